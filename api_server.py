@@ -2,37 +2,114 @@ from __future__ import annotations
 
 import asyncio
 from contextlib import suppress
-from dataclasses import dataclass
+import hashlib
+import hmac
 import time
-from typing import Any, Dict, Optional, Tuple
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import quote
 
 from aiohttp import web
 
 from downloadmain import (
     CFG,
     PARSE_HTML,
+    JOB_KIND_OA_ONLY,
+    db_create_job,
+    db_get_download_link,
     db_get_quota_status,
     db_get_user,
     db_get_user_by_email,
+    db_mark_download_link_used,
+    db_run,
+    download_bot_is_blocked,
+    download_link_error,
+    download_link_require_same_user,
+    download_link_signature,
+    get_job_progress,
+    issue_api_session,
+    logger,
     normalize_doi,
-    process_dois_batch_oa_only,
+    run_doi_job,
+    startup_phase,
+    verify_api_session,
     verify_email_code,
     fetch_openalex,
     _find_oa_pdf_from_openalex_raw,
+    _http_get_json,
+    _valid_email,
 )
+from utils.rate_limit import TokenBucketLimiter, check_all, retry_after_header
 
 
-@dataclass
-class RateLimit:
-    window_s: int = 60
-    max_hits: int = 30
+# نرخ‌محدود token bucket: سطل جدا برای هر IP، هر کاربر (نشست تأییدشده)، ایمیل بدنهٔ login و مسیرهای حساس به ازای هر IP
+_IP_LIMIT = TokenBucketLimiter.per_window(CFG.API_RATE_MAX_HITS, CFG.API_RATE_WINDOW_S, max_keys=CFG.API_RATE_MAX_KEYS)
+_USER_LIMIT = TokenBucketLimiter.per_window(
+    CFG.API_RATE_USER_MAX_HITS, CFG.API_RATE_WINDOW_S, max_keys=CFG.API_RATE_MAX_KEYS
+)
+_LOGIN_EMAIL_LIMIT = TokenBucketLimiter.per_window(
+    CFG.API_RATE_LOGIN_MAX_HITS, CFG.API_RATE_WINDOW_S, max_keys=CFG.API_RATE_MAX_KEYS
+)
+_ROUTE_LIMITS: Dict[str, TokenBucketLimiter] = {
+    path: TokenBucketLimiter.per_window(hits, CFG.API_RATE_WINDOW_S, max_keys=CFG.API_RATE_MAX_KEYS)
+    for path, hits in (
+        ("/api/v1/login", CFG.API_RATE_LOGIN_MAX_HITS),
+        ("/api/v1/me", CFG.API_RATE_LOGIN_MAX_HITS),
+        ("/api/v1/submit_doi", CFG.API_RATE_SUBMIT_MAX_HITS),
+    )
+}
+
+
+def _rate_limit_user_key(request: web.Request) -> str:
+    """کلید کاربر فقط از توکن نشست تأییدشده؛ ایمیل بدنه ادعای تأییدنشده است و سطل کاربر را نمی‌گیرد."""
+    if request.method != "POST":
+        return ""
+    auth = request.headers.get("Authorization", "")
+    if auth[:7].lower() == "bearer ":
+        sess = verify_api_session(auth[7:].strip())
+        return f"user:{sess['email'] or sess['user_id']}" if sess.get("ok") else ""
+    return ""
+
+
+async def _rate_limit_login_email_key(request: web.Request) -> str:
+    """
+    ایمیل بدنهٔ /api/v1/login در فضای نام جدا (ضد brute-force کد روی یک ایمیل)؛
+    پر شدنش فقط login همان ایمیل را محدود می‌کند. بدنه در aiohttp کش می‌شود و handler دوباره همان را می‌خواند.
+    """
+    if request.method != "POST" or request.path != "/api/v1/login" or request.content_type != "application/json":
+        return ""
+    with suppress(Exception):
+        payload = await request.json()
+        email = str(payload.get("email") or "").strip().lower()
+        if email:
+            return f"login-email:{email}"
+    return ""
 
 
-_RL = RateLimit(
-    window_s=int(getattr(CFG, "API_RATE_WINDOW_S", 60) if hasattr(CFG, "API_RATE_WINDOW_S") else 60),
-    max_hits=int(getattr(CFG, "API_RATE_MAX_HITS", 30) if hasattr(CFG, "API_RATE_MAX_HITS") else 30),
-)
-_HITS: Dict[str, list[float]] = {}
+async def _rate_limit_wait(request: web.Request) -> Tuple[float, str]:
+    ip = request.remote or "unknown"
+    checks = [(_IP_LIMIT, f"ip:{ip}")]
+    route_limit = _ROUTE_LIMITS.get(request.path)
+    if route_limit is not None:
+        checks.append((route_limit, f"{request.path}:{ip}"))
+    user_key = _rate_limit_user_key(request)
+    if user_key:
+        checks.append((_USER_LIMIT, user_key))
+    login_key = await _rate_limit_login_email_key(request)
+    if login_key:
+        checks.append((_LOGIN_EMAIL_LIMIT, login_key))
+    return check_all(checks)
+
+
+# شمارنده‌های دانلود مستقیم (در طول عمر پردازه)
+_DOWNLOAD_STATS: Dict[str, int] = {"requests": 0, "completed": 0, "bytes": 0}
+
+_DOWNLOAD_ERROR_STATUS = {"not_found": 404, "expired": 410, "used": 410}
+
+
+def download_stats() -> Dict[str, int]:
+    return dict(_DOWNLOAD_STATS)
 
 
 def _cors_headers() -> Dict[str, str]:
@@ -40,7 +117,7 @@ def _cors_headers() -> Dict[str, str]:
     return {
         "Access-Control-Allow-Origin": "*",
         "Access-Control-Allow-Methods": "GET,POST,OPTIONS",
-        "Access-Control-Allow-Headers": "Content-Type",
+        "Access-Control-Allow-Headers": "Content-Type, Authorization",
     }
 
 
@@ -48,17 +125,19 @@ def _cors_headers() -> Dict[str, str]:
 async def cors_middleware(request: web.Request, handler):
     if request.method == "OPTIONS":
         return web.Response(status=200, headers=_cors_headers())
-
-    # نرخ‌محدود سازی ساده برای جلوگیری از brute-force روی API (به‌خصوص وقتی ریموت است)
-    ip = request.remote or "unknown"
-    now = time.time()
-    arr = _HITS.get(ip, [])
-    cutoff = now - _RL.window_s
-    arr = [t for t in arr if t >= cutoff]
-    arr.append(now)
-    _HITS[ip] = arr
-    if len(arr) > _RL.max_hits:
-        return web.json_response({"ok": False, "error": "rate_limited"}, status=429, headers=_cors_headers())
+    if request.path.startswith(CFG.WEBHOOK_PATH_PREFIX + "/"):
+        # آپدیت‌های تلگرام: بدون CORS/نرخ‌محدود؛ احراز با secret token
+        return await handler(request)
+
+    # نرخ‌محدود سازی برای جلوگیری از brute-force روی API (به‌خصوص وقتی ریموت است)
+    wait, key = await _rate_limit_wait(request)
+    if wait > 0:
+        retry_after = retry_after_header(wait)
+        logger.info("api_rate_limited | key=%s path=%s retry_after=%s", key.split(":", 1)[0], request.path, retry_after)
+        headers = {**_cors_headers(), "Retry-After": retry_after}
+        return web.json_response(
+            {"ok": False, "error": "rate_limited", "retry_after": int(retry_after)}, status=429, headers=headers
+        )
 
     resp = await handler(request)
     for k, v in _cors_headers().items():
@@ -66,49 +145,69 @@ async def cors_middleware(request: web.Request, handler):
     return resp
 
 
-def _auth_user(email: str, code: str) -> Tuple[Optional[int], Optional[Dict[str, Any]]]:
-    result = verify_email_code(email, code)
+async def _auth_user(email: str, code: str) -> Tuple[Optional[int], Optional[Dict[str, Any]]]:
+    result = await db_run(verify_email_code, email, code)
     if not result.get("ok"):
         return None, None
     user_id = result.get("user_id")
     if not user_id:
         return None, None
-    user = db_get_user(int(user_id))
+    user = await db_run(db_get_user, int(user_id))
     if not user:
         return None, None
     return int(user_id), user
 
 
-async def _doi_info(session, doi_raw: str) -> Dict[str, Any]:
-    doi = normalize_doi(doi_raw)
-    title = None
-    year = None
-    is_oa = False
-    oa_pdf_url = None
+def _session_token(request: web.Request, payload: Optional[Dict[str, Any]] = None) -> str:
+    auth = request.headers.get("Authorization", "")
+    if auth[:7].lower() == "bearer ":
+        return auth[7:].strip()
+    return str((payload or {}).get("session") or "").strip()
+
+
+async def _auth_request(request: web.Request, payload: Dict[str, Any]) -> Tuple[Optional[int], str, str]:
+    """
+    (user_id, email, error) برای درخواست‌های بعد از login.
+    توکن نشست (Authorization: Bearer یا فیلد session) بدون DB بررسی می‌شود؛
+    ایمیل+کد فقط برای نسخه‌های قدیمی افزونه پذیرفته می‌شود.
+    """
+    token = _session_token(request, payload)
+    if token:
+        sess = verify_api_session(token)
+        if not sess.get("ok"):
+            return None, "", str(sess.get("error") or "invalid_session")
+        return int(sess["user_id"]), str(sess.get("email") or ""), ""
+    email = str(payload.get("email") or "").strip()
+    code = str(payload.get("code") or "").strip()
+    user_id, user = await _auth_user(email, code)
+    if not user_id or not user:
+        return None, "", "invalid_credentials"
+    return user_id, str(user.get("email") or ""), ""
+
+
+def _doi_color(is_oa: bool, year: Optional[int]) -> str:
+    if is_oa:
+        return "green"
+    if isinstance(year, int) and year < 2022:
+        return "yellow"
+    return "red"
 
-    if not doi:
-        return {"ok": False, "error": "invalid_doi"}
 
+def _doi_info_from_work(doi: str, title: Optional[str], year: Any, oa_raw: Any) -> Dict[str, Any]:
+    is_oa = False
+    oa_pdf_url = None
+    if isinstance(oa_raw, dict):
+        try:
+            oa = oa_raw.get("open_access") or {}
+            is_oa = bool(oa.get("is_oa"))
+        except Exception:
+            is_oa = False
+        with suppress(Exception):
+            oa_pdf_url = _find_oa_pdf_from_openalex_raw(oa_raw)
     try:
-        title, year, _journal, _abstract, _concepts, _src, oa_raw = await fetch_openalex(session, doi)
-        if isinstance(oa_raw, dict):
-            try:
-                oa = oa_raw.get("open_access") or {}
-                is_oa = bool(oa.get("is_oa"))
-            except Exception:
-                is_oa = False
-            with suppress(Exception):
-                oa_pdf_url = _find_oa_pdf_from_openalex_raw(oa_raw)
-    except Exception:
-        pass
-
-    if is_oa:
-        color = "green"
-    elif isinstance(year, int) and year < 2022:
-        color = "yellow"
-    else:
-        color = "red"
-
+        year = int(year) if year else None
+    except (TypeError, ValueError):
+        year = None
     return {
         "ok": True,
         "doi": doi,
@@ -116,14 +215,289 @@ async def _doi_info(session, doi_raw: str) -> Dict[str, Any]:
         "year": year,
         "is_oa": is_oa,
         "oa_pdf_url_present": bool(oa_pdf_url),
-        "color": color,
+        "color": _doi_color(is_oa, year),
     }
 
 
-def create_api_app(*, bot) -> web.Application:
+class _DoiInfoCache:
+    """
+    کش مشترک نتیجهٔ doi_info (کلید: DOI با حروف کوچک) با TTL جدا برای یافت‌نشده‌ها و سقف اندازه.
+    درخواست‌های هم‌زمان برای یک DOI منتظر همان جست‌وجوی در جریان می‌مانند.
+    """
+
+    def __init__(self, ttl_s: float, neg_ttl_s: float, max_items: int) -> None:
+        self.ttl_s = max(0.0, float(ttl_s))
+        self.neg_ttl_s = max(0.0, float(neg_ttl_s))
+        self.max_items = max(1, int(max_items))
+        self._items: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self.inflight: Dict[str, asyncio.Future] = {}
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        hit = self._items.get(key)
+        if not hit:
+            return None
+        if hit[0] < time.monotonic():
+            self._items.pop(key, None)
+            return None
+        self._items.move_to_end(key)
+        return hit[1]
+
+    def put(self, key: str, info: Dict[str, Any], *, negative: bool = False) -> None:
+        ttl = self.neg_ttl_s if negative else self.ttl_s
+        if ttl <= 0:
+            return
+        self._items[key] = (time.monotonic() + ttl, info)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+
+_DOI_CACHE = _DoiInfoCache(CFG.API_DOI_INFO_TTL_S, CFG.API_DOI_INFO_NEG_TTL_S, CFG.API_DOI_INFO_CACHE_MAX)
+# سقف مقادیر OR در فیلتر OpenAlex برای یک درخواست
+_OPENALEX_FILTER_CHUNK = 50
+_OPENALEX_SELECT = "doi,title,publication_year,open_access,best_oa_location"
+
+
+async def _openalex_works(session, dois: List[str]) -> Optional[Dict[str, Dict[str, Any]]]:
+    """چند DOI در یک درخواست (filter=doi:a|b|c)؛ {doi کوچک: work} یا None اگر OpenAlex پاسخ نداد."""
+    params = {"filter": "doi:" + "|".join(dois), "per-page": str(len(dois)), "select": _OPENALEX_SELECT}
+    if _valid_email(CFG.POLITE_CONTACT):
+        params["mailto"] = CFG.POLITE_CONTACT
+    status, data = await _http_get_json(session, CFG.OPENALEX_BASE, params=params)
+    if status != 200 or not isinstance(data, dict) or not isinstance(data.get("results"), list):
+        return None
+    works: Dict[str, Dict[str, Any]] = {}
+    for w in data["results"]:
+        if isinstance(w, dict) and w.get("doi"):
+            works[normalize_doi(str(w["doi"])).lower()] = w
+    return works
+
+
+def _doi_lookup_unavailable(doi: str) -> Dict[str, Any]:
+    """نتیجهٔ قطعی OpenAlex؛ نباید شبیه پاسخ واقعی «OA نیست» باشد و کش نمی‌شود."""
+    return {"ok": False, "error": "lookup_unavailable", "doi": doi}
+
+
+async def _doi_info_single(session, doi: str) -> Tuple[Dict[str, Any], Optional[bool]]:
+    """مسیر قدیمی یک‌به‌یک (برای DOIهایی که در فیلتر OpenAlex جا نمی‌شوند)؛ (info, یافت شد یا None در خطا)."""
+    try:
+        title, year, _journal, _abstract, _concepts, _src, oa_raw = await fetch_openalex(session, doi)
+    except Exception as exc:
+        logger.info("doi_info_lookup_failed | doi=%s err=%s", doi, exc)
+        return _doi_lookup_unavailable(doi), None
+    return _doi_info_from_work(doi, title, year, oa_raw), bool(title)
+
+
+async def _resolve_doi_infos(session, dois: List[str]) -> None:
+    """DOIهای ثبت‌شده در inflight را با فیلتر چند‌DOI در بسته‌های ۵۰تایی حل و در کش می‌گذارد."""
+    try:
+        for i in range(0, len(dois), _OPENALEX_FILTER_CHUNK):
+            chunk = dois[i:i + _OPENALEX_FILTER_CHUNK]
+            batch = [d for d in chunk if "|" not in d and "," not in d]
+            works = await _openalex_works(session, [d.lower() for d in batch]) if batch else {}
+            for doi in chunk:
+                key = doi.lower()
+                if works is not None and doi in batch:
+                    w = works.get(key)
+                    info = _doi_info_from_work(doi, (w or {}).get("title"), (w or {}).get("publication_year"), w)
+                    _DOI_CACHE.put(key, info, negative=w is None)
+                elif works is None:
+                    # OpenAlex در دسترس نبود: نتیجه کش نمی‌شود
+                    info = _doi_lookup_unavailable(doi)
+                else:
+                    info, found = await _doi_info_single(session, doi)
+                    if found is not None:
+                        _DOI_CACHE.put(key, info, negative=not found)
+                fut = _DOI_CACHE.inflight.pop(key, None)
+                if fut is not None and not fut.done():
+                    fut.set_result(info)
+    finally:
+        for doi in dois:
+            fut = _DOI_CACHE.inflight.pop(doi.lower(), None)
+            if fut is not None and not fut.done():
+                fut.set_result(_doi_lookup_unavailable(doi))
+
+
+async def _doi_infos(session, dois: List[str]) -> Dict[str, Dict[str, Any]]:
+    """نتیجهٔ doi_info برای DOIهای نرمال‌شده (کلید: DOI کوچک): کش، سپس جست‌وجوی در جریان، سپس OpenAlex."""
+    out: Dict[str, Dict[str, Any]] = {}
+    waits: Dict[str, asyncio.Future] = {}
+    todo: List[str] = []
+    loop = asyncio.get_running_loop()
+    for doi in dois:
+        key = doi.lower()
+        if key in out or key in waits:
+            continue
+        hit = _DOI_CACHE.get(key)
+        if hit is not None:
+            out[key] = hit
+        elif key in _DOI_CACHE.inflight:
+            waits[key] = _DOI_CACHE.inflight[key]
+        else:
+            fut = loop.create_future()
+            _DOI_CACHE.inflight[key] = waits[key] = fut
+            todo.append(doi)
+    if todo:
+        await _resolve_doi_infos(session, todo)
+    for key, fut in waits.items():
+        out[key] = await fut
+    return out
+
+
+def _doi_info_status(info: Dict[str, Any]) -> int:
+    if info.get("ok"):
+        return 200
+    return 503 if info.get("error") == "lookup_unavailable" else 400
+
+
+async def _doi_info(session, doi_raw: str) -> Dict[str, Any]:
+    doi = normalize_doi(doi_raw)
+    if not doi:
+        return {"ok": False, "error": "invalid_doi"}
+    info = (await _doi_infos(session, [doi]))[doi.lower()]
+    return {**info, "doi": doi}
+
+
+# بازه‌های سروشده با 206 برای هر توکن ([start, end) ادغام‌شده)؛ با پوشش کامل فایل لینک مصرف می‌شود
+_DOWNLOAD_COVERAGE: "OrderedDict[str, List[Tuple[int, int]]]" = OrderedDict()
+_DOWNLOAD_COVERAGE_MAX = 10_000
+
+
+def _record_served_range(token: str, content_range: str) -> bool:
+    """بازهٔ Content-Range («bytes a-b/total») را به پوشش توکن اضافه می‌کند؛ True یعنی کل فایل تحویل شده."""
+    try:
+        span, total_s = content_range.split(" ", 1)[1].split("/", 1)
+        start_s, end_s = span.split("-", 1)
+        start, end, total = int(start_s), int(end_s) + 1, int(total_s)
+    except (IndexError, ValueError):
+        return False
+    merged: List[List[int]] = []
+    for a, b in sorted(_DOWNLOAD_COVERAGE.pop(token, []) + [(start, end)]):
+        if merged and a <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], b)
+        else:
+            merged.append([a, b])
+    if merged[0][0] <= 0 and merged[0][1] >= total:
+        return True
+    _DOWNLOAD_COVERAGE[token] = [(a, b) for a, b in merged]
+    while len(_DOWNLOAD_COVERAGE) > _DOWNLOAD_COVERAGE_MAX:
+        _DOWNLOAD_COVERAGE.popitem(last=False)
+    return False
+
+
+class _DownloadResponse(web.FileResponse):
+    """
+    FileResponse که پس از پایان ارسال (sendfile) بایت‌های سروشده را ثبت می‌کند و با تحویل کامل لینک را مصرف می‌کند:
+    یک 200، یا مجموعه‌ای از 206ها که روی هم کل فایل را پوشش دهند (مثلاً «Range: bytes=0-» در download managerها).
+    """
+
+    def __init__(self, path: Path, *, token: str, owner_id: int) -> None:
+        super().__init__(path, chunk_size=256 * 1024)
+        self._token = token
+        self._owner_id = owner_id
+
+    async def prepare(self, request: web.BaseRequest):
+        if self.prepared:
+            return None
+        t0 = time.perf_counter()
+        _DOWNLOAD_STATS["requests"] += 1
+        try:
+            writer = await super().prepare(request)
+        except ConnectionError as exc:
+            logger.info("http_download_aborted | token=%s… err=%s", self._token[:8], exc)
+            raise
+        if request.method != "GET":
+            return writer
+        served = int(self.content_length or 0)
+        complete = self.status == 200 or (
+            self.status == 206 and _record_served_range(self._token, self.headers.get("Content-Range", ""))
+        )
+        _DOWNLOAD_STATS["bytes"] += served
+        logger.info(
+            "http_download | token=%s… status=%s bytes=%d complete=%s ms=%.0f total_bytes=%d",
+            self._token[:8], self.status, served, complete, (time.perf_counter() - t0) * 1000,
+            _DOWNLOAD_STATS["bytes"],
+        )
+        if complete:
+            _DOWNLOAD_STATS["completed"] += 1
+            with suppress(Exception):
+                await db_run(db_mark_download_link_used, self._token, used_by=self._owner_id or None)
+        return writer
+
+
+async def _direct_download(request: web.Request) -> web.StreamResponse:
+    """
+    GET /d/{token}: همان قواعد ربات دانلود (انقضا، یک‌بار مصرف، کاربر مسدود، و «همان کاربر» از تنظیمات
+    پنل ادمین با امضای HMAC در ?sig=). فایل با FileResponse (sendfile و Range/If-Range) سرو می‌شود تا
+    دانلودِ نیمه‌کاره ادامه پیدا کند؛ لینک فقط با تحویل کامل فایل (200 یا 206هایی که روی هم کل فایل‌اند) مصرف‌شده ثبت می‌شود.
+    """
+    token = request.match_info.get("token", "")
+    rec = await db_run(db_get_download_link, token)
+    err = download_link_error(rec)
+    if err:
+        return web.json_response({"ok": False, "error": f"link_{err}"}, status=_DOWNLOAD_ERROR_STATUS[err])
+    owner_id = int(rec.get("user_id") or 0)
+    if owner_id and await db_run(download_bot_is_blocked, owner_id):
+        return web.json_response({"ok": False, "error": "blocked"}, status=403)
+    if owner_id and await db_run(download_link_require_same_user):
+        # مقایسهٔ بایتی: compare_digest روی str غیر ASCII خطای TypeError (و 500) می‌دهد
+        sig = request.query.get("sig", "").encode("utf-8", "surrogateescape")
+        if not hmac.compare_digest(sig, download_link_signature(token, owner_id).encode()):
+            return web.json_response({"ok": False, "error": "invalid_signature"}, status=403)
+    fpath = Path(str(rec.get("file_path") or ""))
+    if not fpath.is_file():
+        return web.json_response({"ok": False, "error": "file_not_found"}, status=404)
+
+    resp = _DownloadResponse(fpath, token=token, owner_id=owner_id)
+    resp.headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{quote(rec.get('filename') or fpath.name)}"
+    resp.headers["Cache-Control"] = "private, no-store"
+    return resp
+
+
+def webhook_secret(name: str) -> str:
+    """secret token جدا برای هر ربات (کاراکترهای مجاز تلگرام: hex)."""
+    return hmac.new(CFG.WEBHOOK_SECRET.encode(), name.encode(), hashlib.sha256).hexdigest()
+
+
+def webhook_url(name: str) -> str:
+    return f"{CFG.WEBHOOK_BASE_URL}{CFG.WEBHOOK_PATH_PREFIX}/{name}"
+
+
+def _add_webhook_route(app: web.Application, name: str, application) -> None:
+    """POST {prefix}/{name}: آپدیت را در update_queue همان Application می‌گذارد و فوراً 200 برمی‌گرداند."""
+    from telegram import Update
+
+    secret = webhook_secret(name)
+
+    async def handle(request: web.Request) -> web.Response:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        # مقایسهٔ بایتی: compare_digest روی str غیر ASCII خطای TypeError (و 500) می‌دهد
+        if not hmac.compare_digest(token.encode("utf-8", "surrogateescape"), secret.encode()):
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+            update = Update.de_json(data, application.bot)
+        except Exception:
+            return web.Response(status=400)
+        if update is not None:
+            await application.update_queue.put(update)
+        return web.Response(status=200)
+
+    app.router.add_route("POST", f"{CFG.WEBHOOK_PATH_PREFIX}/{name}", handle)
+
+
+def create_api_app(*, bot, webhooks: Optional[Dict[str, Any]] = None, api: bool = True) -> web.Application:
+    """
+    api=False (API_ENABLED=0) فقط مسیرهای webhook را سوار می‌کند؛ Caddy کل دامنهٔ عمومی را به این سرور می‌فرستد
+    و روشن کردن webhook نباید API افزونه و /d/{token} را که اپراتور خاموش کرده باز کند.
+    """
     app = web.Application(middlewares=[cors_middleware])
     app["bot"] = bot
     app["session"] = None
+    for name, application in (webhooks or {}).items():
+        _add_webhook_route(app, name, application)
+    if not api:
+        return app
 
     async def startup(app_: web.Application) -> None:
         import aiohttp
@@ -145,10 +519,11 @@ def create_api_app(*, bot) -> web.Application:
         payload = await request.json()
         email = str(payload.get("email") or "").strip()
         code = str(payload.get("code") or "").strip()
-        user_id, user = _auth_user(email, code)
+        user_id, user = await _auth_user(email, code)
         if not user_id or not user:
             return web.json_response({"ok": False, "error": "invalid_credentials"}, status=401)
-        quota = db_get_quota_status(user_id)
+        quota = await db_run(db_get_quota_status, user_id)
+        session = issue_api_session(user_id, str(user.get("email") or email))
         return web.json_response(
             {
                 "ok": True,
@@ -157,22 +532,22 @@ def create_api_app(*, bot) -> web.Application:
                 "quota": quota,
                 "account_active": bool(quota["remaining_free"] or quota["remaining_paid"]),
                 "ai_active": bool(CFG.GROQ_API_KEY),
+                "session": session["token"] if session else None,
+                "session_expires_at": session["expires_at"] if session else None,
             }
         )
 
     async def me(request: web.Request) -> web.Response:
         payload = await request.json()
-        email = str(payload.get("email") or "").strip()
-        code = str(payload.get("code") or "").strip()
-        user_id, user = _auth_user(email, code)
-        if not user_id or not user:
-            return web.json_response({"ok": False, "error": "invalid_credentials"}, status=401)
-        quota = db_get_quota_status(user_id)
+        user_id, email, err = await _auth_request(request, payload)
+        if not user_id:
+            return web.json_response({"ok": False, "error": err}, status=401)
+        quota = await db_run(db_get_quota_status, user_id)
         return web.json_response(
             {
                 "ok": True,
                 "user_id": user_id,
-                "email": user.get("email"),
+                "email": email,
                 "quota": quota,
                 "account_active": bool(quota["remaining_free"] or quota["remaining_paid"]),
                 "ai_active": bool(CFG.GROQ_API_KEY),
@@ -186,18 +561,35 @@ def create_api_app(*, bot) -> web.Application:
         if not sess:
             return web.json_response({"ok": False, "error": "session_not_ready"}, status=503)
         info = await _doi_info(sess, doi_raw)
-        status = 200 if info.get("ok") else 400
-        return web.json_response(info, status=status)
+        return web.json_response(info, status=_doi_info_status(info))
+
+    async def doi_info_batch(request: web.Request) -> web.Response:
+        payload = await request.json()
+        raw = payload.get("dois")
+        if not isinstance(raw, list):
+            return web.json_response({"ok": False, "error": "invalid_input"}, status=400)
+        if len(raw) > CFG.API_DOI_INFO_BATCH_MAX:
+            return web.json_response(
+                {"ok": False, "error": "too_many_dois", "max": CFG.API_DOI_INFO_BATCH_MAX}, status=400
+            )
+        sess = request.app.get("session")
+        if not sess:
+            return web.json_response({"ok": False, "error": "session_not_ready"}, status=503)
+        pairs = [(str(r or "").strip(), normalize_doi(str(r or ""))) for r in raw]
+        infos = await _doi_infos(sess, [d for _, d in pairs if d])
+        items = [
+            {**infos[d.lower()], "doi": d, "input": r} if d else {"ok": False, "error": "invalid_doi", "input": r}
+            for r, d in pairs
+        ]
+        return web.json_response({"ok": True, "items": items})
 
     async def submit_doi(request: web.Request) -> web.Response:
         payload = await request.json()
-        email = str(payload.get("email") or "").strip()
-        code = str(payload.get("code") or "").strip()
         doi_raw = str(payload.get("doi") or "").strip()
 
-        user_id, user = _auth_user(email, code)
-        if not user_id or not user:
-            return web.json_response({"ok": False, "error": "invalid_credentials"}, status=401)
+        user_id, _email, err = await _auth_request(request, payload)
+        if not user_id:
+            return web.json_response({"ok": False, "error": err}, status=401)
 
         sess = request.app.get("session")
         if not sess:
@@ -205,7 +597,7 @@ def create_api_app(*, bot) -> web.Application:
 
         info = await _doi_info(sess, doi_raw)
         if not info.get("ok"):
-            return web.json_response(info, status=400)
+            return web.json_response(info, status=_doi_info_status(info))
 
         # فقط OA: اگر OA نیست، فقط وضعیت را برگردان (بدون شروع دانلود)
         if not info.get("is_oa"):
@@ -221,6 +613,7 @@ def create_api_app(*, bot) -> web.Application:
 
         bot_ = request.app["bot"]
         doi = str(info.get("doi") or "")
+        job_id = await db_run(db_create_job, user_id, user_id, JOB_KIND_OA_ONLY, [doi])
 
         async def _run() -> None:
             try:
@@ -231,27 +624,45 @@ def create_api_app(*, bot) -> web.Application:
                 )
             except Exception:
                 pass
-            await process_dois_batch_oa_only(user_id, [doi], user_id, bot_)
+            await run_doi_job(job_id, bot_)
 
         asyncio.create_task(_run())
-        return web.json_response({"ok": True, "queued": True, "doi_info": info})
+        return web.json_response({"ok": True, "queued": True, "job_id": job_id, "doi_info": info})
+
+    async def job_status(request: web.Request) -> web.Response:
+        payload = await request.json()
+        user_id, _email, err = await _auth_request(request, payload)
+        if not user_id:
+            return web.json_response({"ok": False, "error": err}, status=401)
+        try:
+            job_id = int(payload.get("job_id") or 0)
+        except (TypeError, ValueError):
+            job_id = 0
+        progress = await get_job_progress(job_id) if job_id else {}
+        if not progress or progress.get("user_id") != user_id:
+            return web.json_response({"ok": False, "error": "job_not_found"}, status=404)
+        return web.json_response({"ok": True, "job": progress})
 
     app.router.add_route("POST", "/api/v1/login", login)
     app.router.add_route("POST", "/api/v1/me", me)
     app.router.add_route("POST", "/api/v1/doi_info", doi_info)
+    app.router.add_route("POST", "/api/v1/doi_info_batch", doi_info_batch)
     app.router.add_route("POST", "/api/v1/submit_doi", submit_doi)
+    app.router.add_route("POST", "/api/v1/job_status", job_status)
+    app.router.add_get("/d/{token}", _direct_download)  # HEAD هم برای download managerها
     app.router.add_route("OPTIONS", "/{tail:.*}", lambda r: web.Response(status=200, headers=_cors_headers()))
     return app
 
 
-async def start_api_server(*, bot) -> Optional[web.AppRunner]:
-    if not CFG.API_ENABLED:
+async def start_api_server(*, bot, webhooks: Optional[Dict[str, Any]] = None) -> Optional[web.AppRunner]:
+    if not CFG.API_ENABLED and not webhooks:
         return None
-    app = create_api_app(bot=bot)
-    runner = web.AppRunner(app)
-    await runner.setup()
-    site = web.TCPSite(runner, host=CFG.API_HOST, port=CFG.API_PORT)
-    await site.start()
+    with startup_phase("api_server"):
+        app = create_api_app(bot=bot, webhooks=webhooks, api=CFG.API_ENABLED)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, host=CFG.API_HOST, port=CFG.API_PORT)
+        await site.start()
     return runner
 
 
@@ -1,11 +1,11 @@
 const DEFAULT_API_BASE = "http://127.0.0.1:8787";
 
 async function getConfig() {
-  const cfg = await chrome.storage.local.get(["apiBase", "email", "code", "proxyEnabled"]);
+  const cfg = await chrome.storage.local.get(["apiBase", "email", "session", "proxyEnabled"]);
   return {
     apiBase: (cfg.apiBase || DEFAULT_API_BASE).replace(/\/+$/, ""),
     email: cfg.email || "",
-    code: cfg.code || "",
+    session: cfg.session || "",
     proxyEnabled: Boolean(cfg.proxyEnabled),
   };
 }
@@ -13,12 +13,18 @@ async function getConfig() {
 async function apiRequest(path, body) {
   const cfg = await getConfig();
   const url = `${cfg.apiBase}${path}`;
+  const headers = { "Content-Type": "application/json" };
+  if (cfg.session) headers.Authorization = `Bearer ${cfg.session}`;
   const resp = await fetch(url, {
     method: "POST",
-    headers: { "Content-Type": "application/json" },
+    headers,
     body: JSON.stringify(body),
   });
   const data = await resp.json().catch(() => ({}));
+  if (resp.status === 401 && cfg.session && path !== "/api/v1/login") {
+    // Expired or invalid session: drop it so the popup asks for a new login code.
+    await chrome.storage.local.set({ session: "" });
+  }
   if (!resp.ok) {
     const msg = data?.error || data?.message || `HTTP ${resp.status}`;
     throw new Error(msg);
@@ -26,6 +32,72 @@ async function apiRequest(path, body) {
   return data;
 }
 
+// DOI info results are cached in chrome.storage.session (cleared when the browser closes).
+const DOI_INFO_TTL_MS = 30 * 60 * 1000;
+const DOI_BATCH_MAX = 100;
+const inflightDoiInfo = new Map(); // lowercased DOI -> Promise<info>
+
+function doiCacheKey(doi) {
+  return `doi:${doi.toLowerCase()}`;
+}
+
+// Only real OpenAlex answers are cached. Outage results ({ok: false, error: "lookup_unavailable"}, or the
+// title-less/year-less placeholders older servers returned) would otherwise mark DOIs red for the whole TTL.
+function isCacheableDoiInfo(info) {
+  return Boolean(info?.ok && !info.error && (info.title || info.year));
+}
+
+async function fetchDoiInfos(dois) {
+  const out = {};
+  for (let i = 0; i < dois.length; i += DOI_BATCH_MAX) {
+    const chunk = dois.slice(i, i + DOI_BATCH_MAX);
+    const data = await apiRequest("/api/v1/doi_info_batch", { dois: chunk });
+    const now = Date.now();
+    const toStore = {};
+    (data?.items || []).forEach((info, idx) => {
+      const doi = chunk[idx].toLowerCase();
+      out[doi] = info;
+      if (isCacheableDoiInfo(info)) toStore[doiCacheKey(doi)] = { info, at: now };
+    });
+    await chrome.storage.session.set(toStore);
+  }
+  return out;
+}
+
+// Returns {lowercased DOI: info}. Serves from the session cache, joins lookups already in flight,
+// and sends everything else to the API as one batch request.
+async function getDoiInfos(dois) {
+  const unique = [...new Set((dois || []).map((d) => String(d || "").trim()).filter(Boolean))];
+  const cached = await chrome.storage.session.get(unique.map(doiCacheKey));
+  const now = Date.now();
+  const result = {};
+  const waits = [];
+  const missing = [];
+  for (const doi of unique) {
+    const key = doi.toLowerCase();
+    const hit = cached[doiCacheKey(doi)];
+    if (hit && now - hit.at < DOI_INFO_TTL_MS) {
+      result[key] = hit.info;
+    } else if (inflightDoiInfo.has(key)) {
+      waits.push(inflightDoiInfo.get(key).then((info) => { result[key] = info; }));
+    } else {
+      missing.push(doi);
+    }
+  }
+  if (missing.length) {
+    const batch = fetchDoiInfos(missing);
+    for (const doi of missing) {
+      const key = doi.toLowerCase();
+      const p = batch.then((infos) => infos[key] || { ok: false, error: "lookup_failed" });
+      inflightDoiInfo.set(key, p);
+      p.finally(() => inflightDoiInfo.delete(key)).catch(() => {});
+      waits.push(p.then((info) => { result[key] = info; }));
+    }
+  }
+  await Promise.all(waits);
+  return result;
+}
+
 chrome.runtime.onMessage.addListener((msg, _sender, sendResponse) => {
   (async () => {
     if (msg?.type === "api") {
@@ -33,6 +105,10 @@ chrome.runtime.onMessage.addListener((msg, _sender, sendResponse) => {
       sendResponse({ ok: true, data });
       return;
     }
+    if (msg?.type === "doiInfo") {
+      sendResponse({ ok: true, data: await getDoiInfos(msg.dois) });
+      return;
+    }
     if (msg?.type === "getConfig") {
       sendResponse({ ok: true, data: await getConfig() });
       return;
@@ -44,16 +120,16 @@ chrome.runtime.onMessage.addListener((msg, _sender, sendResponse) => {
         sendResponse({ ok: false, error: "no_doi" });
         return;
       }
-      if (!cfg.email || !cfg.code) {
+      if (!cfg.session) {
         sendResponse({ ok: false, error: "not_logged_in" });
         return;
       }
-      const info = await apiRequest("/api/v1/doi_info", { doi });
+      const info = (await getDoiInfos([doi]))[doi.toLowerCase()];
       if (!info?.ok || info?.color !== "green") {
         sendResponse({ ok: false, error: "not_open_access", data: info });
         return;
       }
-      const out = await apiRequest("/api/v1/submit_doi", { email: cfg.email, code: cfg.code, doi });
+      const out = await apiRequest("/api/v1/submit_doi", { doi });
       sendResponse({ ok: true, data: out });
       return;
     }
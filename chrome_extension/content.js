@@ -1,23 +1,61 @@
 const DOI_RE = /\b(10\.\d{4,9}\/[-._;()/:A-Z0-9]+)\b/i;
+const DOI_RE_ALL = /\b(10\.\d{4,9}\/[-._;()/:A-Z0-9]+)\b/gi;
+const META_SELECTORS = [
+  'meta[name="citation_doi"]',
+  'meta[name="dc.identifier"]',
+  'meta[name="dc.Identifier"]',
+  'meta[name="DC.Identifier"]',
+];
+const SCAN_DEBOUNCE_MS = 500;
+const MAX_SCAN_CHARS = 200000;
 
-function findDoi() {
-  const metas = [
-    'meta[name="citation_doi"]',
-    'meta[name="dc.identifier"]',
-    'meta[name="dc.Identifier"]',
-    'meta[name="DC.Identifier"]',
-  ];
-  for (const sel of metas) {
+// All DOIs seen on this page (lowercased -> as written), in the order they were found.
+const pageDois = new Map();
+// Lowercased DOI -> info from the background worker (which caches it in chrome.storage.session).
+const doiInfos = new Map();
+
+function metaDoi() {
+  for (const sel of META_SELECTORS) {
     const el = document.querySelector(sel);
     const content = (el?.getAttribute("content") || "").trim();
     if (!content) continue;
     const m = content.match(DOI_RE);
     if (m?.[1]) return m[1];
   }
+  return null;
+}
+
+function findDoi() {
+  return metaDoi() || pageDois.values().next().value || null;
+}
+
+function collectDois(text) {
+  let added = false;
+  for (const m of (text || "").slice(0, MAX_SCAN_CHARS).matchAll(DOI_RE_ALL)) {
+    const key = m[1].toLowerCase();
+    if (!pageDois.has(key)) {
+      pageDois.set(key, m[1]);
+      added = true;
+    }
+  }
+  return added;
+}
 
-  const text = `${document.title}\n${document.body?.innerText || ""}`.slice(0, 200000);
-  const m = text.match(DOI_RE);
-  return m?.[1] || null;
+function scanNode(node) {
+  if (node.nodeType === Node.TEXT_NODE) return collectDois(node.nodeValue);
+  if (node.nodeType !== Node.ELEMENT_NODE || node.id === "doi-helper-fab") return false;
+  let added = collectDois(node.innerText || node.textContent);
+  for (const a of node.querySelectorAll?.('a[href*="doi.org/10."]') || []) {
+    const href = a.getAttribute("href") || "";
+    let decoded = href;
+    try {
+      decoded = decodeURIComponent(href);
+    } catch {
+      // keep the raw href
+    }
+    added = collectDois(decoded) || added;
+  }
+  return added;
 }
 
 function createFab() {
@@ -74,25 +112,61 @@ async function updateFab(fab) {
     setFabColor(fab, "gray");
     return;
   }
-  fab.title = `DOI: ${doi}\nClick to send (Open Access only)`;
 
-  const cfgResp = await chrome.runtime.sendMessage({ type: "getConfig" });
-  const apiBase = cfgResp?.data?.apiBase;
-  if (!apiBase) return;
-
-  try {
-    const resp = await fetch(`${apiBase}/api/v1/doi_info`, {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ doi }),
-    });
-    const data = await resp.json().catch(() => ({}));
-    if (data?.ok && data?.color) setFabColor(fab, data.color);
-  } catch {
-    // ignore
+  const unknown = [...pageDois.values()].filter((d) => !doiInfos.has(d.toLowerCase()));
+  if (!doiInfos.has(doi.toLowerCase())) unknown.unshift(doi);
+  if (unknown.length) {
+    try {
+      const resp = await chrome.runtime.sendMessage({ type: "doiInfo", dois: unknown });
+      for (const [key, info] of Object.entries(resp?.data || {})) doiInfos.set(key, info);
+    } catch {
+      // ignore
+    }
   }
+
+  const total = new Set([doi.toLowerCase(), ...pageDois.keys()]).size;
+  const oa = [...doiInfos.values()].filter((i) => i?.is_oa).length;
+  fab.title = total > 1
+    ? `DOI: ${doi}\n${total} DOIs on this page (${oa} Open Access)\nClick to send (Open Access only)`
+    : `DOI: ${doi}\nClick to send (Open Access only)`;
+  const info = doiInfos.get(doi.toLowerCase());
+  if (info?.ok && info?.color) setFabColor(fab, info.color);
 }
 
+chrome.runtime.onMessage.addListener((msg, _sender, sendResponse) => {
+  if (msg?.type === "getDois") {
+    sendResponse({ ok: true, doi: findDoi(), dois: [...pageDois.values()] });
+  }
+});
+
 const fab = createFab();
+collectDois(document.title);
+scanNode(document.body || document.documentElement);
 updateFab(fab);
-setInterval(() => updateFab(fab), 8000);
+
+// Rescan only what changed instead of polling the whole page.
+let pendingNodes = [];
+let scanTimer = null;
+let lastPrimary = findDoi();
+const observer = new MutationObserver((mutations) => {
+  for (const mut of mutations) {
+    if (mut.type === "characterData") pendingNodes.push(mut.target);
+    else for (const node of mut.addedNodes) pendingNodes.push(node);
+  }
+  if (scanTimer || !pendingNodes.length) return;
+  scanTimer = setTimeout(() => {
+    scanTimer = null;
+    const nodes = pendingNodes;
+    pendingNodes = [];
+    let changed = false;
+    for (const node of nodes) {
+      if (node.isConnected && !fab.contains(node)) changed = scanNode(node) || changed;
+    }
+    const primary = findDoi();
+    if (changed || primary !== lastPrimary) {
+      lastPrimary = primary;
+      updateFab(fab);
+    }
+  }, SCAN_DEBOUNCE_MS);
+});
+observer.observe(document.documentElement, { childList: true, subtree: true, characterData: true });
@@ -35,6 +35,13 @@ async function getActiveTab() {
 async function extractDoiFromPage() {
   const tab = await getActiveTab();
   if (!tab?.id) return null;
+  // The content script already tracks the page's DOIs; only inject a scan when it is not running.
+  try {
+    const res = await chrome.tabs.sendMessage(tab.id, { type: "getDois" });
+    if (res?.ok) return res.doi || null;
+  } catch {
+    // no content script in this tab (e.g. opened before install)
+  }
   const [{ result } = { result: null }] = await chrome.scripting.executeScript({
     target: { tabId: tab.id },
     func: () => {
@@ -78,8 +85,10 @@ async function refreshDoi() {
   $("btnOpenDoi").disabled = false;
   $("btnOpenDoi").onclick = () => chrome.tabs.create({ url: `https://doi.org/${encodeURIComponent(doi)}` });
 
-  const { email, code } = await getLocal(["email", "code"]);
-  const info = await sendApi("/api/v1/doi_info", { doi });
+  const { session } = await getLocal(["session"]);
+  const res = await chrome.runtime.sendMessage({ type: "doiInfo", dois: [doi] });
+  if (!res?.ok) throw new Error(res?.error || "API error");
+  const info = res.data?.[doi.toLowerCase()] || {};
 
   if (info.color === "green") setPill($("doiPill"), "Open Access", "ok");
   else if (info.color === "yellow") setPill($("doiPill"), "Unknown (pre‑2022)", "warn");
@@ -90,11 +99,11 @@ async function refreshDoi() {
       ? "Looks Open Access. You can send it to the bot."
       : "Not Open Access. The extension will not send this DOI.";
 
-  $("btnSend").disabled = info.color !== "green" || !email || !code;
+  $("btnSend").disabled = info.color !== "green" || !session;
   $("btnSend").onclick = async () => {
     $("sendError").classList.add("hidden");
     try {
-      await sendApi("/api/v1/submit_doi", { email, code, doi });
+      await sendApi("/api/v1/submit_doi", { doi });
       $("doiMsg").textContent = "Queued. Check Telegram.";
     } catch (e) {
       $("sendError").textContent = String(e?.message || e);
@@ -106,8 +115,8 @@ async function refreshDoi() {
 }
 
 async function loadDashboard() {
-  const { email, code } = await getLocal(["email", "code"]);
-  if (!email || !code) {
+  const { session } = await getLocal(["session"]);
+  if (!session) {
     $("btnLogout").classList.add("hidden");
     show("viewWelcome");
     return;
@@ -117,7 +126,7 @@ async function loadDashboard() {
   show("viewDash");
 
   try {
-    const data = await sendApi("/api/v1/me", { email, code });
+    const data = await sendApi("/api/v1/me", {});
     setPill($("accountStatus"), data.account_active ? "Active" : "Inactive", data.account_active ? "ok" : "bad");
     setPill($("aiStatus"), data.ai_active ? "Enabled" : "Disabled", data.ai_active ? "ok" : "bad");
     $("freeUsed").textContent = data.quota.used_free;
@@ -158,8 +167,9 @@ async function init() {
     const email = ($("email").value || "").trim();
     const code = ($("code").value || "").trim();
     try {
-      await sendApi("/api/v1/login", { email, code });
-      await setLocal({ email, code });
+      const data = await sendApi("/api/v1/login", { email, code });
+      if (!data.session) throw new Error("no_session");
+      await setLocal({ email, session: data.session, code: "" });
       await loadDashboard();
     } catch (e) {
       $("loginError").textContent = "Email or code is incorrect.";
@@ -168,7 +178,7 @@ async function init() {
   };
 
   $("btnLogout").onclick = async () => {
-    await setLocal({ email: "", code: "" });
+    await setLocal({ email: "", session: "", code: "" });
     $("btnLogout").classList.add("hidden");
     show("viewWelcome");
   };
@@ -6,8 +6,9 @@ import json
 import re
 import sys
 import time
+from contextlib import suppress
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Set
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.error import BadRequest
@@ -15,6 +16,7 @@ from telegram.ext import (
     Application,
     CallbackContext,
     CallbackQueryHandler,
+    ChatMemberHandler,
     CommandHandler,
     ContextTypes,
     MessageHandler,
@@ -27,17 +29,33 @@ if str(_ROOT) not in sys.path:
 
 from downloadmain import (
     CFG,
+    DOWNLOAD_BOT_BLOCKED_KEY,
+    DOWNLOAD_BOT_CONFIG_KEY,
+    chat_serial_update_processor,
+    configure_bot_api,
+    db_add_scheduled_deletion,
     db_cleanup_download_links,
     db_get_download_link,
     db_get_setting,
+    db_get_setting_json,
     db_init,
+    db_list_scheduled_deletions,
     db_mark_download_link_used,
+    db_remove_scheduled_deletions,
+    db_run,
     db_set_setting,
+    document_input,
+    download_http_url,
+    logger,
+    startup_phase,
+    startup_report,
+    upload_size_allowed,
+    upload_slot,
 )
 
 ADMIN_KEY = "DOWNLOAD_BOT_ADMINS"
-BLOCK_KEY = "DOWNLOAD_BOT_BLOCKED"
-CONFIG_KEY = "DOWNLOAD_BOT_CONFIG"
+BLOCK_KEY = DOWNLOAD_BOT_BLOCKED_KEY
+CONFIG_KEY = DOWNLOAD_BOT_CONFIG_KEY
 CHANNELS_KEY = "DOWNLOAD_BOT_REQUIRED_CHANNELS"
 CHANNEL_LINKS_KEY = "DOWNLOAD_BOT_REQUIRED_CHANNEL_LINKS"
 
@@ -151,6 +169,10 @@ async def _get_bot_id(bot) -> Optional[int]:
     global _BOT_ID
     if _BOT_ID:
         return _BOT_ID
+    with suppress(Exception):
+        # بعد از initialize، شناسهٔ ربات بدون درخواست شبکه در دسترس است
+        _BOT_ID = int(bot.id)
+        return _BOT_ID
     try:
         me = await bot.get_me()
         _BOT_ID = int(me.id)
@@ -159,24 +181,116 @@ async def _get_bot_id(bot) -> Optional[int]:
         return None
 
 
+def _channel_key(ref: Any) -> str:
+    return str(ref).strip().lower()
+
+
+class _MembershipCache:
+    """
+    کش TTL برای نتایج get_chat_member.
+    نتیجهٔ مثبت (عضو/ادمین) مدت طولانی‌تر و نتیجهٔ منفی مدت کوتاه‌تر نگه داشته می‌شود تا کاربری که
+    تازه عضو شده زود دوباره بررسی شود. با آپدیت‌های chat_member/my_chat_member باطل می‌شود.
+    """
+
+    def __init__(self) -> None:
+        self._members: Dict[Tuple[int, str], Tuple[bool, float]] = {}
+        self._admin: Dict[str, Tuple[bool, float]] = {}
+        self._admin_inflight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _fresh(entry: Optional[Tuple[bool, float]]) -> Optional[bool]:
+        if entry and entry[1] > time.monotonic():
+            return entry[0]
+        return None
+
+    @staticmethod
+    def _expiry(ok: bool, pos_ttl: int, neg_ttl: int) -> float:
+        return time.monotonic() + max(0, int(pos_ttl if ok else neg_ttl))
+
+    def get_member(self, user_id: int, ref: Any) -> Optional[bool]:
+        val = self._fresh(self._members.get((int(user_id), _channel_key(ref))))
+        if val is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return val
+
+    def set_member(self, user_id: int, ref: Any, is_member: bool) -> None:
+        if len(self._members) > 50_000:
+            self.prune()
+        self._members[(int(user_id), _channel_key(ref))] = (
+            is_member,
+            self._expiry(is_member, CFG.DOWNLOAD_MEMBER_CACHE_TTL_S, CFG.DOWNLOAD_MEMBER_NEG_TTL_S),
+        )
+
+    async def bot_is_admin(self, ref: Any, fetch) -> bool:
+        key = _channel_key(ref)
+        val = self._fresh(self._admin.get(key))
+        if val is not None:
+            return val
+        # هم‌زمانی: برای یک کانال فقط یک درخواست در جریان باشد
+        fut = self._admin_inflight.get(key)
+        if fut is not None:
+            try:
+                return await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                if not fut.cancelled() or asyncio.current_task().cancelling():
+                    raise
+                # درخواست اصلی لغو شد (نه این یکی)؛ خودمان دوباره بپرس
+                return await self.bot_is_admin(ref, fetch)
+        fut = asyncio.get_running_loop().create_future()
+        self._admin_inflight[key] = fut
+        try:
+            ok = bool(await fetch())
+            self._admin[key] = (ok, self._expiry(ok, CFG.DOWNLOAD_ADMIN_CACHE_TTL_S, CFG.DOWNLOAD_MEMBER_NEG_TTL_S))
+            fut.set_result(ok)
+            return ok
+        except Exception as exc:
+            fut.set_exception(exc)
+            raise
+        finally:
+            self._admin_inflight.pop(key, None)
+            # لغو (CancelledError) از except بالا رد می‌شود؛ منتظرها نباید برای همیشه بمانند
+            if not fut.done():
+                fut.cancel()
+
+    def invalidate_chat(self, chat_keys: Set[str], user_id: Optional[int] = None) -> None:
+        if user_id is None:
+            for key in chat_keys:
+                self._admin.pop(key, None)
+            return
+        for key in chat_keys:
+            self._members.pop((int(user_id), key), None)
+
+    def prune(self) -> None:
+        now = time.monotonic()
+        self._members = {k: v for k, v in self._members.items() if v[1] > now}
+        self._admin = {k: v for k, v in self._admin.items() if v[1] > now}
+
+
+_MEMBERS = _MembershipCache()
+
+
 async def _bot_is_admin_in_channel(bot, ref: Any) -> bool:
     bot_id = await _get_bot_id(bot)
     if not bot_id:
         return False
-    try:
-        member = await bot.get_chat_member(ref, bot_id)
-        status = str(getattr(member, "status", "")).lower()
-        return status in {"administrator", "creator"}
-    except Exception:
-        return False
+
+    async def _fetch() -> bool:
+        try:
+            member = await bot.get_chat_member(ref, bot_id)
+            status = str(getattr(member, "status", "")).lower()
+            return status in {"administrator", "creator"}
+        except Exception:
+            return False
+
+    return await _MEMBERS.bot_is_admin(ref, _fetch)
 
 
 def _load_id_list(key: str) -> List[int]:
-    raw = db_get_setting(key) or "[]"
-    try:
-        data = json.loads(raw)
-    except Exception:
-        return []
+    data = db_get_setting_json(key)
     if not isinstance(data, list):
         return []
     out: List[int] = []
@@ -219,13 +333,7 @@ def _load_config() -> Dict[str, Any]:
         "require_same_user": bool(CFG.DOWNLOAD_LINK_REQUIRE_SAME_USER),
         "enforce_channels": bool(CFG.DOWNLOAD_CHANNELS_ENFORCED and bool(channels)),
     }
-    raw = db_get_setting(CONFIG_KEY)
-    if not raw:
-        return cfg
-    try:
-        data = json.loads(raw)
-    except Exception:
-        return cfg
+    data = db_get_setting_json(CONFIG_KEY)
     if isinstance(data, dict):
         cfg.update({k: data.get(k, v) for k, v in cfg.items()})
     return cfg
@@ -306,14 +414,20 @@ async def _check_required_channels(bot, user_id: int) -> tuple[List[str], List[s
         if not await _bot_is_admin_in_channel(bot, ref):
             not_admin.append(item)
             continue
-        try:
-            member = await bot.get_chat_member(ref, user_id)
-            status = str(getattr(member, "status", "")).lower()
-            if status in {"left", "kicked"}:
-                missing.append(item)
-        except BadRequest:
-            missing.append(item)
-        except Exception:
+        is_member = _MEMBERS.get_member(user_id, ref)
+        if is_member is None:
+            try:
+                member = await bot.get_chat_member(ref, user_id)
+                status = str(getattr(member, "status", "")).lower()
+                is_member = status not in {"left", "kicked"}
+                _MEMBERS.set_member(user_id, ref, is_member)
+            except BadRequest:
+                is_member = False
+                _MEMBERS.set_member(user_id, ref, is_member)
+            except Exception:
+                # خطای گذرا کش نمی‌شود
+                is_member = False
+        if not is_member:
             missing.append(item)
     return missing, not_admin
 
@@ -327,25 +441,121 @@ async def _send_document_with_retry(
     tries: int = 3,
     timeout: int = 240,
 ):
+    if not upload_size_allowed(file_path):
+        logger.warning("send_document_too_large | file=%s cap_mb=%s", file_path.name, CFG.TELEGRAM_UPLOAD_MAX_MB)
+        return None
     for i in range(1, tries + 1):
         try:
-            await bot.send_chat_action(chat_id=chat_id, action="upload_document")
-            with open(file_path, "rb") as f:
-                msg = await bot.send_document(
-                    chat_id,
-                    document=f,
-                    filename=file_path.name,
-                    caption=caption,
-                    read_timeout=timeout,
-                )
+            async with upload_slot(chat_id, file_path):
+                await bot.send_chat_action(chat_id=chat_id, action="upload_document")
+                with document_input(file_path) as doc:
+                    msg = await bot.send_document(
+                        chat_id,
+                        document=doc,
+                        filename=file_path.name,
+                        caption=caption,
+                        read_timeout=timeout,
+                    )
             return msg
-        except Exception:
+        except Exception as e:
+            logger.warning("send_document_retry_%d/%d | err=%s", i, tries, e)
             await asyncio.sleep(2 ** i)
     return None
 
 
-async def _countdown_and_cleanup(
-    bot,
+# گام‌های شمارش معکوس: فقط وقتی زمان باقی‌مانده به این مقادیر می‌رسد پیام ویرایش می‌شود
+COUNTDOWN_STEPS: Tuple[int, ...] = (600, 300, 120, 60, 30, 10, 5)
+
+
+def _countdown_text(remaining: int) -> str:
+    return f"حذف در {remaining} ثانیه..."
+
+
+class _DeletionWheel:
+    """
+    زمان‌بند مرکزی حذف‌ها (timer wheel با شکاف یک‌ثانیه‌ای).
+    به‌جای یک task با ویرایش ثانیه‌ای برای هر فایل، یک tick همهٔ کارهای سررسید را با هم انجام می‌دهد؛
+    شمارش معکوس فقط در COUNTDOWN_STEPS ویرایش می‌شود و حذف‌های معلق در DB می‌مانند
+    تا بعد از ری‌استارت دوباره بارگذاری شوند.
+    """
+
+    def __init__(self) -> None:
+        self._slots: Dict[int, List[Dict[str, Any]]] = {}
+        self._loaded = False
+
+    @staticmethod
+    def _next_edit_at(entry: Dict[str, Any], now: int) -> Optional[int]:
+        if not entry.get("countdown_message_id"):
+            return None
+        remaining = int(entry["due_at"]) - now
+        steps = [s for s in COUNTDOWN_STEPS if s < remaining]
+        return int(entry["due_at"]) - max(steps) if steps else None
+
+    def _place(self, entry: Dict[str, Any], now: int) -> None:
+        at = self._next_edit_at(entry, now) or int(entry["due_at"])
+        self._slots.setdefault(at, []).append(entry)
+
+    def add(self, entry: Dict[str, Any]) -> None:
+        self._place(entry, int(time.time()))
+
+    def pending(self) -> int:
+        return sum(len(v) for v in self._slots.values())
+
+    async def _load(self) -> None:
+        rows = await db_run(db_list_scheduled_deletions)
+        now = int(time.time())
+        known = {e["id"] for slot in self._slots.values() for e in slot}
+        for row in rows:
+            if row["id"] not in known:
+                self._place(row, now)
+        self._loaded = True
+
+    @staticmethod
+    async def _edit(bot, entry: Dict[str, Any], now: int) -> None:
+        with suppress(Exception):
+            await bot.edit_message_text(
+                _countdown_text(int(entry["due_at"]) - now),
+                chat_id=int(entry["chat_id"]),
+                message_id=int(entry["countdown_message_id"]),
+            )
+
+    @staticmethod
+    async def _delete(bot, entry: Dict[str, Any]) -> None:
+        chat_id = int(entry["chat_id"])
+        with suppress(Exception):
+            await bot.delete_message(chat_id=chat_id, message_id=int(entry["message_id"]))
+        if entry.get("countdown_message_id"):
+            with suppress(Exception):
+                await bot.delete_message(chat_id=chat_id, message_id=int(entry["countdown_message_id"]))
+        if entry.get("delete_file") and entry.get("file_path"):
+            with suppress(Exception):
+                Path(str(entry["file_path"])).unlink()
+
+    async def tick(self, bot) -> None:
+        if not self._loaded:
+            await self._load()
+        now = int(time.time())
+        entries: List[Dict[str, Any]] = []
+        for at in [k for k in self._slots if k <= now]:
+            entries.extend(self._slots.pop(at))
+        if not entries:
+            return
+        deletes = [e for e in entries if int(e["due_at"]) <= now]
+        edits = [e for e in entries if int(e["due_at"]) > now]
+        await asyncio.gather(
+            *(self._edit(bot, e, now) for e in edits),
+            *(self._delete(bot, e) for e in deletes),
+        )
+        if deletes:
+            await db_run(db_remove_scheduled_deletions, [int(e["id"]) for e in deletes])
+        for e in edits:
+            self._place(e, now)
+
+
+_DELETIONS = _DeletionWheel()
+
+
+async def _schedule_cleanup(
     chat_id: int,
     doc_message_id: int,
     countdown_message_id: Optional[int],
@@ -353,38 +563,37 @@ async def _countdown_and_cleanup(
     *,
     delay_s: int,
     delete_file: bool,
-):
-    remaining = max(0, int(delay_s))
-    while remaining > 0:
-        if countdown_message_id:
-            try:
-                await bot.edit_message_text(
-                    f"حذف در {remaining} ثانیه...",
-                    chat_id=chat_id,
-                    message_id=countdown_message_id,
-                )
-            except Exception:
-                pass
-        await asyncio.sleep(1)
-        remaining -= 1
+) -> None:
+    due_at = int(time.time()) + max(0, int(delay_s))
+    entry = {
+        "chat_id": int(chat_id),
+        "message_id": int(doc_message_id),
+        "countdown_message_id": countdown_message_id,
+        "file_path": str(file_path),
+        "delete_file": 1 if delete_file else 0,
+        "due_at": due_at,
+    }
+    entry["id"] = await db_run(
+        db_add_scheduled_deletion,
+        chat_id,
+        doc_message_id,
+        countdown_message_id,
+        str(file_path),
+        delete_file=delete_file,
+        due_at=due_at,
+    )
+    _DELETIONS.add(entry)
+
+
+async def _deletion_tick(context: CallbackContext) -> None:
     try:
-        await bot.delete_message(chat_id=chat_id, message_id=doc_message_id)
-    except Exception:
-        pass
-    if countdown_message_id:
-        try:
-            await bot.delete_message(chat_id=chat_id, message_id=countdown_message_id)
-        except Exception:
-            pass
-    if delete_file:
-        try:
-            file_path.unlink()
-        except Exception:
-            pass
+        await _DELETIONS.tick(context.bot)
+    except Exception as exc:
+        logger.warning("deletion_tick_failed | err=%s", exc)
 
 
 async def _deliver_file(update: Update, context: ContextTypes.DEFAULT_TYPE, token: str) -> None:
-    rec = db_get_download_link(token)
+    rec = await db_run(db_get_download_link, token)
     if not rec:
         await update.effective_message.reply_text("این لینک دانلود نامعتبر یا منقضی است.")
         return
@@ -411,6 +620,15 @@ async def _deliver_file(update: Update, context: ContextTypes.DEFAULT_TYPE, toke
         await update.effective_message.reply_text("فایل روی سرور پیدا نشد.")
         return
 
+    if not upload_size_allowed(fpath):
+        # تلاش دوباره فایده ندارد؛ در صورت امکان لینک دانلود مستقیم بده
+        logger.warning("download_file_too_large | file=%s cap_mb=%s", fpath.name, CFG.TELEGRAM_UPLOAD_MAX_MB)
+        text = f"حجم این فایل از سقف ارسال تلگرام ({CFG.TELEGRAM_UPLOAD_MAX_MB}MB) بیشتر است."
+        url = download_http_url(token, int(rec.get("user_id") or 0))
+        text += f"\nدانلود مستقیم: {url}" if url else "\nلطفا با پشتیبانی تماس بگیرید."
+        await update.effective_message.reply_text(text, disable_web_page_preview=True)
+        return
+
     msg = await _send_document_with_retry(
         context.bot,
         update.effective_chat.id,
@@ -423,7 +641,7 @@ async def _deliver_file(update: Update, context: ContextTypes.DEFAULT_TYPE, toke
         await update.effective_message.reply_text("ارسال فایل ناموفق بود. لطفا دوباره تلاش کنید.")
         return
 
-    db_mark_download_link_used(token, used_by=update.effective_user.id if update.effective_user else None)
+    await db_run(db_mark_download_link_used, token, used_by=update.effective_user.id if update.effective_user else None)
 
     delete_after_s = int(cfg.get("delete_after_s") or 0)
     if delete_after_s > 0:
@@ -432,21 +650,18 @@ async def _deliver_file(update: Update, context: ContextTypes.DEFAULT_TYPE, toke
             try:
                 m = await context.bot.send_message(
                     chat_id=update.effective_chat.id,
-                    text=f"حذف در {delete_after_s} ثانیه...",
+                    text=_countdown_text(delete_after_s),
                 )
                 countdown_id = m.message_id
             except Exception:
                 countdown_id = None
-        asyncio.create_task(
-            _countdown_and_cleanup(
-                context.bot,
-                update.effective_chat.id,
-                msg.message_id,
-                countdown_id,
-                fpath,
-                delay_s=delete_after_s,
-                delete_file=bool(cfg.get("delete_file")),
-            )
+        await _schedule_cleanup(
+            update.effective_chat.id,
+            msg.message_id,
+            countdown_id,
+            fpath,
+            delay_s=delete_after_s,
+            delete_file=bool(cfg.get("delete_file")),
         )
 
 
@@ -792,29 +1007,60 @@ async def on_join_check(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     await _deliver_file(update, context, token)
 
 
+async def on_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """آپدیت‌های عضویت: کش عضویت کاربر (chat_member) یا ادمین بودن ربات (my_chat_member) را باطل می‌کند."""
+    cmu = update.chat_member or update.my_chat_member
+    if not cmu or not cmu.chat:
+        return
+    keys = {_channel_key(cmu.chat.id)}
+    if cmu.chat.username:
+        keys.add(_channel_key(f"@{cmu.chat.username}"))
+    if update.my_chat_member:
+        _MEMBERS.invalidate_chat(keys)
+    elif cmu.new_chat_member and cmu.new_chat_member.user:
+        _MEMBERS.invalidate_chat(keys, int(cmu.new_chat_member.user.id))
+
+
 async def _cleanup_job(context: CallbackContext) -> None:
     try:
         db_cleanup_download_links()
     except Exception:
         pass
+    _MEMBERS.prune()
 
 
-def main() -> None:
+ALLOWED_UPDATES: List[str] = ["message", "callback_query", "chat_member", "my_chat_member"]
+
+
+def build_app(*, concurrent_updates: int = 1) -> Application:
     if not CFG.DOWNLOAD_BOT_TOKEN:
         raise RuntimeError("DOWNLOAD_BOT_TOKEN env var is missing")
 
-    db_init()
-    app = Application.builder().token(CFG.DOWNLOAD_BOT_TOKEN).build()
+    updates_processor = chat_serial_update_processor(concurrent_updates) if concurrent_updates > 1 else 1
+    app = configure_bot_api(Application.builder()).token(CFG.DOWNLOAD_BOT_TOKEN).concurrent_updates(updates_processor).build()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("admin", admin_menu))
     app.add_handler(CallbackQueryHandler(on_join_check, pattern=f"^{CB_JOIN_CHECK_PREFIX}"))
     app.add_handler(CallbackQueryHandler(on_admin_callback, pattern="^admin:"))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_admin_input))
+    app.add_handler(ChatMemberHandler(on_chat_member, ChatMemberHandler.ANY_CHAT_MEMBER))
 
     if app.job_queue:
         app.job_queue.run_repeating(_cleanup_job, interval=3600, first=120, name="download_cleanup")
+        app.job_queue.run_repeating(_deletion_tick, interval=1, first=1, name="download_deletions")
+    return app
+
 
-    app.run_polling(allowed_updates=["message", "callback_query"], drop_pending_updates=True)
+def main() -> None:
+    if CFG.WEBHOOK_ENABLED:
+        # در حالت webhook آپدیت‌های این ربات را پردازهٔ ربات اصلی (doi/mainbot.py) سرو می‌کند
+        logger.info("download_bot_exit | reason=webhook_enabled served_by=doi/mainbot.py")
+        return
+    db_init()
+    with startup_phase("build_app"):
+        app = build_app()
+    startup_report("download_bot")
+    app.run_polling(allowed_updates=ALLOWED_UPDATES, drop_pending_updates=True)
 
 
 if __name__ == "__main__":
@@ -33,8 +33,8 @@ from telegram.ext import (
 # زیرساخت، تنظیمات، دیتابیس، پردازش DOI
 from downloadmain import (  # noqa: F401  # type: ignore
     CFG, logger, catlog,
-    db_init, db_upsert_user, db_get_user, db_set_seen_welcome, db_set_email, db_set_delivery,
-    db_set_plan, db_set_plan_period, db_set_doi_quota, db_inc_doi_quota_used,
+    db_init, db_get_user, db_ensure_user, db_set_seen_welcome, db_set_email, db_set_delivery,
+    db_set_plan, db_set_plan_period, PLAN_STATUS_ACTIVE, PLAN_STATUS_EXPIRED, db_set_doi_quota, db_inc_doi_quota_used,
     db_set_doi_daily_quota, db_inc_doi_daily_used,
     db_add_quota, db_count_dois, db_add_dois, db_get_or_create_token, db_set_new_token,
     db_get_setting, db_set_setting,
@@ -43,15 +43,16 @@ from downloadmain import (  # noqa: F401  # type: ignore
     PAYMENT_STATUS_AWAITING, PAYMENT_STATUS_PENDING, PAYMENT_STATUS_APPROVED, PAYMENT_STATUS_REJECTED,
     db_add_wallet_balance,
     normalize_doi,
-    request_email_verification, verify_email_code,
+    request_email_verification, verify_email_code, db_run, flush_pending_writes,
     db_add_quota_by_email, db_get_user_by_email, db_get_quota_status,
     vpn_load_configs, vpn_add_config, vpn_remove_config, vpn_set_active, vpn_ping_all,
     _get_scihub_driver, _build_chrome_driver, _maybe_solve_recaptcha,
-    process_dois_batch, groq_health_check_sync, ensure_v2ray_running, CB_DL_DONE,
+    process_dois_batch, resume_doi_jobs, groq_health_check_sync, ensure_v2ray_running, CB_DL_DONE,
     iranpaper_accounts_ordered, iranpaper_set_active, iranpaper_set_primary, iranpaper_set_vpn,
     set_activation, is_activation_on, iranpaper_vpn_map,
+    _lazy_import, startup_phase, startup_report, warm_chrome_bootstrap,
+    warm_packaging, shutdown_packaging, configure_bot_api, chat_serial_update_processor,
 )
-from downloaders.sciencedirect import warmup_accounts
 from telegram.request import HTTPXRequest
 from doi.ui_email_verification import (
     build_email_verification_conversation,
@@ -77,13 +78,6 @@ try:
 except Exception:  # pragma: no cover - optional local API
     start_api_server = None  # type: ignore
     stop_api_server = None   # type: ignore
-# ↙️ اضافه کنید
-try:
-    from groq import AsyncGroq
-    _HAS_GROQ_LOCAL = True
-except Exception:
-    AsyncGroq = None          # type: ignore
-    _HAS_GROQ_LOCAL = False
 # =========================
 # ثابت‌های UI / CallbackData
 # =========================
@@ -302,10 +296,6 @@ def _plan_is_unlimited(plan_type: str) -> bool:
     return bool(info and info.get("doi_unlimited"))
 
 
-PLAN_STATUS_ACTIVE: Final[str] = "فعال"
-PLAN_STATUS_EXPIRED: Final[str] = "منقضی"
-
-
 def _plan_daily_limit(plan_type: str) -> int:
     info = _plan_info(plan_type)
     return int(info.get("daily_limit") or 0) if info else 0
@@ -534,9 +524,8 @@ def is_admin(update: Update) -> bool:
     return bool(u.username and u.username.lower() == CFG.ADMIN_USERNAME.lower())
 
 
-def ensure_user(user_id: int, username: Optional[str]) -> Dict[str, Any]:
-    db_upsert_user(user_id, username)
-    return db_get_user(user_id)
+async def ensure_user(user_id: int, username: Optional[str]) -> Dict[str, Any]:
+    return await db_run(db_ensure_user, user_id, username)
 
 def _format_price_toman(price: Optional[int]) -> str:
     if not isinstance(price, int) or price <= 0:
@@ -1007,7 +996,7 @@ async def show_admin_menu(update: Update, *, edit=False) -> None:
 # /start  و /help
 # =========================
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = ensure_user(update.effective_user.id, update.effective_user.username)
+    user = await ensure_user(update.effective_user.id, update.effective_user.username)
     logger.info("DBG | user_id=%s username=%s", update.effective_user.id, update.effective_user.username)
 
     first = not bool(user.get("seen_welcome"))
@@ -1058,10 +1047,11 @@ async def _ai_detect_provider(url: str) -> Tuple[str, float]:
     با مدل Groq نام پایگاه را حدس می‌زند.
     خروجی: (label, confidence)
     """
-    if not _HAS_GROQ_LOCAL or not CFG.GROQ_API_KEY:
+    groq = _lazy_import("groq", optional=True) if CFG.GROQ_API_KEY else None
+    if groq is None:
         return "Unknown", 0.0
 
-    client = AsyncGroq(api_key=CFG.GROQ_API_KEY)
+    client = groq.AsyncGroq(api_key=CFG.GROQ_API_KEY)
     system = (
         "You are a classifier. Choose exactly ONE label "
         f"from {PROVIDER_LABELS}. Return STRICT JSON: "
@@ -1471,6 +1461,8 @@ async def on_activation_toggle(update: Update, context: ContextTypes.DEFAULT_TYP
         await q.answer("دانلود فعال شد", show_alert=False)
         # Warmup فوری (در پس‌زمینه و بدون بلاک کردن event loop)
         def _warm_scidir() -> None:
+            from downloaders.sciencedirect import warmup_accounts
+
             try:
                 asyncio.run(
                     warmup_accounts(
@@ -1492,6 +1484,7 @@ async def on_activation_toggle(update: Update, context: ContextTypes.DEFAULT_TYP
                 logger.warning("scihub_warmup_failed | err=%s", exc)
 
         loop = asyncio.get_running_loop()
+        loop.run_in_executor(None, warm_chrome_bootstrap)
         loop.run_in_executor(None, _warm_scidir)
         loop.run_in_executor(None, _warm_scihub)
     elif q.data == "act:off":
@@ -1795,7 +1788,7 @@ async def on_download_link_done(update: Update, context: ContextTypes.DEFAULT_TY
 
 
 async def send_account_view_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    ensure_user(update.effective_user.id, update.effective_user.username)
+    await ensure_user(update.effective_user.id, update.effective_user.username)
     await show_profile_card(update, context, include_delivery=True)
 
 
@@ -1804,7 +1797,7 @@ async def send_account_view_message(update: Update, context: ContextTypes.DEFAUL
 # ---- حساب کاربری و توکن
 async def on_menu_account(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     q = update.callback_query; await q.answer()
-    ensure_user(update.effective_user.id, update.effective_user.username)
+    await ensure_user(update.effective_user.id, update.effective_user.username)
     await show_profile_card(update, context, include_delivery=True)
 
 async def on_account_token(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1827,7 +1820,7 @@ async def on_token_regen(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 # ---- ایمیل
 async def on_account_email_entry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     q = update.callback_query; await q.answer()
-    user = ensure_user(update.effective_user.id, update.effective_user.username)
+    user = await ensure_user(update.effective_user.id, update.effective_user.username)
     cur = user.get("email")
     cur_line = f"ایمیل فعلی: {htmlmod.escape(cur)}" if cur else "ایمیل فعلی: —"
     text = ("✉️ <b>ارسال ایمیل</b>\n"
@@ -1843,8 +1836,8 @@ async def receive_email(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     if not EMAIL_REGEX.match(email):
         await update.message.reply_text("❗️ فرمت ایمیل معتبر نیست. نمونه: user@example.com", reply_markup=back_to_menu_kb())
         return WAITING_FOR_EMAIL
-    user = ensure_user(update.effective_user.id, update.effective_user.username)
-    result = request_email_verification(email, user_id=int(user.get("user_id")))
+    user = await ensure_user(update.effective_user.id, update.effective_user.username)
+    result = await db_run(request_email_verification, email, user_id=int(user.get("user_id")))
     if not result.get("ok"):
         if result.get("error") == "email_in_use":
             await update.message.reply_text(
@@ -1887,7 +1880,7 @@ async def receive_email_code(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return WAITING_FOR_EMAIL
 
-    result = verify_email_code(pending_email, code)
+    result = await db_run(verify_email_code, pending_email, code)
     if not result.get("ok"):
         err = result.get("error")
         if err == "email_in_use":
@@ -1952,13 +1945,13 @@ async def on_account_delivery(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def set_delivery_bot(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     q = update.callback_query; await q.answer("روش ارسال: ربات")
-    user = ensure_user(update.effective_user.id, update.effective_user.username)
+    user = await ensure_user(update.effective_user.id, update.effective_user.username)
     db_set_delivery(user["user_id"], "bot")
     await show_profile_card(update, context, include_delivery=True)
 
 async def set_delivery_email(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     q = update.callback_query; await q.answer("روش ارسال: ایمیل")
-    user = ensure_user(update.effective_user.id, update.effective_user.username)
+    user = await ensure_user(update.effective_user.id, update.effective_user.username)
     db_set_delivery(user["user_id"], "email")
     await show_profile_card(update, context, include_delivery=True)
 
@@ -2054,7 +2047,7 @@ async def on_menu_wallet_topup(update: Update, context: ContextTypes.DEFAULT_TYP
     if not q:
         return ConversationHandler.END
     await q.answer()
-    user = ensure_user(update.effective_user.id, update.effective_user.username)
+    user = await ensure_user(update.effective_user.id, update.effective_user.username)
     balance = int(user.get("wallet_balance") or 0)
     balance_text = f"{balance:,}".replace(",", "٬")
     text = (
@@ -2312,7 +2305,7 @@ async def on_plan_wallet_pay(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 # ---- DOI Conversation
 async def enter_doi_flow(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user = ensure_user(update.effective_user.id, update.effective_user.username)
+    user = await ensure_user(update.effective_user.id, update.effective_user.username)
     q = update.callback_query; await q.answer()
     access = _doi_access_status(user)
     if not access.get("ok"):
@@ -2342,7 +2335,7 @@ async def _update_doi_ctrl(
         logger.warning("ctrl_update_fail: %s", e)
 
 async def receive_doi(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user = ensure_user(update.effective_user.id, update.effective_user.username)
+    user = await ensure_user(update.effective_user.id, update.effective_user.username)
     text = (update.message.text or "").strip()
     found = DOI_REGEX.findall(text)
     if len(found) != 1:
@@ -2393,7 +2386,7 @@ async def receive_doi(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
 
 async def finish_doi(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     q = update.callback_query; await q.answer()
-    user = ensure_user(update.effective_user.id, update.effective_user.username)
+    user = await ensure_user(update.effective_user.id, update.effective_user.username)
     buf: List[str] = context.user_data.get("doi_buffer", [])
     if not buf:
         await q.edit_message_text("هیچ DOI ای ثبت نشده است. لطفاً DOI بفرستید.", reply_markup=doi_control_kb())
@@ -2519,7 +2512,7 @@ async def fallback_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         doi = normalize_doi(found[0])
         if not doi:
             return
-        user = ensure_user(update.effective_user.id, update.effective_user.username)
+        user = await ensure_user(update.effective_user.id, update.effective_user.username)
         access = _doi_access_status(user)
         if not access.get("ok"):
             await update.message.reply_text(_doi_block_message(access), reply_markup=back_to_menu_kb())
@@ -2638,37 +2631,60 @@ def build_app() -> Application:
 
         if start_api_server:
             try:
-                runner = await start_api_server(bot=application.bot)
+                runner = await start_api_server(bot=application.bot, webhooks=application.bot_data.get("webhook_apps"))
                 application.bot_data["api_runner"] = runner
                 if runner:
                     logger.info("api_server_started | host=%s port=%s", CFG.API_HOST, CFG.API_PORT)
             except Exception as exc:
                 logger.warning("api_server_start_failed | err=%s", exc)
 
+        # ادامهٔ کارهای DOI نیمه‌تمام از اجرای قبلی
+        try:
+            await resume_doi_jobs(application.bot)
+        except Exception as exc:
+            logger.warning("jobs_resume_failed | err=%s", exc)
+        try:
+            warm_packaging()
+        except Exception as exc:
+            logger.warning("package_pool_warm_failed | err=%s", exc)
+        startup_report("mainbot")
+
     async def _post_shutdown(application: Application) -> None:
+        try:
+            await flush_pending_writes()
+        except Exception as exc:
+            logger.warning("write_behind_shutdown_flush_failed | err=%s", exc)
         if stop_api_server:
             runner = application.bot_data.get("api_runner")
             try:
                 await stop_api_server(runner)
             except Exception as exc:
                 logger.warning("api_server_stop_failed | err=%s", exc)
+        with contextlib.suppress(Exception):
+            shutdown_packaging()
 
+    # در webhook آپدیت‌های چت‌های مختلف موازی، ولی هر چت ترتیبی (ConversationHandler/doi_buffer)
+    updates_processor = (
+        chat_serial_update_processor(CFG.WEBHOOK_CONCURRENT_UPDATES) if CFG.WEBHOOK_ENABLED else 1
+    )
     try:
         from telegram.ext import AIORateLimiter
         builder = (
-            Application.builder()
+            configure_bot_api(Application.builder())
             .token(CFG.TOKEN)
             .request(req)                  # ←‌ این خط
             .rate_limiter(AIORateLimiter())
+            .concurrent_updates(updates_processor)
             .post_init(_post_init)
             .post_shutdown(_post_shutdown)
         )
     except Exception:
         # اگر AIORateLimiter در دسترس نبود هم request(req) را حفظ کن
         builder = (
-            Application.builder()
+            configure_bot_api(Application.builder())
             .token(CFG.TOKEN)
             .request(req)                  # ←‌ فراموش نشود
+            .concurrent_updates(updates_processor)
             .post_init(_post_init)
             .post_shutdown(_post_shutdown)
         )
@@ -3839,7 +3855,9 @@ async def receive_store_group(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 def main() -> None:
     logger.info("=== Bot starting ===")
-    db_init(); groq_health_check_sync()
+    db_init()
+    with startup_phase("groq_health"):
+        groq_health_check_sync()
 
     global ensure_scinet_session, scinet_monitor_cycle, scinet_complete_active_request
 
@@ -3852,12 +3870,15 @@ def main() -> None:
             scinet_monitor_cycle = None
             scinet_complete_active_request = None
 
-    app = build_app()
+    with startup_phase("build_app"):
+        app = build_app()
 
     async def _scidir_warm(context: CallbackContext) -> None:
         if not is_activation_on():
             return
         def _run() -> None:
+            from downloaders.sciencedirect import warmup_accounts
+
             try:
                 asyncio.run(
                     warmup_accounts(
@@ -3872,6 +3893,12 @@ def main() -> None:
                 logger.warning("scidir_warmup_failed | err=%s", exc)
         asyncio.get_running_loop().run_in_executor(None, _run)
 
+    async def _chrome_bootstrap_warm(context: CallbackContext) -> None:
+        # chromedriver کش‌شده + template پروفایل گرم، قبل از اولین ساخت درایور
+        if not is_activation_on():
+            return
+        asyncio.get_running_loop().run_in_executor(None, warm_chrome_bootstrap)
+
     async def _scihub_warm(context: CallbackContext) -> None:
         if not is_activation_on():
             return
@@ -3897,18 +3924,94 @@ def main() -> None:
         except Exception as exc:
             logger.warning("scinet_monitor_schedule_failed | err=%s", exc)
 
+    async def _resume_jobs_tick(context: CallbackContext) -> None:
+        # lease پردازهٔ مرده بعد از ری‌استارت سریع هنوز معتبر است؛ بعد از انقضا دوباره اسکن کن
+        try:
+            await resume_doi_jobs(context.bot)
+        except Exception as exc:
+            logger.warning("jobs_resume_failed | err=%s", exc)
+
+    try:
+        if app.job_queue:
+            lease_s = max(30, int(CFG.JOB_LEASE_S))
+            app.job_queue.run_repeating(_resume_jobs_tick, interval=lease_s, first=lease_s, name="jobs_resume")
+    except Exception as exc:
+        logger.warning("jobs_resume_schedule_failed | err=%s", exc)
+
     try:
         delay = random.uniform(30, 60)
         if app.job_queue:
+            app.job_queue.run_repeating(_chrome_bootstrap_warm, interval=3600, first=5, name="chrome_bootstrap")
             app.job_queue.run_once(_scidir_warm, when=delay, name="scidir_warmup")
             app.job_queue.run_once(_scihub_warm, when=delay, name="scihub_warmup")
     except Exception as exc:
         logger.warning("warmup_schedule_failed | err=%s", exc)
 
+    if CFG.WEBHOOK_ENABLED:
+        asyncio.run(_run_webhook(app))
+        return
+
     app.run_polling(
-        allowed_updates=["message", "callback_query", "my_chat_member"],
+        allowed_updates=MAIN_ALLOWED_UPDATES,
         drop_pending_updates=True
     )
 
+
+MAIN_ALLOWED_UPDATES: Final[List[str]] = ["message", "callback_query", "my_chat_member"]
+
+
+async def _run_webhook(app: Application) -> None:
+    """
+    حالت webhook: ربات اصلی و ربات دانلود روی همان سرور aiohttp (api_server) آپدیت می‌گیرند.
+    Caddy همهٔ مسیرها را به bot:8787 می‌فرستد؛ مسیرها {WEBHOOK_PATH_PREFIX}/main و /download هستند.
+    """
+    import signal
+    from api_server import webhook_secret, webhook_url
+
+    if not CFG.WEBHOOK_BASE_URL:
+        raise RuntimeError("WEBHOOK_BASE_URL env var is missing (e.g. https://bot.example.com)")
+
+    apps: Dict[str, Tuple[Application, List[str]]] = {"main": (app, MAIN_ALLOWED_UPDATES)}
+    if CFG.DOWNLOAD_BOT_TOKEN:
+        from doi.download_bot import ALLOWED_UPDATES as DL_ALLOWED_UPDATES, build_app as build_download_app
+        apps["download"] = (build_download_app(concurrent_updates=CFG.WEBHOOK_CONCURRENT_UPDATES), DL_ALLOWED_UPDATES)
+    # _post_init ربات اصلی سرور API را با این مسیرها بالا می‌آورد
+    app.bot_data["webhook_apps"] = {name: a for name, (a, _allowed) in apps.items()}
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+
+    started: List[Application] = []
+    try:
+        for name, (application, allowed) in apps.items():
+            await application.initialize()
+            if application.post_init:
+                await application.post_init(application)
+            await application.start()
+            started.append(application)
+            await application.bot.set_webhook(
+                url=webhook_url(name),
+                secret_token=webhook_secret(name),
+                allowed_updates=allowed,
+                drop_pending_updates=True,
+                max_connections=CFG.WEBHOOK_MAX_CONNECTIONS,
+            )
+            logger.info("webhook_set | bot=%s url=%s", name, webhook_url(name))
+        await stop.wait()
+    finally:
+        for application in reversed(started):
+            with contextlib.suppress(Exception):
+                await application.stop()
+        for application, _allowed in reversed(list(apps.values())):
+            with contextlib.suppress(Exception):
+                await application.shutdown()
+            if application.post_shutdown:
+                with contextlib.suppress(Exception):
+                    await application.post_shutdown(application)
+
+
 if __name__ == "__main__":
     main()
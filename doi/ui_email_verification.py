@@ -18,7 +18,7 @@ from telegram.ext import (
     filters,
 )
 
-from downloadmain import db_get_user
+from downloadmain import db_get_user, db_run
 from downloadmain import request_email_verification as _request_email_verification
 from downloadmain import verify_email_code as _verify_email_code
 
@@ -308,7 +308,7 @@ async def show_profile_card(
     *,
     include_delivery: bool = False,
 ) -> None:
-    status = get_user_status(update.effective_user.id)
+    status = await db_run(get_user_status, update.effective_user.id)
     text = _profile_card(status)
     kb = build_menu_keyboard(status, include_delivery=include_delivery)
     await _edit_or_send(update, context, text, kb)
@@ -317,7 +317,7 @@ async def show_profile_card(
 async def on_email_verify(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if update.callback_query:
         await update.callback_query.answer()
-    status = get_user_status(update.effective_user.id)
+    status = await db_run(get_user_status, update.effective_user.id)
     text = _email_entry_card(status.get("email"))
     kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ بازگشت", callback_data=CB_EMAIL_BACK)]])
     _set_ui_active(context, True)
@@ -352,7 +352,7 @@ async def receive_email(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         await _send_new(update, context, text, kb)
         return WAITING_EMAIL
 
-    res = request_email_verification(update.effective_user.id, email)
+    res = await db_run(request_email_verification, update.effective_user.id, email)
     if not res.get("ok"):
         if res.get("error") == "email_in_use":
             text = _result_card(False, "این ایمیل قبلاً تایید شده و برای حساب دیگری استفاده می‌شود.")
@@ -388,7 +388,7 @@ async def on_email_resend(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     email = (context.user_data.get("pending_email") or "").strip()
     if not email:
         return await on_email_verify(update, context)
-    res = request_email_verification(update.effective_user.id, email)
+    res = await db_run(request_email_verification, update.effective_user.id, email)
     if not res.get("ok") and res.get("error") != "rate_limited":
         text = _result_card(False, "ارسال مجدد با خطا مواجه شد. لطفاً دوباره تلاش کنید.")
         kb = build_verify_keyboard(cooldown=_cooldown_seconds(res))
@@ -415,7 +415,7 @@ async def receive_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         await _send_new(update, context, text, kb)
         return WAITING_CODE
 
-    res = verify_email_code(update.effective_user.id, email, code)
+    res = await db_run(verify_email_code, update.effective_user.id, email, code)
     if res.get("ok"):
         context.user_data.pop("pending_email", None)
         _set_ui_active(context, False)
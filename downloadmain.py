@@ -18,6 +18,7 @@ import json
 import time
 import random
 import asyncio
+import atexit
 import logging
 import sqlite3
 import secrets
@@ -28,12 +29,17 @@ import html as htmlmod
 import base64
 import hashlib
 import hmac
+import functools
+import copy
+import importlib
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from urllib.parse import quote_plus, unquote, urljoin, urlparse
 from logging.handlers import RotatingFileHandler
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Final, Dict, Any, List, Tuple, Optional, TYPE_CHECKING
+from typing import Final, Callable, Dict, Any, List, Tuple, Optional, TYPE_CHECKING
 
 try:
     import pymysql  # type: ignore
@@ -43,46 +49,80 @@ except Exception:
     pymysql = None  # type: ignore
     DictCursor = None  # type: ignore
     _HAS_PYMYSQL = False
-from selenium import webdriver   # لازم برای Type Hint و استفاده در جاهای مختلف
+from contextlib import suppress, contextmanager, asynccontextmanager
 
-import requests
-from contextlib import suppress, contextmanager
-
-try:
-    import resend  # type: ignore
-    _HAS_RESEND = True
-except Exception:
-    resend = None  # type: ignore
-    _HAS_RESEND = False
-
-try:
-    import undetected_chromedriver as uc
-    _HAS_UC = True
-except Exception:
-    uc = None  # type: ignore
-    _HAS_UC = False
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.chrome.service import Service
-from selenium.common.exceptions import TimeoutException
-from webdriver_manager.chrome import ChromeDriverManager
+# ماژول‌های سنگین (Selenium/undetected_chromedriver/webdriver_manager/reportlab/groq/2captcha/requests)
+# دیگر در زمان import بارگذاری نمی‌شوند؛ فقط مسیرهایی که واقعاً مرورگر، PDF یا LLM لازم دارند آن‌ها را
+# با _lazy_import یا import محلی می‌آورند. ربات دانلود و API server این هزینه را نمی‌پردازند.
 from v2ray_helper import ensure_v2ray_running
-from downloaders.sciencedirect import download_via_sciencedirect as scidir_download, warmup_accounts
-from utils.zip_report import build_zip_with_summary
 
 if TYPE_CHECKING:
+    import requests
+    from selenium import webdriver
     from twocaptcha import TwoCaptcha as _TwoCaptchaType
 else:
     _TwoCaptchaType = Any  # type: ignore[misc]
 
-try:
-    from twocaptcha import TwoCaptcha  # type: ignore[import]
-    _HAS_TWOCAPTCHA = True
-except Exception:
-    TwoCaptcha = None  # type: ignore
-    _HAS_TWOCAPTCHA = False
+_STARTUP_T0 = time.perf_counter()
+_STARTUP_TIMINGS: Dict[str, float] = {}
+_LAZY_MODULES: Dict[str, Any] = {}
+_HEAVY_MODULES: Final[Tuple[str, ...]] = (
+    "selenium", "undetected_chromedriver", "webdriver_manager", "reportlab", "groq", "twocaptcha", "requests",
+)
+
+
+def _record_timing(name: str, t0: float) -> None:
+    _STARTUP_TIMINGS[name] = round((time.perf_counter() - t0) * 1000, 1)
+
+
+def _lazy_import(name: str, *, optional: bool = False) -> Any:
+    """ماژول را در اولین استفاده import می‌کند و زمانش را ثبت می‌کند؛ optional در نبودِ پکیج None برمی‌گرداند."""
+    if name in _LAZY_MODULES:
+        return _LAZY_MODULES[name]
+    t0 = time.perf_counter()
+    try:
+        mod = importlib.import_module(name)
+    except Exception:
+        if not optional:
+            raise
+        mod = None
+    _LAZY_MODULES[name] = mod
+    _record_timing(f"import:{name}", t0)
+    return mod
+
+
+def _has_module(name: str) -> bool:
+    return _lazy_import(name, optional=True) is not None
+
+
+@contextmanager
+def startup_phase(name: str):
+    """زمانِ یک مرحلهٔ راه‌اندازی را برای startup_report ثبت می‌کند."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record_timing(name, t0)
+
+
+def startup_report(component: str = "app") -> Dict[str, Any]:
+    """گزارش زمان‌بندی راه‌اندازی: مراحل ثبت‌شده، کل زمان، و ماژول‌های سنگینی که تا این لحظه بارگذاری شده‌اند."""
+    heavy = [m for m in _HEAVY_MODULES if m in sys.modules]
+    report = {
+        "component": component,
+        "total_ms": round((time.perf_counter() - _STARTUP_T0) * 1000, 1),
+        "phases": dict(_STARTUP_TIMINGS),
+        "heavy_loaded": heavy,
+    }
+    logger.info(
+        "startup_timing | component=%s total_ms=%.1f phases=%s heavy_loaded=%s",
+        component,
+        report["total_ms"],
+        " ".join(f"{k}={v}" for k, v in report["phases"].items()),
+        ",".join(heavy) or "-",
+    )
+    return report
+
 
 logger = logging.getLogger(__name__)
 # --- ParseMode اختیاری (برای HTML). اگر در محیط موجود نبود، بدون parse_mode ارسال می‌کنیم.
@@ -93,13 +133,7 @@ except Exception:
     PARSE_HTML = None  # type: ignore
 
 # ---- Groq SDK (async) ----
-try:
-    from groq import AsyncGroq, Groq  # Groq برای health-check سنک
-    _HAS_GROQ = True
-except Exception:
-    AsyncGroq = None  # type: ignore
-    Groq = None       # type: ignore
-    _HAS_GROQ = False
+# AsyncGroq/Groq از ماژول groq به‌صورت تنبل گرفته می‌شوند (Groq برای health-check سنک)
 
 import aiohttp
 
@@ -108,6 +142,9 @@ import aiohttp
 
 
 def make_driver(headless=True):
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+
     options = Options()
     if headless:
         options.add_argument("--headless=new")
@@ -115,17 +152,27 @@ def make_driver(headless=True):
     options.add_argument("--no-sandbox")
     options.add_argument("--disable-dev-shm-usage")
 
-    if _HAS_UC:
+    uc = _lazy_import("undetected_chromedriver", optional=True)
+    if uc is not None:
         return uc.Chrome(options=options)
     return webdriver.Chrome(options=options)
 
 # =========================
 # تنظیمات
 # =========================
+# Bot API محلی (telegram-bot-api --local): با آن فایل‌ها با مسیر روی دیسک ارسال می‌شوند و سقف آپلود ۲ گیگابایت است
+_BOT_API_URL = os.environ.get("TELEGRAM_BOT_API_URL", "").strip().rstrip("/")
+_BOT_API_LOCAL = bool(_BOT_API_URL) and os.environ.get("TELEGRAM_BOT_API_LOCAL", "1").lower() not in {"0", "false", "no"}
+
+
 @dataclass(frozen=True)
 class Config:
     TOKEN: str = os.environ.get("TELEGRAM_BOT_TOKEN", "")
     DOWNLOAD_BOT_TOKEN: str = os.environ.get("DOWNLOAD_BOT_TOKEN", "")
+    # مثلاً http://127.0.0.1:8081 ؛ خالی یعنی api.telegram.org
+    TELEGRAM_BOT_API_URL: str = _BOT_API_URL
+    TELEGRAM_BOT_API_FILE_URL: str = os.environ.get("TELEGRAM_BOT_API_FILE_URL", "").strip().rstrip("/")
+    TELEGRAM_BOT_API_LOCAL: bool = _BOT_API_LOCAL
 
     LOG_DIR: Path = Path("run_logs")
     LOG_FILE: Path = Path("run_logs/bot.log")
@@ -136,6 +183,9 @@ class Config:
     DEBUG: bool = True
     DEBUG_LOG_FILE: Path = Path("run_logs/debug.log")
     LOG_CONCEPT_ROWS: bool = True
+    # نرخ نمونه‌برداری لاگ JSON کامل دسته‌بندی (0..1)
+    CATEGORY_LOG_SAMPLE: float = float(os.environ.get("CATEGORY_LOG_SAMPLE", "0.1"))
+    CATEGORY_INDEX_FILE: Path = Path("data/concept_category_index.json")
 
     ZARINPAL_URL: str = "https://zarinp.al/mam"
     ADMIN_USERNAME: str = "H_koosha"
@@ -153,6 +203,36 @@ class Config:
     DB_PASSWORD: str = os.environ.get("DB_PASSWORD", "")
     DB_CONNECT_RETRIES: int = int(os.environ.get("DB_CONNECT_RETRIES", "15"))
     DB_CONNECT_WAIT_S: float = float(os.environ.get("DB_CONNECT_WAIT_S", "2"))
+    DB_POOL_SIZE: int = int(os.environ.get("DB_POOL_SIZE", "8"))
+    DB_POOL_PING_IDLE_S: float = float(os.environ.get("DB_POOL_PING_IDLE_S", "30"))
+    DB_POOL_TIMEOUT_S: float = float(os.environ.get("DB_POOL_TIMEOUT_S", "30"))
+    # write-behind برای doi_meta و مصرف سهمیه
+    DB_WRITE_BATCH_ROWS: int = int(os.environ.get("DB_WRITE_BATCH_ROWS", "50"))
+    DB_WRITE_FLUSH_MS: int = int(os.environ.get("DB_WRITE_FLUSH_MS", "500"))
+    # فاصلهٔ بررسی ردیف نسخهٔ settings (ثانیه)؛ 0 یعنی هر بار
+    SETTINGS_CACHE_CHECK_S: float = float(os.environ.get("SETTINGS_CACHE_CHECK_S", "2"))
+    # TTL کش رکورد کاربر در ensure_user (ثانیه)؛ 0 یعنی بدون کش
+    USER_CACHE_TTL_S: float = float(os.environ.get("USER_CACHE_TTL_S", "30"))
+    # صف پایدار DOIها: مدت lease هر کار (ثانیه)؛ پس از انقضا کار دیگری آن را ادامه می‌دهد
+    JOB_LEASE_S: int = int(os.environ.get("JOB_LEASE_S", "120"))
+    # کاری که بیش از این تعداد بار claim شده (مثلاً هر بار پردازه را می‌کشد) یا از این قدیمی‌تر است resume نمی‌شود
+    JOB_MAX_ATTEMPTS: int = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+    JOB_MAX_AGE_S: int = int(os.environ.get("JOB_MAX_AGE_S", str(6 * 3600)))
+    # زمان‌بند سراسری: سقف هم‌زمانی هر مرحله در کل پردازه و وزن lane پریمیوم
+    SCHED_METADATA_SLOTS: int = int(os.environ.get("SCHED_METADATA_SLOTS", "8"))
+    SCHED_DOWNLOAD_SLOTS: int = int(os.environ.get("SCHED_DOWNLOAD_SLOTS", "3"))
+    SCHED_PACKAGE_SLOTS: int = int(os.environ.get("SCHED_PACKAGE_SLOTS", "2"))
+    PACKAGE_WORKERS: int = int(os.environ.get("PACKAGE_WORKERS", "2"))
+    # سقف send_document در Bot API عمومی ۵۰ مگابایت و در Bot API محلی ۲۰۰۰ مگابایت است؛ جلدها کمی کوچک‌تر ساخته می‌شوند
+    TELEGRAM_UPLOAD_MAX_MB: int = int(os.environ.get("TELEGRAM_UPLOAD_MAX_MB", "2000" if _BOT_API_LOCAL else "50"))
+    ZIP_VOLUME_MAX_MB: int = int(os.environ.get("ZIP_VOLUME_MAX_MB", "1990" if _BOT_API_LOCAL else "48"))
+    SCHED_PREMIUM_WEIGHT: int = int(os.environ.get("SCHED_PREMIUM_WEIGHT", "3"))
+    # حداقل فاصلهٔ ویرایش پیام پیشرفت در هر چت (ثانیه)
+    PROGRESS_EDIT_INTERVAL_S: float = float(os.environ.get("PROGRESS_EDIT_INTERVAL_S", "5"))
+    # آپلود فایل به تلگرام: سقف آپلود هم‌زمان کل پردازه و سقف هر چت (UPLOAD_PER_CHAT، مثلاً جلدهای یک ZIP)
+    UPLOAD_GLOBAL_CAP: int = int(os.environ.get("UPLOAD_GLOBAL_CAP", "4"))
+    UPLOAD_MAX_WAIT_S: float = float(os.environ.get("UPLOAD_MAX_WAIT_S", "120"))
+    UPLOAD_PER_CHAT: int = int(os.environ.get("UPLOAD_PER_CHAT", "2"))
     TWOCAPTCHA_API_KEY: str = os.environ.get("TWOCAPTCHA_API_KEY", "")
 
     USER_TOKEN_LEN: int = 12  # طول توکن افزونه
@@ -188,6 +268,13 @@ class Config:
     DOWNLOAD_DELETE_DELAY_S: int = int(os.environ.get("DOWNLOAD_DELETE_DELAY_S", "60"))
     DOWNLOAD_COUNTDOWN_ENABLED: bool = os.environ.get("DOWNLOAD_COUNTDOWN_ENABLED", "1").lower() not in {"0", "false", "no"}
     DOWNLOAD_CHANNELS_ENFORCED: bool = os.environ.get("DOWNLOAD_CHANNELS_ENFORCED", "1").lower() not in {"0", "false", "no"}
+    DOWNLOAD_MEMBER_CACHE_TTL_S: int = int(os.environ.get("DOWNLOAD_MEMBER_CACHE_TTL_S", "300"))
+    DOWNLOAD_MEMBER_NEG_TTL_S: int = int(os.environ.get("DOWNLOAD_MEMBER_NEG_TTL_S", "15"))
+    DOWNLOAD_ADMIN_CACHE_TTL_S: int = int(os.environ.get("DOWNLOAD_ADMIN_CACHE_TTL_S", "600"))
+    # دانلود مستقیم HTTP (GET /d/{token} روی api_server)؛ آدرس عمومی همان سرور، خالی یعنی فقط ربات دانلود
+    DOWNLOAD_HTTP_BASE_URL: str = os.environ.get("DOWNLOAD_HTTP_BASE_URL", "").strip().rstrip("/")
+    # کلید امضای لینک‌ها؛ باید بین اجراها ثابت بماند (خالی → مشتق از توکن ربات)
+    DOWNLOAD_HTTP_SECRET: str = os.environ.get("DOWNLOAD_HTTP_SECRET", "").strip()
 
     # Providerهای قانونی (JSON string)
     LEGAL_PRE2022: str = os.environ.get("LEGAL_PRE2022", """
@@ -233,6 +320,8 @@ class Config:
     SCINET_USERNAME: str = os.environ.get("SCINET_USERNAME", "")
     SCINET_PASSWORD: str = os.environ.get("SCINET_PASSWORD", "")
     SECRET_KEY: str = os.environ.get("SECRET_KEY", "")
+    # اعتبار توکن نشست API (افزونه) پس از login با ایمیل+کد (ساعت)
+    API_SESSION_TTL_H: int = int(os.environ.get("API_SESSION_TTL_H", "168"))
     RESEND_API_KEY: str = os.environ.get("RESEND_API_KEY", "")
     FROM_EMAIL: str = os.environ.get("FROM_EMAIL", "")
 
@@ -241,6 +330,11 @@ class Config:
     CHROME_PROFILE_DIR: str = os.environ.get("CHROME_PROFILE_DIR", "")  # ← اضافه
     USE_UNDETECTED: bool = os.environ.get("CHROME_USE_UC", "1").lower() in {"1","true","yes"}  # ← اضافه
     CHROMEDRIVER_PATH: str = os.environ.get("CHROMEDRIVER_PATH", "")
+    CHROME_DRIVER_CACHE_DIR: Path = Path(os.environ.get("CHROME_DRIVER_CACHE_DIR", "data/chrome/drivers"))
+    CHROME_PROFILE_TEMPLATES: bool = os.environ.get("CHROME_PROFILE_TEMPLATES", "1").lower() not in {"0", "false", "no"}
+    CHROME_PROFILE_ROOT: Path = Path(os.environ.get("CHROME_PROFILE_ROOT", "data/chrome/profiles"))
+    CHROME_PROFILE_TEMPLATE_MAX_AGE_H: int = int(os.environ.get("CHROME_PROFILE_TEMPLATE_MAX_AGE_H", "24"))
+    CHROME_WARM_URLS: str = os.environ.get("CHROME_WARM_URLS", "https://www.sciencedirect.com/,https://www.sci-hub.ee/")
     SCINET_GROUP_CHAT_ID: int = int(os.environ.get("SCINET_GROUP_CHAT_ID", "-4841805049"))
     PAYMENT_GROUP_CHAT_ID: int = int(os.environ.get("PAYMENT_GROUP_CHAT_ID") or os.environ.get("SCINET_GROUP_CHAT_ID", "0") or 0)
     STORE_CARD_NUMBER: str = os.environ.get("STORE_CARD_NUMBER", "")
@@ -253,6 +347,25 @@ class Config:
     API_PORT: int = int(os.environ.get("API_PORT", "8787"))
     API_RATE_WINDOW_S: int = int(os.environ.get("API_RATE_WINDOW_S", "60"))
     API_RATE_MAX_HITS: int = int(os.environ.get("API_RATE_MAX_HITS", "60"))
+    # سطل‌های جدا برای هر کاربر (ایمیل) و مسیرهای حساس؛ همه در همان پنجرهٔ API_RATE_WINDOW_S
+    API_RATE_USER_MAX_HITS: int = int(os.environ.get("API_RATE_USER_MAX_HITS", "30"))
+    API_RATE_LOGIN_MAX_HITS: int = int(os.environ.get("API_RATE_LOGIN_MAX_HITS", "10"))
+    API_RATE_SUBMIT_MAX_HITS: int = int(os.environ.get("API_RATE_SUBMIT_MAX_HITS", "20"))
+    API_RATE_MAX_KEYS: int = int(os.environ.get("API_RATE_MAX_KEYS", "50000"))
+    # doi_info: کش مشترک نتیجه (ثانیه؛ یافت‌نشده‌ها کوتاه‌تر) و سقف DOI در هر درخواست batch
+    API_DOI_INFO_TTL_S: int = int(os.environ.get("API_DOI_INFO_TTL_S", "21600"))
+    API_DOI_INFO_NEG_TTL_S: int = int(os.environ.get("API_DOI_INFO_NEG_TTL_S", "600"))
+    API_DOI_INFO_CACHE_MAX: int = int(os.environ.get("API_DOI_INFO_CACHE_MAX", "20000"))
+    API_DOI_INFO_BATCH_MAX: int = int(os.environ.get("API_DOI_INFO_BATCH_MAX", "100"))
+
+    # Webhook: هر دو ربات روی همان سرور aiohttp بالا (پشت Caddy) آپدیت می‌گیرند
+    WEBHOOK_ENABLED: bool = os.environ.get("WEBHOOK_ENABLED", "0").strip().lower() in {"1", "true", "yes"}
+    WEBHOOK_BASE_URL: str = os.environ.get("WEBHOOK_BASE_URL", "").strip().rstrip("/")   # مثل https://bot.example.com
+    WEBHOOK_PATH_PREFIX: str = "/" + os.environ.get("WEBHOOK_PATH_PREFIX", "tg").strip().strip("/")
+    # خالی → در هر اجرا تصادفی (setWebhook هر بار دوباره ثبت می‌شود)
+    WEBHOOK_SECRET: str = os.environ.get("WEBHOOK_SECRET", "").strip() or secrets.token_urlsafe(32)
+    WEBHOOK_MAX_CONNECTIONS: int = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+    WEBHOOK_CONCURRENT_UPDATES: int = int(os.environ.get("WEBHOOK_CONCURRENT_UPDATES", "8"))
 CFG = Config()
 _TWOCAPTCHA_KEY = (CFG.TWOCAPTCHA_API_KEY or "").strip()
 
@@ -321,7 +434,8 @@ def _verify_otp_code(code: str, stored: str, secret: bytes) -> bool:
 
 
 def _send_otp_email(to_email: str, code: str) -> None:
-    if not _HAS_RESEND:
+    resend = _lazy_import("resend", optional=True)
+    if resend is None:
         raise RuntimeError("Resend package is not installed")
     if not CFG.RESEND_API_KEY or not CFG.FROM_EMAIL:
         raise RuntimeError("Missing RESEND_API_KEY or FROM_EMAIL")
@@ -342,7 +456,8 @@ def _send_otp_email(to_email: str, code: str) -> None:
 
 def _db_get_latest_otp(email: str) -> Dict[str, Any]:
     cur = _db_execute(
-        "SELECT * FROM email_otps WHERE lower(email)=? ORDER BY id DESC LIMIT 1",
+        # ایمیل هنگام درج lower می‌شود؛ مقایسهٔ مستقیم از idx_email_otps_email استفاده می‌کند
+        "SELECT * FROM email_otps WHERE email=? ORDER BY id DESC LIMIT 1",
         (email.lower(),),
     )
     row = cur.fetchone()
@@ -618,6 +733,52 @@ def verify_email_code(email: str, code: str) -> Dict[str, Any]:
     return {"ok": True, "user_id": user_id or None}
 
 
+# --- توکن نشست API: امضای HMAC با SECRET_KEY، بدون حالت در DB
+def _api_session_key() -> Optional[bytes]:
+    secret = _otp_secret()
+    return hashlib.sha256(b"api-session:" + secret).digest() if secret else None
+
+
+def _b64url(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def issue_api_session(user_id: int, email: str, *, ttl_s: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """توکن امضاشدهٔ «payload.sig» برای کاربر؛ اگر SECRET_KEY تنظیم نشده باشد None."""
+    key = _api_session_key()
+    if not key:
+        return None
+    exp = int(time.time()) + int(ttl_s if ttl_s is not None else max(1, CFG.API_SESSION_TTL_H) * 3600)
+    payload = _b64url(json.dumps({"u": int(user_id), "e": (email or "").strip().lower(), "exp": exp},
+                                 separators=(",", ":")).encode("utf-8"))
+    sig = _b64url(hmac.new(key, payload.encode("ascii"), hashlib.sha256).digest())
+    return {"token": f"{payload}.{sig}", "expires_at": exp}
+
+
+def verify_api_session(token: str) -> Dict[str, Any]:
+    """بررسی بدون DB: {"ok": True, "user_id", "email", "expires_at"} یا {"ok": False, "error"}."""
+    key = _api_session_key()
+    payload, _, sig = (token or "").strip().partition(".")
+    if not key or not payload or not sig:
+        return {"ok": False, "error": "invalid_session"}
+    try:
+        # مقایسهٔ بایتی: compare_digest روی str غیر ASCII خطای TypeError می‌دهد (و هر POST با Bearer خراب 500 می‌شد)
+        payload_b, sig_b = payload.encode("ascii"), sig.encode("ascii")
+    except UnicodeEncodeError:
+        return {"ok": False, "error": "invalid_session"}
+    expected = _b64url(hmac.new(key, payload_b, hashlib.sha256).digest()).encode("ascii")
+    if not hmac.compare_digest(sig_b, expected):
+        return {"ok": False, "error": "invalid_session"}
+    try:
+        data = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        user_id, exp = int(data["u"]), int(data["exp"])
+    except Exception:
+        return {"ok": False, "error": "invalid_session"}
+    if exp < time.time():
+        return {"ok": False, "error": "session_expired"}
+    return {"ok": True, "user_id": user_id, "email": data.get("e") or "", "expires_at": exp}
+
+
 def set_activation(flag: bool) -> None:
     db_set_setting(ACTIVATION_KEY, "1" if flag else "0")
 
@@ -640,25 +801,33 @@ def _driver_alive(driver: Optional[webdriver.Chrome]) -> bool:
 def _get_twocaptcha_session() -> requests.Session:
     sess = getattr(_twocaptcha_tls, "session", None)
     if sess is None:
-        sess = requests.Session()
+        sess = _lazy_import("requests").Session()
         _twocaptcha_tls.session = sess
     return sess
 
 
 solver: Optional[_TwoCaptchaType] = None
-_HAS_TWOCAPTCHA = bool(_TWOCAPTCHA_KEY and TwoCaptcha)
-if _HAS_TWOCAPTCHA and TwoCaptcha:
-    try:
-        solver = TwoCaptcha(_TWOCAPTCHA_KEY)
-    except Exception as exc:
-        logger.warning("twocaptcha_init_failed | err=%s", exc)
-        solver = None
-        _HAS_TWOCAPTCHA = False
+_TWOCAPTCHA_CHECKED = False
+
+
+def _twocaptcha_enabled() -> bool:
+    """solver در اولین نیاز ساخته می‌شود، نه در زمان import."""
+    global solver, _TWOCAPTCHA_CHECKED
+    if not _TWOCAPTCHA_CHECKED:
+        _TWOCAPTCHA_CHECKED = True
+        mod = _lazy_import("twocaptcha", optional=True) if _TWOCAPTCHA_KEY else None
+        if mod is not None:
+            try:
+                solver = mod.TwoCaptcha(_TWOCAPTCHA_KEY)
+            except Exception as exc:
+                logger.warning("twocaptcha_init_failed | err=%s", exc)
+                solver = None
+    return solver is not None
 
 
 def test_twocaptcha(sitekey: str, url: str) -> None:
     """تست ساده برای حل کپچای reCAPTCHA با 2Captcha."""
-    if not _HAS_TWOCAPTCHA:
+    if not _twocaptcha_enabled():
         print("TwoCaptcha is not configured.")
         return
     try:
@@ -676,7 +845,7 @@ def _extract_recaptcha_sitekey(driver: webdriver.Chrome) -> Optional[str]:
     ]
     for sel in selectors:
         try:
-            element = driver.find_element(By.CSS_SELECTOR, sel)
+            element = driver.find_element("css selector", sel)
         except Exception:
             continue
         if element:
@@ -787,7 +956,7 @@ def _solve_recaptcha_with_retry(sitekey: str, page_url: str, *, max_runs: int =
 
 
 def _maybe_solve_recaptcha(driver: webdriver.Chrome, page_url: str) -> bool:
-    if not _HAS_TWOCAPTCHA:
+    if not _twocaptcha_enabled():
         return False
     try:
         sitekey = _extract_recaptcha_sitekey(driver)
@@ -826,8 +995,6 @@ def _maybe_solve_recaptcha(driver: webdriver.Chrome, page_url: str) -> bool:
 logger = logging.getLogger("doi_bot")
 logger.setLevel(logging.DEBUG if CFG.DEBUG else logging.INFO)
 
-CFG.LOG_DIR.mkdir(parents=True, exist_ok=True)
-
 _fmt = logging.Formatter("%(asctime)s | %(levelname)s | %(name)s | %(message)s", "%Y-%m-%d %H:%M:%S")
 
 # کنسول: فقط INFO+
@@ -836,33 +1003,54 @@ _console.setLevel(logging.INFO)
 _console.setFormatter(_fmt)
 logger.addHandler(_console)
 
-# فایل اصلی: INFO+
-_file = RotatingFileHandler(CFG.LOG_FILE, maxBytes=CFG.LOG_MAX_BYTES, backupCount=CFG.LOG_BACKUP_COUNT, encoding="utf-8")
-_file.setLevel(logging.INFO)
-_file.setFormatter(_fmt)
-logger.addHandler(_file)
-
-# فایل دیباگ: DEBUG
-if CFG.DEBUG:
-    _dbg = RotatingFileHandler(CFG.DEBUG_LOG_FILE, maxBytes=CFG.LOG_MAX_BYTES, backupCount=CFG.LOG_BACKUP_COUNT, encoding="utf-8")
-    _dbg.setLevel(logging.DEBUG)
-    _dbg.setFormatter(_fmt)
-    logger.addHandler(_dbg)
-
 # Logger مخصوصِ تشخیص دسته‌بندی
 catlog = logging.getLogger("doi_bot.category")
 catlog.setLevel(logging.DEBUG if CFG.DEBUG else logging.INFO)
-_cat_file = RotatingFileHandler(CFG.CATEGORY_LOG_FILE, maxBytes=CFG.LOG_MAX_BYTES, backupCount=CFG.LOG_BACKUP_COUNT, encoding="utf-8")
-_cat_file.setLevel(logging.DEBUG if CFG.DEBUG else logging.INFO)
-_cat_file.setFormatter(_fmt)
-catlog.addHandler(_cat_file)
+
+_LOGGING_READY = False
+_STORAGE_READY = False
+
+
+def init_logging() -> None:
+    """فایل‌های لاگ (اصلی، دیباگ، دسته‌بندی) را یک‌بار می‌سازد؛ دیگر در زمان import پوشه/فایل باز نمی‌شود."""
+    global _LOGGING_READY
+    if _LOGGING_READY:
+        return
+    _LOGGING_READY = True
+    CFG.LOG_DIR.mkdir(parents=True, exist_ok=True)
+
+    # فایل اصلی: INFO+
+    file_handler = RotatingFileHandler(CFG.LOG_FILE, maxBytes=CFG.LOG_MAX_BYTES, backupCount=CFG.LOG_BACKUP_COUNT, encoding="utf-8")
+    file_handler.setLevel(logging.INFO)
+    file_handler.setFormatter(_fmt)
+    logger.addHandler(file_handler)
+
+    # فایل دیباگ: DEBUG
+    if CFG.DEBUG:
+        debug_handler = RotatingFileHandler(CFG.DEBUG_LOG_FILE, maxBytes=CFG.LOG_MAX_BYTES, backupCount=CFG.LOG_BACKUP_COUNT, encoding="utf-8")
+        debug_handler.setLevel(logging.DEBUG)
+        debug_handler.setFormatter(_fmt)
+        logger.addHandler(debug_handler)
+
+    cat_handler = RotatingFileHandler(CFG.CATEGORY_LOG_FILE, maxBytes=CFG.LOG_MAX_BYTES, backupCount=CFG.LOG_BACKUP_COUNT, encoding="utf-8")
+    cat_handler.setLevel(logging.DEBUG if CFG.DEBUG else logging.INFO)
+    cat_handler.setFormatter(_fmt)
+    catlog.addHandler(cat_handler)
+
 
 # =========================
 # دیتابیس
 # =========================
-CFG.DATA_DIR.mkdir(parents=True, exist_ok=True)
-CFG.DOWNLOAD_TMP_DIR.mkdir(parents=True, exist_ok=True)
-CFG.DOWNLOAD_LINK_DIR.mkdir(parents=True, exist_ok=True)
+def init_storage() -> None:
+    """پوشه‌های داده/دانلود را می‌سازد (قبلاً در زمان import ساخته می‌شدند)."""
+    global _STORAGE_READY
+    if _STORAGE_READY:
+        return
+    _STORAGE_READY = True
+    CFG.DATA_DIR.mkdir(parents=True, exist_ok=True)
+    CFG.DOWNLOAD_TMP_DIR.mkdir(parents=True, exist_ok=True)
+    CFG.DOWNLOAD_LINK_DIR.mkdir(parents=True, exist_ok=True)
+
 
 DB_IS_MYSQL = (CFG.DB_TYPE or "sqlite").lower() == "mysql"
 
@@ -893,57 +1081,289 @@ def _connect_sqlite():
     conn.row_factory = sqlite3.Row
     return conn
 
-_conn = _connect_mysql() if DB_IS_MYSQL else _connect_sqlite()
+class _DetachedCursor:
+    """نتیجهٔ بافرشدهٔ یک کوئری MySQL که به کانکشن وابسته نیست.
 
-def _normalize_sql(sql: str) -> str:
-    return sql.replace("?", "%s") if DB_IS_MYSQL else sql
+    کانکشن بلافاصله بعد از اجرا به pool برمی‌گردد؛ فراخواننده‌ها همان
+    fetchone/fetchall/rowcount/lastrowid/close را مثل قبل استفاده می‌کنند.
+    """
 
-@contextmanager
-def _db_write():
-    if DB_IS_MYSQL:
-        # PyMySQL connection context manager closes the connection; avoid that.
-        yield
-    else:
-        try:
-            yield
-            _conn.commit()
-        except Exception:
-            with suppress(Exception):
-                _conn.rollback()
-            raise
-            yield
+    def __init__(self, cur: Any) -> None:
+        self.rowcount = cur.rowcount
+        self.lastrowid = getattr(cur, "lastrowid", None)
+        self.description = cur.description
+        self._rows = list(cur.fetchall() or []) if cur.description else []
+        self._pos = 0
 
-def _db_execute(sql: str, params: Optional[Any] = None, *, many: bool = False):
-    sql = _normalize_sql(sql)
-    if DB_IS_MYSQL:
-        global _conn
+    def fetchone(self) -> Optional[Dict[str, Any]]:
+        if self._pos >= len(self._rows):
+            return None
+        row = self._rows[self._pos]
+        self._pos += 1
+        return row
 
-        def _run() -> Any:
-            cur = _conn.cursor()
-            if many:
-                cur.executemany(sql, params or [])
+    def fetchall(self) -> List[Dict[str, Any]]:
+        rows = self._rows[self._pos:]
+        self._pos = len(self._rows)
+        return rows
+
+    def close(self) -> None:
+        self._rows = []
+
+
+# خطاهای «قطع کانکشن» MySQL؛ فقط این‌ها کانکشن را دور می‌اندازند و کوئری را دوباره اجرا می‌کنند
+# (deadlock 1213، lock wait timeout 1205 و بقیهٔ OperationalErrorها خطای سرورند، نه کانکشن خراب)
+_MYSQL_CONN_LOST_ERRNOS: Final[frozenset] = frozenset({2006, 2013, 2055})
+
+
+def _mysql_conn_lost(exc: BaseException) -> bool:
+    if isinstance(exc, pymysql.err.InterfaceError):
+        return True
+    if isinstance(exc, pymysql.err.OperationalError):
+        try:
+            return int(exc.args[0]) in _MYSQL_CONN_LOST_ERRNOS
+        except (IndexError, TypeError, ValueError):
+            return False
+    return False
+
+
+class _MySQLPool:
+    """Pool امن برای چند thread؛ هر کوئری یک کانکشن را check-out و بلافاصله آزاد می‌کند.
+
+    ping فقط روی کانکشن‌هایی انجام می‌شود که بیش از DB_POOL_PING_IDLE_S بیکار مانده‌اند.
+    """
+
+    def __init__(self, size: int, ping_idle_s: float, checkout_timeout_s: float) -> None:
+        self.size = max(1, int(size))
+        self.ping_idle_s = max(0.0, float(ping_idle_s))
+        self.checkout_timeout_s = max(0.1, float(checkout_timeout_s))
+        self._idle: List[Tuple[Any, float]] = []
+        self._open = 0
+        self._cond = threading.Condition()
+        self._stats: Dict[str, int] = {
+            "created": 0, "checkouts": 0, "waits": 0, "pings": 0,
+            "discarded": 0, "retries": 0,
+        }
+
+    def _acquire(self) -> Any:
+        deadline = time.monotonic() + self.checkout_timeout_s
+        with self._cond:
+            self._stats["checkouts"] += 1
+            waited = False
+            while not self._idle and self._open >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise RuntimeError("mysql_pool_exhausted")
+                if not waited:
+                    self._stats["waits"] += 1
+                    waited = True
+                self._cond.wait(remaining)
+            if self._idle:
+                conn, last_used = self._idle.pop()
             else:
-                cur.execute(sql, params or ())
-            return cur
+                self._open += 1
+                conn, last_used = None, 0.0
+        if conn is None:
+            try:
+                conn = _connect_mysql()
+            except Exception:
+                with self._cond:
+                    self._open -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._stats["created"] += 1
+            return conn
+        if time.monotonic() - last_used >= self.ping_idle_s:
+            with self._cond:
+                self._stats["pings"] += 1
+            try:
+                conn.ping(reconnect=True)
+            except Exception:
+                self._discard(conn)
+                return self._acquire()
+        return conn
 
+    def _release(self, conn: Any) -> None:
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def _discard(self, conn: Any) -> None:
+        with suppress(Exception):
+            conn.close()
+        with self._cond:
+            self._open -= 1
+            self._stats["discarded"] += 1
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
         try:
-            if _conn is None or not getattr(_conn, "open", False):
-                _conn = _connect_mysql()
+            yield conn
+        except Exception as exc:
+            if _mysql_conn_lost(exc):
+                self._discard(conn)
+            else:
+                self._release(conn)
+            raise
+        else:
+            self._release(conn)
+
+    def execute(self, sql: str, params: Optional[Any], *, many: bool) -> _DetachedCursor:
+        for attempt in (1, 2):
+            try:
+                with self.connection() as conn:
+                    cur = conn.cursor()
+                    try:
+                        if many:
+                            cur.executemany(sql, params or [])
+                        else:
+                            cur.execute(sql, params or ())
+                        return _DetachedCursor(cur)
+                    finally:
+                        with suppress(Exception):
+                            cur.close()
+            except Exception as exc:
+                if attempt == 2 or not _mysql_conn_lost(exc):
+                    raise
+                with self._cond:
+                    self._stats["retries"] += 1
+        raise RuntimeError("unreachable")
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            out = dict(self._stats)
+            out.update(size=self.size, open=self._open, idle=len(self._idle),
+                       in_use=self._open - len(self._idle))
+        return out
+
+    def close(self) -> None:
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for conn, _ in idle:
+            with suppress(Exception):
+                conn.close()
+
+
+_pool: Optional[_MySQLPool] = None
+_conn = None
+_DB_CONNECT_LOCK = threading.Lock()
+
+
+def init_db_connection() -> None:
+    """pool (MySQL) یا کانکشن SQLite را در اولین نیاز باز می‌کند، نه در زمان import."""
+    global _pool, _conn
+    if _pool is not None or _conn is not None:
+        return
+    with _DB_CONNECT_LOCK:
+        if _pool is not None or _conn is not None:
+            return
+        init_storage()
+        with startup_phase("db_connect"):
+            if DB_IS_MYSQL:
+                _pool = _MySQLPool(CFG.DB_POOL_SIZE, CFG.DB_POOL_PING_IDLE_S, CFG.DB_POOL_TIMEOUT_S)
+                atexit.register(_pool.close)
             else:
-                _conn.ping(reconnect=True)
-            return _run()
-        except (pymysql.err.InterfaceError, pymysql.err.OperationalError):
-            _conn = _connect_mysql()
-            return _run()
-
-    cur = _conn.cursor()
-    if many:
-        cur.executemany(sql, params or [])
+                _conn = _connect_sqlite()
+
+
+def init_runtime() -> None:
+    """مقداردهی صریح زیرساخت (لاگ فایل، پوشه‌ها، اتصال DB)؛ db_init آن را صدا می‌زند."""
+    with startup_phase("init_logging"):
+        init_logging()
+    with startup_phase("init_storage"):
+        init_storage()
+    init_db_connection()
+
+
+# اتصال SQLite بین event loop و thread اختصاصی DB مشترک است؛ نوشتن‌ها سریالی می‌شوند.
+_SQLITE_LOCK = threading.RLock()
+_DB_EXECUTOR: Optional[ThreadPoolExecutor] = None
+
+
+def _db_executor() -> ThreadPoolExecutor:
+    global _DB_EXECUTOR
+    if _DB_EXECUTOR is None:
+        workers = CFG.DB_POOL_SIZE if DB_IS_MYSQL else 1
+        _DB_EXECUTOR = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="db")
+    return _DB_EXECUTOR
+
+
+async def db_run(fn, *args: Any, **kwargs: Any) -> Any:
+    """یک تابع sync دیتابیس را روی thread pool اختصاصی DB اجرا می‌کند تا event loop بلاک نشود."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor(), functools.partial(fn, *args, **kwargs))
+
+
+def db_pool_stats() -> Dict[str, int]:
+    """متریک‌های pool کانکشن MySQL (برای SQLite خالی است)."""
+    return _pool.stats() if _pool else {}
+
+def _normalize_sql(sql: str) -> str:
+    return sql.replace("?", "%s") if DB_IS_MYSQL else sql
+
+@contextmanager
+def _db_write():
+    if DB_IS_MYSQL:
+        # autocommit=True و هر کوئری کانکشن خودش را از pool می‌گیرد.
+        yield
     else:
-        cur.execute(sql, params or ())
+        if _conn is None:
+            init_db_connection()
+        with _SQLITE_LOCK:
+            try:
+                yield
+                _conn.commit()
+            except Exception:
+                with suppress(Exception):
+                    _conn.rollback()
+                raise
+
+def _db_execute(sql: str, params: Optional[Any] = None, *, many: bool = False):
+    sql = _normalize_sql(sql)
+    if _pool is None and _conn is None:
+        init_db_connection()
+    if DB_IS_MYSQL:
+        return _pool.execute(sql, params, many=many)
+
+    with _SQLITE_LOCK:
+        cur = _conn.cursor()
+        if many:
+            cur.executemany(sql, params or [])
+        else:
+            cur.execute(sql, params or ())
     return cur
 
-def db_init() -> None:
+def _db_execute_batch(ops: List[Tuple[str, List[Tuple[Any, ...]]]]) -> None:
+    """چند دستور executemany را در یک تراکنش (یک commit) اجرا می‌کند."""
+    ops = [(sql, rows) for sql, rows in ops if rows]
+    if not ops:
+        return
+    if _pool is None and _conn is None:
+        init_db_connection()
+    if DB_IS_MYSQL:
+        with _pool.connection() as conn:
+            conn.begin()
+            try:
+                with conn.cursor() as cur:
+                    for sql, rows in ops:
+                        cur.executemany(_normalize_sql(sql), rows)
+                conn.commit()
+            except Exception:
+                with suppress(Exception):
+                    conn.rollback()
+                raise
+        return
+    with _db_write():
+        for sql, rows in ops:
+            cur = _db_execute(sql, rows, many=True)
+            cur.close()
+
+
+def _db_create_tables() -> None:
     if DB_IS_MYSQL:
         statements = [
             """
@@ -1190,24 +1610,240 @@ def db_init() -> None:
             );
             CREATE INDEX IF NOT EXISTS idx_email_otps_email ON email_otps(email);
             """)
-    _ensure_column("users", "user_token", "TEXT" if not DB_IS_MYSQL else "VARCHAR(64)")
-    _ensure_column("users", "token_created_at", "TEXT" if not DB_IS_MYSQL else "DATETIME")
-    _ensure_column("users", "plan_started_at", "INTEGER" if not DB_IS_MYSQL else "BIGINT")
-    _ensure_column("users", "plan_expires_at", "INTEGER" if not DB_IS_MYSQL else "BIGINT")
-    _ensure_column("users", "doi_quota_limit", "INTEGER" if not DB_IS_MYSQL else "INT")
-    _ensure_column("users", "doi_quota_used", "INTEGER" if not DB_IS_MYSQL else "INT")
-    _ensure_column("users", "doi_daily_limit", "INTEGER" if not DB_IS_MYSQL else "INT")
-    _ensure_column("users", "doi_daily_used", "INTEGER" if not DB_IS_MYSQL else "INT")
-    _ensure_column("users", "doi_daily_day", "INTEGER" if not DB_IS_MYSQL else "INT")
-    _ensure_column("users", "quota_free", "INTEGER" if not DB_IS_MYSQL else "INT")
-    _ensure_column("users", "quota_paid", "INTEGER" if not DB_IS_MYSQL else "INT")
-    _ensure_column("users", "used_free", "INTEGER" if not DB_IS_MYSQL else "INT")
-    _ensure_column("users", "used_paid", "INTEGER" if not DB_IS_MYSQL else "INT")
+
+
+# ---- Schema migrations ----
+# هر مهاجرت یک بار اجرا می‌شود و شمارهٔ آن در schema_version ثبت می‌شود؛
+# وقتی schema به‌روز است db_init هیچ probe یا DDL دیگری اجرا نمی‌کند.
+def _migration_add_columns() -> None:
+    _ensure_column("users", "user_token", "TEXT" if not DB_IS_MYSQL else "VARCHAR(64)")
+    _ensure_column("users", "token_created_at", "TEXT" if not DB_IS_MYSQL else "DATETIME")
+    _ensure_column("users", "plan_started_at", "INTEGER" if not DB_IS_MYSQL else "BIGINT")
+    _ensure_column("users", "plan_expires_at", "INTEGER" if not DB_IS_MYSQL else "BIGINT")
+    _ensure_column("users", "doi_quota_limit", "INTEGER" if not DB_IS_MYSQL else "INT")
+    _ensure_column("users", "doi_quota_used", "INTEGER" if not DB_IS_MYSQL else "INT")
+    _ensure_column("users", "doi_daily_limit", "INTEGER" if not DB_IS_MYSQL else "INT")
+    _ensure_column("users", "doi_daily_used", "INTEGER" if not DB_IS_MYSQL else "INT")
+    _ensure_column("users", "doi_daily_day", "INTEGER" if not DB_IS_MYSQL else "INT")
+    _ensure_column("users", "quota_free", "INTEGER" if not DB_IS_MYSQL else "INT")
+    _ensure_column("users", "quota_paid", "INTEGER" if not DB_IS_MYSQL else "INT")
+    _ensure_column("users", "used_free", "INTEGER" if not DB_IS_MYSQL else "INT")
+    _ensure_column("users", "used_paid", "INTEGER" if not DB_IS_MYSQL else "INT")
     _ensure_column("users", "email_verified", "INTEGER" if not DB_IS_MYSQL else "TINYINT")
     _ensure_column("users", "wallet_balance", "INTEGER" if not DB_IS_MYSQL else "INT")
     _ensure_column("payment_requests", "total_amount", "INTEGER" if not DB_IS_MYSQL else "INT")
     _ensure_column("payment_requests", "wallet_used", "INTEGER" if not DB_IS_MYSQL else "INT")
 
+
+def _migration_lookup_indexes() -> None:
+    # ایمیل نرمال‌شده: در SQLite ایندکس عبارتی روی lower(email)،
+    # در MySQL ستون generated به نام email_lower (سازگار با 5.7) + ایندکس.
+    if DB_IS_MYSQL:
+        _ensure_column("users", "email_lower", "VARCHAR(255) AS (LOWER(email)) VIRTUAL")
+        _ensure_index("users", "idx_users_email_lower", "email_lower")
+    else:
+        _ensure_index("users", "idx_users_email_lower", "lower(email)")
+    _ensure_index("doi_meta", "idx_doi_meta_doi", "doi")
+    _ensure_index("payment_requests", "idx_payment_code", "payment_code")
+    _ensure_index("download_links", "idx_download_links_used", "used_at")
+
+
+def _migration_jobs_queue() -> None:
+    if DB_IS_MYSQL:
+        statements = [
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                chat_id BIGINT NOT NULL,
+                kind VARCHAR(16) NOT NULL,
+                status VARCHAR(16) NOT NULL DEFAULT 'queued',
+                stage VARCHAR(16) NOT NULL DEFAULT 'queued',
+                zip_path TEXT,
+                lease_owner VARCHAR(128) NULL,
+                lease_until BIGINT DEFAULT 0,
+                attempts INT DEFAULT 0,
+                error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                INDEX idx_jobs_status_lease (status, lease_until)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS job_items (
+                id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                job_id BIGINT NOT NULL,
+                seq INT NOT NULL,
+                doi VARCHAR(512) NOT NULL,
+                stage VARCHAR(16) NOT NULL DEFAULT 'queued',
+                meta_json MEDIUMTEXT,
+                entry_json TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                UNIQUE KEY uniq_job_seq (job_id, seq),
+                CONSTRAINT fk_job_items_job FOREIGN KEY (job_id) REFERENCES jobs(id) ON DELETE CASCADE
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+            """,
+        ]
+        for stmt in statements:
+            cur = _db_execute(stmt)
+            cur.close()
+        return
+    with _db_write():
+        _conn.executescript("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,              -- full / oa_only
+            status TEXT NOT NULL DEFAULT 'queued',   -- queued / running / done / failed
+            stage TEXT NOT NULL DEFAULT 'queued',
+            zip_path TEXT,
+            lease_owner TEXT,
+            lease_until INTEGER DEFAULT 0,
+            attempts INTEGER DEFAULT 0,
+            error TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_status_lease ON jobs(status, lease_until);
+        CREATE TABLE IF NOT EXISTS job_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            doi TEXT NOT NULL,
+            stage TEXT NOT NULL DEFAULT 'queued',  -- queued / metadata / downloaded / packaged / delivered
+            meta_json TEXT,
+            entry_json TEXT,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(job_id, seq),
+            FOREIGN KEY(job_id) REFERENCES jobs(id) ON DELETE CASCADE
+        );
+        """)
+
+
+def _migration_scheduled_deletions() -> None:
+    if DB_IS_MYSQL:
+        ddl = """
+            CREATE TABLE IF NOT EXISTS scheduled_deletions (
+                id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                chat_id BIGINT NOT NULL,
+                message_id BIGINT NOT NULL,
+                countdown_message_id BIGINT NULL,
+                file_path TEXT,
+                delete_file TINYINT DEFAULT 0,
+                due_at BIGINT NOT NULL,
+                INDEX idx_sched_del_due (due_at)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """
+        cur = _db_execute(ddl)
+        cur.close()
+        return
+    with _db_write():
+        _conn.executescript("""
+        CREATE TABLE IF NOT EXISTS scheduled_deletions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            countdown_message_id INTEGER,
+            file_path TEXT,
+            delete_file INTEGER DEFAULT 0,
+            due_at INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_sched_del_due ON scheduled_deletions(due_at);
+        """)
+
+
+_MIGRATIONS: Final[List[Tuple[int, str, Callable[[], None]]]] = [
+    (1, "add_columns", _migration_add_columns),
+    (2, "lookup_indexes", _migration_lookup_indexes),
+    (3, "jobs_queue", _migration_jobs_queue),
+    (4, "scheduled_deletions", _migration_scheduled_deletions),
+]
+SCHEMA_VERSION: Final[int] = _MIGRATIONS[-1][0]
+
+
+def _schema_version() -> int:
+    cur = _db_execute("SELECT MAX(version) AS v FROM schema_version")
+    row = cur.fetchone()
+    cur.close()
+    return int(row["v"] or 0) if row else 0
+
+
+def db_init() -> None:
+    init_runtime()
+    with startup_phase("db_schema"):
+        _db_init_schema()
+
+
+def _db_init_schema() -> None:
+    if DB_IS_MYSQL:
+        ddl = (
+            "CREATE TABLE IF NOT EXISTS schema_version ("
+            "version INT PRIMARY KEY, name VARCHAR(64), "
+            "applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP"
+            ") ENGINE=InnoDB DEFAULT CHARSET=utf8mb4"
+        )
+    else:
+        ddl = (
+            "CREATE TABLE IF NOT EXISTS schema_version ("
+            "version INTEGER PRIMARY KEY, name TEXT, "
+            "applied_at TEXT DEFAULT CURRENT_TIMESTAMP)"
+        )
+    with _db_write():
+        cur = _db_execute(ddl)
+        cur.close()
+    current = _schema_version()
+    if current >= SCHEMA_VERSION:
+        logger.info("db_schema_current | version=%d", current)
+    else:
+        _db_create_tables()
+        for version, name, migrate in _MIGRATIONS:
+            if version <= current:
+                continue
+            t0 = time.perf_counter()
+            # خطای مهاجرت بالا می‌رود و نسخه ثبت نمی‌شود تا اجرای بعدی دوباره تلاش کند.
+            # mainbot و download_bot هر دو db_init را صدا می‌زنند؛ مهاجرت‌ها idempotent‌اند و ثبت نسخه هم.
+            migrate()
+            insert = "INSERT IGNORE INTO" if DB_IS_MYSQL else "INSERT OR IGNORE INTO"
+            with _db_write():
+                cur = _db_execute(f"{insert} schema_version (version, name) VALUES (?, ?)", (version, name))
+                cur.close()
+            logger.info("db_migration_applied | version=%d name=%s ms=%.0f", version, name, (time.perf_counter() - t0) * 1000)
+    if _pool:
+        logger.info("mysql_pool_ready | %s", db_pool_stats())
+
+def _ddl_already_applied(exc: Exception) -> bool:
+    """خطای «ستون/ایندکس از قبل هست» (پردازهٔ دیگری هم‌زمان همان مهاجرت را اجرا کرده)."""
+    with suppress(Exception):
+        if DB_IS_MYSQL and int(exc.args[0]) in (1060, 1061):  # duplicate column / key name
+            return True
+    msg = str(exc).lower()
+    return "duplicate column" in msg or "already exists" in msg
+
+
+def _ensure_index(table: str, name: str, columns: str) -> None:
+    if DB_IS_MYSQL:
+        cur = _db_execute(
+            "SELECT 1 FROM INFORMATION_SCHEMA.STATISTICS "
+            "WHERE TABLE_SCHEMA=? AND TABLE_NAME=? AND INDEX_NAME=?",
+            (CFG.DB_NAME, table, name),
+        )
+        row = cur.fetchone()
+        cur.close()
+        if row:
+            return
+        sql = f"CREATE INDEX `{name}` ON `{table}` ({columns})"
+    else:
+        sql = f"CREATE INDEX IF NOT EXISTS {name} ON {table}({columns})"
+    try:
+        with _db_write():
+            cur = _db_execute(sql)
+            cur.close()
+    except Exception as e:
+        if not _ddl_already_applied(e):
+            raise
+        logger.info("create_index_exists | table=%s index=%s", table, name)
+
 def _ensure_column(table: str, column: str, coltype: str) -> None:
     if DB_IS_MYSQL:
         cur = _db_execute(
@@ -1223,7 +1859,9 @@ def _ensure_column(table: str, column: str, coltype: str) -> None:
             cur = _db_execute(f"ALTER TABLE `{table}` ADD COLUMN `{column}` {coltype}")
             cur.close()
         except Exception as e:
-            logger.warning("ALTER TABLE failed (maybe exists): %s", e)
+            if not _ddl_already_applied(e):
+                raise
+            logger.info("add_column_exists | table=%s column=%s", table, column)
         return
 
     cur = _db_execute(f"PRAGMA table_info({table})")
@@ -1235,9 +1873,59 @@ def _ensure_column(table: str, column: str, coltype: str) -> None:
                 cur = _db_execute(f"ALTER TABLE {table} ADD COLUMN {column} {coltype}")
                 cur.close()
         except Exception as e:
-            logger.warning("ALTER TABLE failed (maybe exists): %s", e)
+            if not _ddl_already_applied(e):
+                raise
+            logger.info("add_column_exists | table=%s column=%s", table, column)
 
 # ---- User CRUD ----
+class _UserCache:
+    """رکورد کاربران را برای مدت کوتاهی در حافظه نگه می‌دارد تا ensure_user در هر پیام به DB نزند."""
+
+    def __init__(self, ttl_s: float) -> None:
+        self.ttl_s = max(0.0, float(ttl_s))
+        self._lock = threading.Lock()
+        self._rows: Dict[int, Tuple[float, Dict[str, Any]]] = {}
+
+    def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            hit = self._rows.get(int(user_id))
+            if not hit:
+                return None
+            if time.monotonic() - hit[0] > self.ttl_s:
+                self._rows.pop(int(user_id), None)
+                return None
+            return dict(hit[1])
+
+    def put(self, user_id: int, row: Dict[str, Any]) -> None:
+        if not row or self.ttl_s <= 0:
+            return
+        with self._lock:
+            self._rows[int(user_id)] = (time.monotonic(), dict(row))
+            if len(self._rows) > 4096:
+                cutoff = time.monotonic() - self.ttl_s
+                for uid in [u for u, (ts, _) in self._rows.items() if ts < cutoff]:
+                    self._rows.pop(uid, None)
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._rows.pop(int(user_id), None)
+
+
+_USER_CACHE = _UserCache(CFG.USER_CACHE_TTL_S)
+
+
+def _invalidates_user(fn):
+    """mutatorهایی که اولین آرگومانشان user_id است، بعد از نوشتن کش آن کاربر را باطل می‌کنند."""
+    @functools.wraps(fn)
+    def wrapper(user_id: int, *args: Any, **kwargs: Any):
+        try:
+            return fn(user_id, *args, **kwargs)
+        finally:
+            _USER_CACHE.invalidate(user_id)
+    return wrapper
+
+
+@_invalidates_user
 def db_upsert_user(user_id: int, username: Optional[str]) -> None:
     if DB_IS_MYSQL:
         sql = """
@@ -1261,11 +1949,26 @@ def db_get_user(user_id: int) -> Dict[str, Any]:
     cur.close()
     return dict(row) if row else {}
 
+def db_ensure_user(user_id: int, username: Optional[str]) -> Dict[str, Any]:
+    """رکورد کاربر را برمی‌گرداند؛ فقط وقتی کاربر جدید است یا username عوض شده می‌نویسد."""
+    uname = username or None
+    user = _USER_CACHE.get(user_id)
+    if user is None:
+        user = db_get_user(user_id)
+    if not user or user.get("username") != uname:
+        db_upsert_user(user_id, uname)
+        user = db_get_user(user_id)
+    _USER_CACHE.put(user_id, user)
+    return user
+
+# در MySQL ستون generated ایندکس‌دار؛ در SQLite عبارت lower(email) با ایندکس عبارتی
+_EMAIL_LOWER_SQL: Final[str] = "email_lower" if DB_IS_MYSQL else "lower(email)"
+
 def db_get_user_by_email(email: str) -> Dict[str, Any]:
     em = (email or "").strip().lower()
     if not em:
         return {}
-    cur = _db_execute("SELECT * FROM users WHERE lower(email)=?", (em,))
+    cur = _db_execute(f"SELECT * FROM users WHERE {_EMAIL_LOWER_SQL}=?", (em,))
     row = cur.fetchone()
     cur.close()
     return dict(row) if row else {}
@@ -1276,18 +1979,20 @@ def db_get_verified_user_by_email(email: str) -> Dict[str, Any]:
     if not em:
         return {}
     cur = _db_execute(
-        "SELECT * FROM users WHERE lower(email)=? AND email_verified=1",
+        f"SELECT * FROM users WHERE {_EMAIL_LOWER_SQL}=? AND email_verified=1",
         (em,),
     )
     row = cur.fetchone()
     cur.close()
     return dict(row) if row else {}
 
+@_invalidates_user
 def db_set_seen_welcome(user_id: int) -> None:
     with _db_write():
         cur = _db_execute("UPDATE users SET seen_welcome=1, updated_at=CURRENT_TIMESTAMP WHERE user_id=?", (user_id,))
         cur.close()
 
+@_invalidates_user
 def db_set_email(user_id: int, email: str) -> None:
     with _db_write():
         cur = _db_execute(
@@ -1297,6 +2002,7 @@ def db_set_email(user_id: int, email: str) -> None:
         cur.close()
 
 
+@_invalidates_user
 def db_set_email_verified(user_id: int, verified: bool = True) -> None:
     val = 1 if verified else 0
     with _db_write():
@@ -1306,6 +2012,7 @@ def db_set_email_verified(user_id: int, verified: bool = True) -> None:
         )
         cur.close()
 
+@_invalidates_user
 def db_set_delivery(user_id: int, method: str) -> None:
     with _db_write():
         cur = _db_execute(
@@ -1314,6 +2021,20 @@ def db_set_delivery(user_id: int, method: str) -> None:
         )
         cur.close()
 
+# ---- Plans ----
+PLAN_STATUS_ACTIVE: Final[str] = "فعال"
+PLAN_STATUS_EXPIRED: Final[str] = "منقضی"
+
+
+def plan_is_active(user: Dict[str, Any], *, now: Optional[int] = None) -> bool:
+    """پلن با وضعیت فعال و (اگر تاریخ انقضا دارد) هنوز منقضی‌نشده."""
+    if str(user.get("plan_status") or "").strip() != PLAN_STATUS_ACTIVE:
+        return False
+    expires_at = int(user.get("plan_expires_at") or 0)
+    return not expires_at or (int(time.time()) if now is None else now) <= expires_at
+
+
+@_invalidates_user
 def db_set_plan(user_id: int, ptype: str, label: str, price: int, status: str, note: str) -> None:
     with _db_write():
         cur = _db_execute("""
@@ -1323,7 +2044,8 @@ def db_set_plan(user_id: int, ptype: str, label: str, price: int, status: str, n
         """, (ptype, label, price, status, note, user_id))
         cur.close()
 
-
+
+@_invalidates_user
 def db_set_plan_period(user_id: int, *, started_at: Optional[int], expires_at: Optional[int]) -> None:
     start_val = int(started_at) if started_at else None
     end_val = int(expires_at) if expires_at else None
@@ -1338,7 +2060,8 @@ def db_set_plan_period(user_id: int, *, started_at: Optional[int], expires_at: O
         )
         cur.close()
 
-
+
+@_invalidates_user
 def db_set_doi_quota(user_id: int, *, limit: int, used: int = 0) -> None:
     with _db_write():
         cur = _db_execute(
@@ -1351,7 +2074,8 @@ def db_set_doi_quota(user_id: int, *, limit: int, used: int = 0) -> None:
         )
         cur.close()
 
-
+
+@_invalidates_user
 def db_inc_doi_quota_used(user_id: int, inc: int) -> None:
     if int(inc) <= 0:
         return
@@ -1367,7 +2091,8 @@ def db_inc_doi_quota_used(user_id: int, inc: int) -> None:
         )
         cur.close()
 
-
+
+@_invalidates_user
 def db_set_doi_daily_quota(user_id: int, *, limit: int, used: int = 0, day_key: int = 0) -> None:
     with _db_write():
         cur = _db_execute(
@@ -1380,7 +2105,8 @@ def db_set_doi_daily_quota(user_id: int, *, limit: int, used: int = 0, day_key:
         )
         cur.close()
 
-
+
+@_invalidates_user
 def db_inc_doi_daily_used(user_id: int, inc: int, *, day_key: int) -> None:
     if int(inc) <= 0:
         return
@@ -1427,8 +2153,8 @@ def db_add_dois(user_id: int, dois: List[str]) -> int:
             cur.close()
         return count
 
-    before = _conn.total_changes
     with _db_write():
+        before = _conn.total_changes
         cur = _db_execute(
             "INSERT OR IGNORE INTO dois (user_id, doi) VALUES (?, ?)",
             [(user_id, d) for d in normalized],
@@ -1438,10 +2164,9 @@ def db_add_dois(user_id: int, dois: List[str]) -> int:
     return _conn.total_changes - before
 
 # ---- doi_meta CRUD ----
-def db_upsert_meta(user_id: int, doi: str, *, title: Optional[str], year: Optional[int],
-                   category: Optional[str], source: str, status: str, error: Optional[str]) -> None:
+def _meta_upsert_sql() -> str:
     if DB_IS_MYSQL:
-        sql = """
+        return """
             INSERT INTO doi_meta (user_id, doi, title, year, category, source, status, error, updated_at)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
             ON DUPLICATE KEY UPDATE
@@ -1453,21 +2178,23 @@ def db_upsert_meta(user_id: int, doi: str, *, title: Optional[str], year: Option
                 error=VALUES(error),
                 updated_at=CURRENT_TIMESTAMP
         """
-    else:
-        sql = """
-            INSERT INTO doi_meta (user_id, doi, title, year, category, source, status, error, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-            ON CONFLICT(user_id, doi) DO UPDATE SET
-                title=excluded.title,
-                year=excluded.year,
-                category=excluded.category,
-                source=excluded.source,
-                status=excluded.status,
-                error=excluded.error,
-                updated_at=CURRENT_TIMESTAMP
-        """
+    return """
+        INSERT INTO doi_meta (user_id, doi, title, year, category, source, status, error, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(user_id, doi) DO UPDATE SET
+            title=excluded.title,
+            year=excluded.year,
+            category=excluded.category,
+            source=excluded.source,
+            status=excluded.status,
+            error=excluded.error,
+            updated_at=CURRENT_TIMESTAMP
+    """
+
+def db_upsert_meta(user_id: int, doi: str, *, title: Optional[str], year: Optional[int],
+                   category: Optional[str], source: str, status: str, error: Optional[str]) -> None:
     with _db_write():
-        cur = _db_execute(sql, (user_id, doi, title, year, category, source, status, (error or None)))
+        cur = _db_execute(_meta_upsert_sql(), (user_id, doi, title, year, category, source, status, (error or None)))
         cur.close()
 
 # ---- Token helpers ----
@@ -1481,6 +2208,7 @@ def db_get_token(user_id: int) -> Optional[str]:
     cur.close()
     return row["user_token"] if row and row["user_token"] else None
 
+@_invalidates_user
 def db_set_new_token(user_id: int) -> str:
     for _ in range(50):
         tok = _generate_token()
@@ -1503,28 +2231,116 @@ def db_get_or_create_token(user_id: int) -> str:
         return tok
     return db_set_new_token(user_id)
 
-# ---- Settings CRUD ----
-def db_get_setting(key: str) -> Optional[str]:
-    sql = "SELECT value FROM settings WHERE key=?" if not DB_IS_MYSQL else "SELECT value FROM settings WHERE `key`=?"
-    cur = _db_execute(sql, (key,))
+# ---- Settings CRUD (با کش درون‌پردازه‌ای) ----
+# ردیف شمارندهٔ نسخه: هر db_set_setting آن را یک واحد بالا می‌برد تا پردازه‌های دیگر
+# (ربات اصلی، ربات دانلود، API) کش خود را باطل کنند.
+SETTINGS_VERSION_KEY: Final[str] = "__settings_version__"
+
+
+def _settings_key_sql() -> str:
+    return "`key`" if DB_IS_MYSQL else "key"
+
+
+def _db_read_setting(key: str) -> Optional[str]:
+    cur = _db_execute(f"SELECT value FROM settings WHERE {_settings_key_sql()}=?", (key,))
     row = cur.fetchone()
     cur.close()
     return row["value"] if row else None
 
-def db_set_setting(key: str, value: str) -> None:
-    if DB_IS_MYSQL:
+
+class _SettingsCache:
+    """مقادیر خام و پارس‌شدهٔ settings را نگه می‌دارد و با ردیف نسخه همگام می‌ماند."""
+
+    def __init__(self, check_s: float) -> None:
+        self.check_s = max(0.0, float(check_s))
+        self._lock = threading.RLock()
+        self._raw: Dict[str, Optional[str]] = {}
+        self._parsed: Dict[Tuple[str, Any], Any] = {}
+        self._version: Optional[str] = None
+        self._checked_at = 0.0
+
+    def _clear(self) -> None:
+        self._raw.clear()
+        self._parsed.clear()
+
+    def _sync(self) -> None:
+        now = time.monotonic()
+        if self._version is not None and now - self._checked_at < self.check_s:
+            return
+        version = _db_read_setting(SETTINGS_VERSION_KEY) or "0"
+        if version != self._version:
+            self._clear()
+            self._version = version
+        self._checked_at = now
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            self._sync()
+            if key not in self._raw:
+                self._raw[key] = _db_read_setting(key)
+            return self._raw[key]
+
+    def get_parsed(self, key: str, parse: Callable[[Optional[str]], Any]) -> Any:
+        with self._lock:
+            raw = self.get(key)
+            slot = (key, parse)
+            if slot not in self._parsed:
+                self._parsed[slot] = parse(raw)
+            return copy.deepcopy(self._parsed[slot])
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._clear()
+            self._version = None
+
+
+_SETTINGS = _SettingsCache(CFG.SETTINGS_CACHE_CHECK_S)
+
+
+def db_get_setting(key: str) -> Optional[str]:
+    return _SETTINGS.get(key)
+
+
+def db_get_setting_parsed(key: str, parse: Callable[[Optional[str]], Any]) -> Any:
+    """مقدار پارس‌شده با parse(raw) را از کش برمی‌گرداند (یک کپی مستقل)."""
+    return _SETTINGS.get_parsed(key, parse)
+
+
+def _parse_json_or_none(raw: Optional[str]) -> Any:
+    if not raw:
+        return None
+    try:
+        return json.loads(raw)
+    except Exception:
+        return None
+
+
+def db_get_setting_json(key: str) -> Any:
+    """JSON پارس‌شده یا None (نبود کلید یا JSON نامعتبر)."""
+    return _SETTINGS.get_parsed(key, _parse_json_or_none)
+
+
+def db_set_setting(key: str, value: str) -> None:
+    if DB_IS_MYSQL:
         sql = (
             "INSERT INTO settings (`key`, value) VALUES (?, ?) "
             "ON DUPLICATE KEY UPDATE value = VALUES(value)"
         )
+        bump = (
+            "INSERT INTO settings (`key`, value) VALUES (?, '1') "
+            "ON DUPLICATE KEY UPDATE value = CAST(value AS UNSIGNED) + 1"
+        )
     else:
         sql = (
             "INSERT INTO settings (key, value) VALUES (?, ?) "
             "ON CONFLICT(key) DO UPDATE SET value = excluded.value"
         )
-    with _db_write():
-        cur = _db_execute(sql, (key, value))
-        cur.close()
+        bump = (
+            "INSERT INTO settings (key, value) VALUES (?, '1') "
+            "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+        )
+    _db_execute_batch([(sql, [(key, value)]), (bump, [(SETTINGS_VERSION_KEY,)])])
+    _SETTINGS.invalidate()
 
 # ---- Payment Requests ----
 PAYMENT_STATUS_AWAITING: Final[str] = "awaiting_receipt"
@@ -1663,6 +2479,7 @@ def db_set_payment_status(
         cur.close()
 
 # ---- Wallet ----
+@_invalidates_user
 def db_add_wallet_balance(user_id: int, delta: int) -> None:
     with _db_write():
         cur = _db_execute(
@@ -1677,6 +2494,7 @@ def db_add_wallet_balance(user_id: int, delta: int) -> None:
         cur.close()
 
 # ---- Quotas ----
+@_invalidates_user
 def db_add_quota(user_id: int, *, free_add: int = 0, paid_add: int = 0) -> None:
     with _db_write():
         cur = _db_execute(
@@ -1700,6 +2518,7 @@ def db_add_quota_by_email(email: str, *, free_add: int = 0, paid_add: int = 0) -
     return True
 
 
+@_invalidates_user
 def db_inc_used(user_id: int, *, free_inc: int = 0, paid_inc: int = 0) -> None:
     with _db_write():
         cur = _db_execute(
@@ -1730,12 +2549,417 @@ def db_get_quota_status(user_id: int) -> Dict[str, int]:
         "remaining_paid": max(0, qp - up),
     }
 
+# ---- Write-behind (doi_meta + مصرف سهمیه) ----
+class _WriteBehindBuffer:
+    """نوشتن‌های per-DOI را جمع می‌کند و هر N ردیف یا T میلی‌ثانیه یک‌جا flush می‌کند."""
+
+    def __init__(self, max_rows: int, flush_ms: int) -> None:
+        self.max_rows = max(1, int(max_rows))
+        self.flush_s = max(0.01, int(flush_ms) / 1000.0)
+        self._lock = threading.Lock()
+        self._meta: Dict[Tuple[int, str], Tuple[Any, ...]] = {}
+        self._used: Dict[int, List[int]] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # ارجاع به taskهای flush تا پیش از پایان garbage-collect نشوند
+        self._tasks: set = set()
+        self._last_failed = False
+        self._stats: Dict[str, int] = {"flushes": 0, "meta_rows": 0, "used_rows": 0, "errors": 0}
+
+    def _pending(self) -> int:
+        return len(self._meta) + len(self._used)
+
+    def add_meta(self, row: Tuple[Any, ...]) -> None:
+        with self._lock:
+            self._meta[(int(row[0]), str(row[1]))] = row
+            full = self._pending() >= self.max_rows
+        self._after_add(full)
+
+    def add_used(self, user_id: int, free_inc: int, paid_inc: int) -> None:
+        with self._lock:
+            acc = self._used.setdefault(int(user_id), [0, 0])
+            acc[0] += int(free_inc)
+            acc[1] += int(paid_inc)
+            full = self._pending() >= self.max_rows
+        self._after_add(full)
+
+    def _after_add(self, full: bool) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # خارج از event loop: بدون تأخیر بنویس
+            self.flush_sync()
+            return
+        if full:
+            self._cancel_timer()
+            self._spawn_flush(loop)
+        elif self._timer is None:
+            self._arm_timer(loop, self.flush_s)
+
+    def _spawn_flush(self, loop: asyncio.AbstractEventLoop) -> None:
+        task = loop.create_task(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _arm_timer(self, loop: asyncio.AbstractEventLoop, delay_s: float) -> None:
+        self._timer = loop.call_later(delay_s, self._spawn_flush, loop)
+
+    def _cancel_timer(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def flush_sync(self) -> int:
+        with self._lock:
+            meta, self._meta = list(self._meta.values()), {}
+            used, self._used = self._used, {}
+        if not meta and not used:
+            return 0
+        used_rows = [(free, paid, uid) for uid, (free, paid) in used.items() if free or paid]
+        try:
+            _db_execute_batch([
+                (_meta_upsert_sql(), meta),
+                (
+                    """
+                    UPDATE users
+                       SET used_free = COALESCE(used_free, 0) + ?,
+                           used_paid = COALESCE(used_paid, 0) + ?,
+                           updated_at = CURRENT_TIMESTAMP
+                     WHERE user_id = ?
+                    """,
+                    used_rows,
+                ),
+            ])
+        except Exception as exc:
+            logger.warning("write_behind_flush_failed | meta=%d used=%d err=%s", len(meta), len(used_rows), exc)
+            with self._lock:
+                self._last_failed = True
+                self._stats["errors"] += 1
+                # برگرداندن به بافر تا flush بعدی دوباره تلاش کند
+                for row in meta:
+                    self._meta.setdefault((int(row[0]), str(row[1])), row)
+                for uid, (free, paid) in used.items():
+                    acc = self._used.setdefault(uid, [0, 0])
+                    acc[0] += free
+                    acc[1] += paid
+            return 0
+        for uid in used:
+            _USER_CACHE.invalidate(uid)
+        with self._lock:
+            self._last_failed = False
+            self._stats["flushes"] += 1
+            self._stats["meta_rows"] += len(meta)
+            self._stats["used_rows"] += len(used_rows)
+        return len(meta) + len(used_rows)
+
+    async def flush(self) -> int:
+        self._cancel_timer()
+        with self._lock:
+            if not self._pending():
+                return 0
+        written = await db_run(self.flush_sync)
+        if self._last_failed and self._timer is None:
+            # ردیف‌ها به بافر برگشته‌اند؛ بدون انتظار برای نوشتن بعدی دوباره تلاش کن
+            self._arm_timer(asyncio.get_running_loop(), max(self.flush_s, 1.0))
+        return written
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats, pending=self._pending())
+
+
+_WRITE_BEHIND = _WriteBehindBuffer(CFG.DB_WRITE_BATCH_ROWS, CFG.DB_WRITE_FLUSH_MS)
+atexit.register(_WRITE_BEHIND.flush_sync)
+
+
+def queue_upsert_meta(user_id: int, doi: str, *, title: Optional[str], year: Optional[int],
+                      category: Optional[str], source: str, status: str, error: Optional[str]) -> None:
+    """نسخهٔ write-behind از db_upsert_meta؛ ردیف در flush بعدی نوشته می‌شود."""
+    _WRITE_BEHIND.add_meta((int(user_id), doi, title, year, category, source, status, (error or None)))
+
+
+def queue_inc_used(user_id: int, *, free_inc: int = 0, paid_inc: int = 0) -> None:
+    """نسخهٔ write-behind از db_inc_used؛ افزایش‌ها برای هر کاربر تجمیع می‌شوند."""
+    if int(free_inc) or int(paid_inc):
+        _WRITE_BEHIND.add_used(int(user_id), int(free_inc), int(paid_inc))
+
+
+async def flush_pending_writes() -> int:
+    return await _WRITE_BEHIND.flush()
+
+
+def write_behind_stats() -> Dict[str, int]:
+    return _WRITE_BEHIND.stats()
+
+# ---- Jobs (صف پایدار دسته‌های DOI) ----
+# هر DOI در job_items مرحلهٔ خودش را دارد تا بعد از ری‌استارت از آخرین مرحلهٔ کامل ادامه دهیم.
+JOB_STAGES: Final[Tuple[str, ...]] = ("queued", "metadata", "downloaded", "packaged", "delivered")
+JOB_KIND_FULL: Final[str] = "full"
+JOB_KIND_OA_ONLY: Final[str] = "oa_only"
+# شناسهٔ این پردازه برای lease
+JOB_WORKER_ID: Final[str] = f"{platform.node()}:{os.getpid()}:{secrets.token_hex(3)}"
+
+
+def job_stage_index(stage: Optional[str]) -> int:
+    try:
+        return JOB_STAGES.index(stage or "queued")
+    except ValueError:
+        return 0
+
+
+def _job_json_load(raw: Optional[str]) -> Optional[Dict[str, Any]]:
+    if not raw:
+        return None
+    try:
+        data = json.loads(raw)
+    except Exception:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def db_create_job(user_id: int, chat_id: int, kind: str, dois: List[str]) -> int:
+    """ردیف کار و آیتم‌هایش را در یک تراکنش می‌نویسد (کار بدون آیتم بعد از crash «done» resume می‌شد)."""
+    items_sql = "INSERT INTO job_items (job_id, seq, doi, stage) VALUES (?, ?, ?, 'queued')"
+    if DB_IS_MYSQL:
+        if _pool is None:
+            init_db_connection()
+        with _pool.connection() as conn:
+            conn.begin()
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        _normalize_sql("INSERT INTO jobs (user_id, chat_id, kind, status, stage) "
+                                       "VALUES (?, ?, ?, 'queued', 'queued')"),
+                        (int(user_id), int(chat_id), kind),
+                    )
+                    job_id = int(cur.lastrowid)
+                    cur.executemany(_normalize_sql(items_sql), [(job_id, i, d) for i, d in enumerate(dois)])
+                conn.commit()
+            except Exception:
+                with suppress(Exception):
+                    conn.rollback()
+                raise
+        return job_id
+    with _db_write():
+        cur = _db_execute(
+            "INSERT INTO jobs (user_id, chat_id, kind, status, stage) VALUES (?, ?, ?, 'queued', 'queued')",
+            (int(user_id), int(chat_id), kind),
+        )
+        job_id = int(cur.lastrowid)
+        cur.close()
+        cur = _db_execute(items_sql, [(job_id, i, d) for i, d in enumerate(dois)], many=True)
+        cur.close()
+    return job_id
+
+
+def db_claim_job(job_id: int, *, lease_s: int) -> bool:
+    """lease کار را می‌گیرد اگر آزاد/منقضی باشد یا از قبل مال همین پردازه باشد."""
+    now = int(time.time())
+    with _db_write():
+        cur = _db_execute(
+            """
+            UPDATE jobs
+               SET status = 'running', lease_owner = ?, lease_until = ?,
+                   attempts = COALESCE(attempts, 0) + 1, updated_at = CURRENT_TIMESTAMP
+             WHERE id = ? AND status IN ('queued', 'running')
+               AND (lease_owner IS NULL OR lease_owner = ? OR COALESCE(lease_until, 0) < ?)
+            """,
+            (JOB_WORKER_ID, now + int(lease_s), int(job_id), JOB_WORKER_ID, now),
+        )
+        ok = cur.rowcount == 1
+        cur.close()
+    return ok
+
+
+def db_renew_job_lease(job_id: int, *, lease_s: int) -> bool:
+    with _db_write():
+        cur = _db_execute(
+            "UPDATE jobs SET lease_until = ? WHERE id = ? AND lease_owner = ? AND status = 'running'",
+            (int(time.time()) + int(lease_s), int(job_id), JOB_WORKER_ID),
+        )
+        ok = cur.rowcount == 1
+        cur.close()
+    return ok
+
+
+def db_release_job(job_id: int) -> None:
+    """lease را آزاد می‌کند تا پردازهٔ بعدی بلافاصله ادامه دهد (مثلاً هنگام shutdown)."""
+    with _db_write():
+        cur = _db_execute(
+            # shutdown تمیز تلاش ناموفق نیست؛ claim بعدی نباید به سقف JOB_MAX_ATTEMPTS نزدیک‌ترش کند
+            "UPDATE jobs SET lease_owner = NULL, lease_until = 0, "
+            "attempts = CASE WHEN COALESCE(attempts, 0) > 0 THEN attempts - 1 ELSE 0 END "
+            "WHERE id = ? AND lease_owner = ?",
+            (int(job_id), JOB_WORKER_ID),
+        )
+        cur.close()
+
+
+def db_get_job(job_id: int) -> Dict[str, Any]:
+    cur = _db_execute("SELECT * FROM jobs WHERE id=?", (int(job_id),))
+    row = cur.fetchone()
+    cur.close()
+    return dict(row) if row else {}
+
+
+def db_get_job_items(job_id: int) -> List[Dict[str, Any]]:
+    cur = _db_execute("SELECT * FROM job_items WHERE job_id=? ORDER BY seq", (int(job_id),))
+    rows = cur.fetchall()
+    cur.close()
+    items: List[Dict[str, Any]] = []
+    for row in rows:
+        item = dict(row)
+        item["meta"] = _job_json_load(item.pop("meta_json", None))
+        item["entry"] = _job_json_load(item.pop("entry_json", None))
+        items.append(item)
+    return items
+
+
+def db_set_job_item_stage(item_id: int, stage: str, *, meta: Optional[Dict[str, Any]] = None,
+                          entry: Optional[Dict[str, Any]] = None) -> None:
+    sets = ["stage = ?", "updated_at = CURRENT_TIMESTAMP"]
+    params: List[Any] = [stage]
+    if meta is not None:
+        sets.append("meta_json = ?")
+        params.append(json.dumps(meta, ensure_ascii=False))
+    if entry is not None:
+        sets.append("entry_json = ?")
+        params.append(json.dumps(entry, ensure_ascii=False))
+    params.append(int(item_id))
+    with _db_write():
+        cur = _db_execute(f"UPDATE job_items SET {', '.join(sets)} WHERE id = ?", tuple(params))
+        cur.close()
+
+
+def db_set_job_stage(job_id: int, stage: str, *, status: Optional[str] = None,
+                     zip_path: Optional[str] = None) -> None:
+    """مرحلهٔ کار و همهٔ آیتم‌های عقب‌تر از آن را جلو می‌برد؛ با status=done lease آزاد می‌شود."""
+    sets = ["stage = ?", "updated_at = CURRENT_TIMESTAMP"]
+    params: List[Any] = [stage]
+    if zip_path is not None:
+        sets.append("zip_path = ?")
+        params.append(zip_path)
+    if status is not None:
+        sets.append("status = ?")
+        params.append(status)
+        if status == "done":
+            sets.append("lease_owner = NULL")
+            sets.append("lease_until = 0")
+    params.append(int(job_id))
+    later = JOB_STAGES[job_stage_index(stage):]
+    with _db_write():
+        cur = _db_execute(f"UPDATE jobs SET {', '.join(sets)} WHERE id = ?", tuple(params))
+        cur.close()
+        if stage in ("packaged", "delivered"):
+            placeholders = ",".join(["?"] * len(later))
+            cur = _db_execute(
+                f"UPDATE job_items SET stage = ?, updated_at = CURRENT_TIMESTAMP "
+                f"WHERE job_id = ? AND stage NOT IN ({placeholders})",
+                (stage, int(job_id), *later),
+            )
+            cur.close()
+
+
+def db_fail_job(job_id: int, error: str, *, unleased_only: bool = False) -> bool:
+    """
+    کار را failed می‌کند. unleased_only: فقط اگر هنوز نیمه‌تمام و بدون lease معتبر باشد
+    (رها کردن کار از resume؛ True فقط برای پردازه‌ای که واقعاً آن را failed کرد).
+    """
+    sql = ("UPDATE jobs SET status = 'failed', error = ?, lease_owner = NULL, lease_until = 0, "
+           "updated_at = CURRENT_TIMESTAMP WHERE id = ?")
+    params: Tuple[Any, ...] = ((error or "")[:300], int(job_id))
+    if unleased_only:
+        sql += " AND status IN ('queued', 'running') AND COALESCE(lease_until, 0) < ?"
+        params += (int(time.time()),)
+    with _db_write():
+        cur = _db_execute(sql, params)
+        ok = cur.rowcount == 1
+        cur.close()
+    return ok
+
+
+_JOB_CREATED_TS_SQL: Final[str] = (
+    "UNIX_TIMESTAMP(created_at)" if DB_IS_MYSQL else "CAST(strftime('%s', created_at) AS INTEGER)"
+)
+
+
+def db_list_resumable_jobs() -> List[Dict[str, Any]]:
+    """کارهای نیمه‌تمامی که lease ندارند یا lease آن‌ها منقضی شده است (id، chat_id، attempts، created_ts)."""
+    cur = _db_execute(
+        f"SELECT id, chat_id, attempts, {_JOB_CREATED_TS_SQL} AS created_ts FROM jobs "
+        "WHERE status IN ('queued', 'running') AND COALESCE(lease_until, 0) < ? ORDER BY id",
+        (int(time.time()),),
+    )
+    rows = cur.fetchall()
+    cur.close()
+    return [dict(r) for r in rows]
+
 def _download_bot_deeplink(token: str) -> Optional[str]:
     name = (CFG.DOWNLOAD_BOT_USERNAME or "").strip().lstrip("@")
     if not name or not token:
         return None
     return f"https://t.me/{name}?start={token}"
 
+def _download_http_key() -> bytes:
+    secret = CFG.DOWNLOAD_HTTP_SECRET or CFG.TOKEN
+    return hashlib.sha256(b"download-link:" + secret.encode()).digest()
+
+def download_link_signature(token: str, user_id: int) -> str:
+    """امضای HMAC توکن برای صاحب لینک؛ جای بررسی «همان کاربر» ربات دانلود در لینک HTTP."""
+    return hmac.new(_download_http_key(), f"{token}:{int(user_id)}".encode(), hashlib.sha256).hexdigest()[:32]
+
+# کلیدهای settings ربات دانلود (پنل /admin)؛ api_server هم برای /d/{token} همین‌ها را می‌خواند
+DOWNLOAD_BOT_BLOCKED_KEY: Final[str] = "DOWNLOAD_BOT_BLOCKED"
+DOWNLOAD_BOT_CONFIG_KEY: Final[str] = "DOWNLOAD_BOT_CONFIG"
+
+
+def download_link_require_same_user() -> bool:
+    """require_same_user فعلی ربات دانلود: مقدار ذخیره‌شده در پنل ادمین، وگرنه env."""
+    data = db_get_setting_json(DOWNLOAD_BOT_CONFIG_KEY)
+    if isinstance(data, dict) and "require_same_user" in data:
+        return bool(data["require_same_user"])
+    return bool(CFG.DOWNLOAD_LINK_REQUIRE_SAME_USER)
+
+
+def download_bot_is_blocked(user_id: int) -> bool:
+    data = db_get_setting_json(DOWNLOAD_BOT_BLOCKED_KEY)
+    if not user_id or not isinstance(data, list):
+        return False
+    return str(int(user_id)) in {str(x).strip() for x in data}
+
+
+def download_http_url(token: str, user_id: int) -> Optional[str]:
+    base = CFG.DOWNLOAD_HTTP_BASE_URL
+    if not base or not token:
+        return None
+    return f"{base}/d/{token}?sig={download_link_signature(token, user_id)}"
+
+def download_link_error(rec: Dict[str, Any], *, now: Optional[int] = None) -> Optional[str]:
+    """قواعد مشترک اعتبار رکورد download_links: None یعنی معتبر، وگرنه not_found/expired/used."""
+    if not rec:
+        return "not_found"
+    now = int(now if now is not None else time.time())
+    expires_at = int(rec.get("expires_at") or 0)
+    if expires_at and expires_at < now:
+        return "expired"
+    if rec.get("used_at"):
+        return "used"
+    return None
+
+def _download_links_text(tokens: List[str], user_id: int) -> str:
+    total = len(tokens)
+    lines: List[str] = []
+    if CFG.DOWNLOAD_BOT_USERNAME:
+        if total == 1:
+            lines += ["Download link (start the download bot):", str(_download_bot_deeplink(tokens[0]))]
+        else:
+            lines.append(f"Download links ({total} parts, start the download bot for each):")
+            lines += [f"{i}/{total}: {_download_bot_deeplink(t)}" for i, t in enumerate(tokens, start=1)]
+    if CFG.DOWNLOAD_HTTP_BASE_URL:
+        urls = [download_http_url(t, user_id) for t in tokens]
+        lines.append("Direct download (resumable):")
+        lines += [str(urls[0])] if total == 1 else [f"{i}/{total}: {u}" for i, u in enumerate(urls, start=1)]
+    return "\n".join(lines)
+
 CB_DL_DONE: Final[str] = "dl:done"
 
 def _download_link_done_kb() -> Optional[Any]:
@@ -1831,6 +3055,35 @@ def db_cleanup_download_links(*, include_used: bool = True) -> int:
         cur.close()
     return count
 
+# ---- Scheduled deletions (پیام/فایل‌هایی که ربات دانلود بعد از مدتی پاک می‌کند) ----
+def db_add_scheduled_deletion(chat_id: int, message_id: int, countdown_message_id: Optional[int],
+                              file_path: Optional[str], *, delete_file: bool, due_at: int) -> int:
+    with _db_write():
+        cur = _db_execute(
+            "INSERT INTO scheduled_deletions (chat_id, message_id, countdown_message_id, file_path, delete_file, due_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (int(chat_id), int(message_id), countdown_message_id, file_path, 1 if delete_file else 0, int(due_at)),
+        )
+        row_id = int(cur.lastrowid)
+        cur.close()
+    return row_id
+
+
+def db_list_scheduled_deletions() -> List[Dict[str, Any]]:
+    cur = _db_execute("SELECT * FROM scheduled_deletions ORDER BY due_at")
+    rows = cur.fetchall()
+    cur.close()
+    return [dict(r) for r in rows]
+
+
+def db_remove_scheduled_deletions(ids: List[int]) -> None:
+    if not ids:
+        return
+    placeholders = ",".join(["?"] * len(ids))
+    with _db_write():
+        cur = _db_execute(f"DELETE FROM scheduled_deletions WHERE id IN ({placeholders})", tuple(int(i) for i in ids))
+        cur.close()
+
 def _v2ray_key(region: str) -> str:
     return f"V2RAY_CONFIGS_{region.upper()}"
 
@@ -1840,17 +3093,9 @@ def _norm_region(region: str) -> str:
 
 def vpn_load_configs(region: str) -> List[Dict[str, Any]]:
     region = _norm_region(region)
-    raw = db_get_setting(_v2ray_key(region)) or "[]"
-    try:
-        arr = json.loads(raw)
-        if isinstance(arr, list):
-            out: List[Dict[str, Any]] = []
-            for item in arr:
-                if isinstance(item, dict) and item.get("data"):
-                    out.append(item)
-            return out
-    except Exception:
-        pass
+    arr = db_get_setting_json(_v2ray_key(region))
+    if isinstance(arr, list):
+        return [item for item in arr if isinstance(item, dict) and item.get("data")]
     return []
 
 def vpn_save_configs(region: str, configs: List[Dict[str, Any]]) -> None:
@@ -1936,7 +3181,7 @@ def vpn_ping_config(region: str, cfg_id: str) -> Tuple[bool, Optional[int]]:
         return False, None
     start = time.perf_counter()
     try:
-        resp = requests.get(
+        resp = _lazy_import("requests").get(
             "https://1.1.1.1/cdn-cgi/trace",
             proxies={"http": proxy, "https": proxy},
             timeout=6,
@@ -1982,13 +3227,9 @@ def _env_accounts() -> List[Dict[str, Any]]:
 
 
 def _load_account_state() -> Dict[str, Any]:
-    raw = db_get_setting(IRANPAPER_STATE_KEY) or "{}"
-    try:
-        data = json.loads(raw)
-        if isinstance(data, dict):
-            return data
-    except Exception:
-        pass
+    data = db_get_setting_json(IRANPAPER_STATE_KEY)
+    if isinstance(data, dict):
+        return data
     # پیش‌فرض: همه غیرفعال
     return {"active": {}, "primary": None}
 
@@ -2016,13 +3257,9 @@ def iranpaper_set_primary(slot: int) -> None:
 
 
 def _load_vpn_map() -> Dict[str, str]:
-    raw = db_get_setting(IRANPAPER_VPN_MAP_KEY) or "{}"
-    try:
-        data = json.loads(raw)
-        if isinstance(data, dict):
-            return {str(k): str(v) for k, v in data.items()}
-    except Exception:
-        pass
+    data = db_get_setting_json(IRANPAPER_VPN_MAP_KEY)
+    if isinstance(data, dict):
+        return {str(k): str(v) for k, v in data.items()}
     return {}
 
 
@@ -2076,6 +3313,8 @@ def iranpaper_accounts_ordered() -> List[Dict[str, Any]]:
 
 
 async def warmup_scidir_accounts() -> None:
+    from downloaders.sciencedirect import warmup_accounts
+
     await warmup_accounts(
         iranpaper_accounts_ordered(),
         cfg=CFG,
@@ -2087,17 +3326,10 @@ async def warmup_scidir_accounts() -> None:
 
 
 def _get_download_links() -> List[Dict[str, Any]]:
-    raw = db_get_setting("DOWNLOAD_LINKS") or "[]"
-    try:
-        arr = json.loads(raw)
-    except Exception:
-        return []
-    out: List[Dict[str, Any]] = []
+    arr = db_get_setting_json("DOWNLOAD_LINKS")
     if isinstance(arr, list):
-        for item in arr:
-            if isinstance(item, dict) and item.get("url"):
-                out.append(item)
-    return out
+        return [item for item in arr if isinstance(item, dict) and item.get("url")]
+    return []
 
 # =========================
 # Utility: DOI normalize + HTTP
@@ -2221,11 +3453,12 @@ async def fetch_openalex(session: aiohttp.ClientSession, doi: str) -> Tuple[Opti
                 if not isinstance(c, dict):
                     continue
                 concepts.append({
+                    "id": c.get("id", ""),
                     "display_name": c.get("display_name", ""),
                     "score": float(c.get("score", 0.0) or 0.0),
                     "level": c.get("level"),
                     "ancestors": [
-                        {"display_name": a.get("display_name",""), "level": a.get("level")}
+                        {"id": a.get("id", ""), "display_name": a.get("display_name",""), "level": a.get("level")}
                         for a in (c.get("ancestors") or []) if isinstance(a, dict)
                     ],
                 })
@@ -2258,11 +3491,12 @@ async def fetch_openalex(session: aiohttp.ClientSession, doi: str) -> Tuple[Opti
         if not isinstance(c, dict):
             continue
         concepts.append({
+            "id": c.get("id", ""),
             "display_name": c.get("display_name", ""),
             "score": float(c.get("score", 0.0) or 0.0),
             "level": c.get("level"),
             "ancestors": [
-                {"display_name": a.get("display_name",""), "level": a.get("level")}
+                {"id": a.get("id", ""), "display_name": a.get("display_name",""), "level": a.get("level")}
                 for a in (c.get("ancestors") or []) if isinstance(a, dict)
             ],
         })
@@ -2301,29 +3535,146 @@ ROOT_TO_CATEGORY: Dict[str, str] = {
     "international relations": "انسانی","geography": "انسانی",
 }
 
-def _category_from_openalex_concepts(concepts: List[Dict[str, Any]]) -> Tuple[Optional[str], Dict[str, float]]:
-    if not concepts:
-        return None, {"علوم پزشکی": 0.0, "مهندسی": 0.0, "انسانی": 0.0}
-    buckets: Dict[str, float] = {"علوم پزشکی": 0.0, "مهندسی": 0.0, "انسانی": 0.0}
-    total = 0.0
+CATEGORY_BUCKETS: Tuple[str, ...] = ("علوم پزشکی", "مهندسی", "انسانی")
+_NAME_TO_BUCKET: Dict[str, int] = {
+    name: CATEGORY_BUCKETS.index(cat) for name, cat in ROOT_TO_CATEGORY.items()
+}
+# امضای نگاشت؛ اگر ROOT_TO_CATEGORY عوض شود، ایندکس روی دیسک دور ریخته می‌شود.
+_CATEGORY_INDEX_SIG: str = hashlib.sha1(
+    json.dumps(sorted(ROOT_TO_CATEGORY.items()), ensure_ascii=False).encode("utf-8")
+).hexdigest()[:12]
+
+# concept_id (OpenAlex) → اندیس سطل (‎-1 یعنی بدون نگاشت)
+_CONCEPT_INDEX: Dict[str, int] = {}
+_CONCEPT_INDEX_LOADED = False
+_CONCEPT_INDEX_DIRTY = 0
+_CONCEPT_INDEX_FLUSH_EVERY = 64
+_CONCEPT_INDEX_LOCK = threading.Lock()
+
+
+def _concept_id(obj: Dict[str, Any]) -> str:
+    raw = str(obj.get("id") or "").strip()
+    return raw.rsplit("/", 1)[-1] if raw else ""
+
+
+def _load_concept_index() -> None:
+    global _CONCEPT_INDEX_LOADED
+    if _CONCEPT_INDEX_LOADED:
+        return
+    _CONCEPT_INDEX_LOADED = True
+    path = CFG.CATEGORY_INDEX_FILE
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return
+    except Exception as exc:
+        logger.warning("concept_index_load_failed | path=%s err=%s", path, exc)
+        return
+    if not isinstance(data, dict) or data.get("sig") != _CATEGORY_INDEX_SIG:
+        logger.info("concept_index_stale | path=%s", path)
+        return
+    index = data.get("index")
+    if isinstance(index, dict):
+        for cid, bucket in index.items():
+            with suppress(Exception):
+                _CONCEPT_INDEX[str(cid)] = int(bucket)
+    logger.info("concept_index_loaded | entries=%d", len(_CONCEPT_INDEX))
+
+
+def flush_concept_index() -> None:
+    """ایندکس concept→دسته را (در صورت تغییر) به‌صورت اتمیک روی دیسک می‌نویسد."""
+    global _CONCEPT_INDEX_DIRTY
+    with _CONCEPT_INDEX_LOCK:
+        if not _CONCEPT_INDEX_DIRTY:
+            return
+        payload = {"sig": _CATEGORY_INDEX_SIG, "index": dict(_CONCEPT_INDEX)}
+        _CONCEPT_INDEX_DIRTY = 0
+    path = CFG.CATEGORY_INDEX_FILE
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp.write_text(json.dumps(payload, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, path)
+    except Exception as exc:
+        logger.warning("concept_index_flush_failed | path=%s err=%s", path, exc)
+
+
+atexit.register(flush_concept_index)
+
+
+def _bucket_by_names(concept: Dict[str, Any]) -> Tuple[int, Optional[str]]:
+    """مسیر کند: زنجیرهٔ اجداد + نام خود concept را با ROOT_TO_CATEGORY تطبیق می‌دهد."""
+    for a in (concept.get("ancestors") or []):
+        if not isinstance(a, dict):
+            continue
+        name = str(a.get("display_name", "")).strip()
+        idx = _NAME_TO_BUCKET.get(name.lower())
+        if idx is not None:
+            return idx, name
+    name = str(concept.get("display_name", "")).strip()
+    idx = _NAME_TO_BUCKET.get(name.lower())
+    if idx is not None:
+        return idx, name
+    return -1, None
+
+
+def _concept_bucket(concept: Dict[str, Any]) -> int:
+    """اندیس سطل یک concept؛ بر اساس شناسهٔ OpenAlex کش می‌شود."""
+    global _CONCEPT_INDEX_DIRTY
+    cid = _concept_id(concept)
+    if not cid:
+        return _bucket_by_names(concept)[0]
+    if not _CONCEPT_INDEX_LOADED:
+        with _CONCEPT_INDEX_LOCK:
+            _load_concept_index()
+    idx = _CONCEPT_INDEX.get(cid)
+    if idx is not None:
+        return idx
+    idx = _bucket_by_names(concept)[0]
+    with _CONCEPT_INDEX_LOCK:
+        _CONCEPT_INDEX[cid] = idx
+        # اجدادی که خودشان ریشهٔ نگاشت‌اند هم ایندکس می‌شوند
+        for a in (concept.get("ancestors") or []):
+            if not isinstance(a, dict):
+                continue
+            aid = _concept_id(a)
+            if aid and aid not in _CONCEPT_INDEX:
+                a_idx = _NAME_TO_BUCKET.get(str(a.get("display_name", "")).strip().lower())
+                if a_idx is not None:
+                    _CONCEPT_INDEX[aid] = a_idx
+        _CONCEPT_INDEX_DIRTY += 1
+        should_flush = _CONCEPT_INDEX_DIRTY >= _CONCEPT_INDEX_FLUSH_EVERY
+    if should_flush:
+        flush_concept_index()
+    return idx
+
+
+def _score_concept_buckets(concepts: List[Dict[str, Any]]) -> Tuple[List[float], int]:
+    """یک پیمایش: امتیاز هر سطل و تعداد conceptهای نگاشت‌شده."""
+    scores = [0.0] * len(CATEGORY_BUCKETS)
+    matched = 0
     for c in concepts:
         score = float(c.get("score") or 0.0)
         if score <= 0:
             continue
-        names = [str(a.get("display_name", "")).lower() for a in (c.get("ancestors") or [])]
-        names.append(str(c.get("display_name", "")).lower())
-        for name in names:
-            cat = ROOT_TO_CATEGORY.get(name)
-            if cat:
-                buckets[cat] += score
-                total += score
-                break
+        idx = _concept_bucket(c)
+        if idx >= 0:
+            scores[idx] += score
+            matched += 1
+    return scores, matched
+
+
+def _category_from_openalex_concepts(concepts: List[Dict[str, Any]]) -> Tuple[Optional[str], Dict[str, float]]:
+    if not concepts:
+        return None, dict.fromkeys(CATEGORY_BUCKETS, 0.0)
+    scores, _matched = _score_concept_buckets(concepts)
+    buckets = dict(zip(CATEGORY_BUCKETS, scores))
+    total = sum(scores)
     if total <= 0:
         return None, buckets
-    best_cat, best_val = max(buckets.items(), key=lambda kv: kv[1])
-    share = best_val / total
-    if share >= CFG.CATEGORY_MIN_SHARE:
-        return best_cat, buckets
+    best = max(range(len(scores)), key=scores.__getitem__)
+    if scores[best] / total >= CFG.CATEGORY_MIN_SHARE:
+        return CATEGORY_BUCKETS[best], buckets
     return None, buckets
 
 # =========================
@@ -2337,17 +3688,13 @@ def _category_diagnostics_payload(
     buckets_input: Optional[Dict[str, float]] = None,
 ) -> Dict[str, Any]:
     rows = []
-    buckets = {"علوم پزشکی": 0.0, "مهندسی": 0.0, "انسانی": 0.0}
+    buckets = dict.fromkeys(CATEGORY_BUCKETS, 0.0)
     total_mapped = 0.0
     matched_count = 0
 
     for c in concepts:
         disp = (c.get("display_name") or "").strip()
         score = float(c.get("score") or 0.0)
-        level = c.get("level")
-        anc_list = [str(a.get("display_name","")).strip() for a in (c.get("ancestors") or []) if isinstance(a, dict)]
-        names_chain = [*anc_list, disp]
-
         matched_cat = None
         matched_by = None
         reason = None
@@ -2355,26 +3702,22 @@ def _category_diagnostics_payload(
         if score <= 0:
             reason = "nonpositive_score"
         else:
-            for nm in names_chain:
-                key = nm.lower().strip()
-                if not key:
-                    continue
-                cat = ROOT_TO_CATEGORY.get(key)
-                if cat:
-                    matched_cat = cat
-                    matched_by = nm
-                    buckets[cat] += score
-                    total_mapped += score
-                    matched_count += 1
-                    break
-            if not matched_cat:
+            idx = _concept_bucket(c)
+            if idx >= 0:
+                matched_cat = CATEGORY_BUCKETS[idx]
+                buckets[matched_cat] += score
+                total_mapped += score
+                matched_count += 1
+                if CFG.LOG_CONCEPT_ROWS:
+                    matched_by = _bucket_by_names(c)[1]
+            else:
                 reason = "no_mapping_for_names"
 
-        row = {"name": disp, "score": score, "level": level, "ancestors": anc_list,
-               "matched": bool(matched_cat), "matched_cat": matched_cat, "matched_by": matched_by,
-               "skip_reason": reason}
         if CFG.LOG_CONCEPT_ROWS:
-            rows.append(row)
+            anc_list = [str(a.get("display_name", "")).strip() for a in (c.get("ancestors") or []) if isinstance(a, dict)]
+            rows.append({"name": disp, "score": score, "level": c.get("level"), "ancestors": anc_list,
+                         "matched": bool(matched_cat), "matched_cat": matched_cat, "matched_by": matched_by,
+                         "skip_reason": reason})
 
     if buckets_input:
         for k, v in buckets_input.items():
@@ -2416,14 +3759,24 @@ def log_category_debug(
     chosen_category: Optional[str],
     buckets: Dict[str, float],
 ) -> None:
-    payload = _category_diagnostics_payload(doi, title, year, concepts, buckets_input=buckets or {})
+    buckets = buckets or dict.fromkeys(CATEGORY_BUCKETS, 0.0)
+    scores, matched = _score_concept_buckets(concepts)
+    total = sum(scores)
+    best_cat, best_val = max(buckets.items(), key=lambda kv: kv[1]) if buckets else (None, 0.0)
     logger.info(
         "cat| doi=%s decided=%s best=%s share=%.3f totals=%s mapped=%d/%d",
-        doi, payload["decided_category"], payload["best_cat"], payload["best_share"],
-        {k: round(v, 3) for k, v in payload["buckets"].items()},
-        payload["matched_concepts"], payload["total_concepts"],
+        doi, chosen_category or "نامشخص", best_cat if total > 0 else None,
+        (best_val / total) if total > 0 else 0.0,
+        {k: round(v, 3) for k, v in buckets.items()},
+        matched, len(concepts),
     )
+    # payload کامل فقط وقتی ساخته می‌شود که واقعاً لاگ شود (نمونه‌برداری‌شده)
+    if not catlog.isEnabledFor(logging.DEBUG):
+        return
+    if CFG.CATEGORY_LOG_SAMPLE < 1.0 and random.random() >= CFG.CATEGORY_LOG_SAMPLE:
+        return
     try:
+        payload = _category_diagnostics_payload(doi, title, year, concepts, buckets_input=buckets)
         catlog.debug(json.dumps(payload, ensure_ascii=False))
     except Exception as e:
         logger.warning("category_log_json_failed: %s", e)
@@ -2465,10 +3818,11 @@ def _normalize_ai_label(lab: str) -> Optional[str]:
     return None
 
 async def _ai_classify_via_groq_title(title: Optional[str]) -> Tuple[Optional[str], float, str]:
-    if not _HAS_GROQ or not CFG.GROQ_API_KEY:
+    groq = _lazy_import("groq", optional=True) if CFG.GROQ_API_KEY else None
+    if groq is None:
         return None, 0.0, "groq_unavailable"
 
-    client = AsyncGroq(api_key=CFG.GROQ_API_KEY)
+    client = groq.AsyncGroq(api_key=CFG.GROQ_API_KEY)
     model_main = CFG.GROQ_MODEL or "llama-3.3-70b-versatile"
     model_fb = "llama-3.1-8b-instant"
 
@@ -2557,11 +3911,12 @@ async def ai_classify_category_from_title(title: Optional[str]) -> Tuple[Optiona
 
 
 def groq_health_check_sync() -> None:
-    if not _HAS_GROQ or not CFG.GROQ_API_KEY:
-        logger.info("groq_health_skip | has_groq=%s", _HAS_GROQ)
+    groq = _lazy_import("groq", optional=True) if CFG.GROQ_API_KEY else None
+    if groq is None:
+        logger.info("groq_health_skip | has_groq=%s", _has_module("groq"))
         return
     try:
-        client = Groq(api_key=CFG.GROQ_API_KEY)
+        client = groq.Groq(api_key=CFG.GROQ_API_KEY)
         models = client.models.list()
         ids = [m.id for m in getattr(models, "data", [])]
         logger.info("groq_models | count=%d sample=%s", len(ids), ids[:8])
@@ -2579,10 +3934,8 @@ _DEFAULT_SCIHUB_REGEX = (
     r'onclick=["\'][^"\']*location\.href=["\']([^"\']+?\.pdf)[^"\']*["\']'
 )
 
-def _dynamic_scihub_providers() -> List[Dict[str, Any]]:
-    """لینک‌هایی که ادمین در ربات ذخیره کرده است → provider."""
-    raw = db_get_setting("SCI_HUB_LINKS") or ""
-    urls = [u.strip() for u in raw.splitlines() if u.strip()]
+def _parse_scihub_providers(raw: Optional[str]) -> List[Dict[str, Any]]:
+    urls = [u.strip() for u in (raw or "").splitlines() if u.strip()]
     out: List[Dict[str, Any]] = []
     for i, base in enumerate(urls, start=1):
         if not base.lower().startswith("http"):
@@ -2598,6 +3951,11 @@ def _dynamic_scihub_providers() -> List[Dict[str, Any]]:
     return out
 
 
+def _dynamic_scihub_providers() -> List[Dict[str, Any]]:
+    """لینک‌هایی که ادمین در ربات ذخیره کرده است → provider."""
+    return db_get_setting_parsed("SCI_HUB_LINKS", _parse_scihub_providers)
+
+
 def _parse_providers(json_str: str, *, source: str) -> List[Dict[str, Any]]:
     """Parse providers JSON از .env (فقط موارد «قانونی»)."""
     try:
@@ -2914,7 +4272,54 @@ def _resolve_wdm_arch() -> str:
     return machine or "x64"
 
 
-def _build_chrome_driver(proxy_url: Optional[str] = None) -> webdriver.Chrome:
+_PROFILE_TEMPLATES: Optional[Any] = None
+
+
+def _profile_templates() -> Any:
+    global _PROFILE_TEMPLATES
+    if _PROFILE_TEMPLATES is None:
+        from utils.chrome_bootstrap import ProfileTemplates
+
+        _PROFILE_TEMPLATES = ProfileTemplates(
+            CFG.CHROME_PROFILE_ROOT, max_age_s=CFG.CHROME_PROFILE_TEMPLATE_MAX_AGE_H * 3600
+        )
+    return _PROFILE_TEMPLATES
+
+
+def _resolve_chromedriver(patch_uc: bool) -> str:
+    """chromedriver کش‌شده روی دیسک (یک‌بار resolve/patch برای هر نسخهٔ Chrome)."""
+    from utils.chrome_bootstrap import resolve_driver
+
+    os.environ["WDM_ARCH"] = _resolve_wdm_arch()
+    return resolve_driver(
+        CFG.CHROME_DRIVER_CACHE_DIR,
+        source_path=CFG.CHROMEDRIVER_PATH.strip(),
+        patch_uc=patch_uc,
+        install=lambda: _lazy_import("webdriver_manager.chrome").ChromeDriverManager().install(),
+    )
+
+
+def warm_chrome_bootstrap() -> None:
+    """
+    کارهای سرد مرورگر را از مسیر بحرانی بیرون می‌برد: chromedriver را resolve/patch می‌کند و
+    اگر template پروفایل وجود ندارد یا کهنه است، آن را با یک درایور گرم می‌سازد. (برای اجرا در thread پس‌زمینه)
+    """
+    use_uc = bool(CFG.USE_UNDETECTED and _has_module("undetected_chromedriver"))
+    try:
+        _resolve_chromedriver(use_uc)
+    except Exception as exc:
+        logger.warning("chromedriver_resolve_failed | err=%s", exc)
+        return
+    if CFG.CHROME_PROFILE_TEMPLATES and not CFG.CHROME_PROFILE_DIR:
+        urls = [u.strip() for u in (CFG.CHROME_WARM_URLS or "").split(",") if u.strip()]
+        _profile_templates().build(lambda profile_dir: _build_chrome_driver(profile_dir=profile_dir), urls)
+
+
+def _build_chrome_driver(proxy_url: Optional[str] = None, *, profile_dir: Optional[str] = None) -> webdriver.Chrome:
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.chrome.service import Service
+
     opts = Options()
     if CFG.CHROME_HEADLESS:
         opts.add_argument("--headless=new")
@@ -2925,8 +4330,13 @@ def _build_chrome_driver(proxy_url: Optional[str] = None) -> webdriver.Chrome:
     opts.add_argument("--start-maximized")
 
     # ↓↓↓ مهم: پروفایل واقعی + ضد شناسایی
-    if CFG.CHROME_PROFILE_DIR:
-        opts.add_argument(f"--user-data-dir={CFG.CHROME_PROFILE_DIR}")
+    # ترتیب: پروفایل صریح (ساخت template)، CHROME_PROFILE_DIR، و در غیر این صورت کپی از template گرم‌شده
+    if not profile_dir:
+        profile_dir = CFG.CHROME_PROFILE_DIR or None
+    if not profile_dir and CFG.CHROME_PROFILE_TEMPLATES:
+        profile_dir = _profile_templates().clone()
+    if profile_dir:
+        opts.add_argument(f"--user-data-dir={profile_dir}")
         opts.add_argument("--profile-directory=Default")
 
     #opts.add_experimental_option("excludeSwitches", ["enable-automation"])
@@ -2936,25 +4346,24 @@ def _build_chrome_driver(proxy_url: Optional[str] = None) -> webdriver.Chrome:
     if proxy_url:
         opts.add_argument(f"--proxy-server={proxy_url}")
 
-    use_uc = bool(CFG.USE_UNDETECTED and _HAS_UC)
-    if CFG.USE_UNDETECTED and not _HAS_UC:
+    uc = _lazy_import("undetected_chromedriver", optional=True) if CFG.USE_UNDETECTED else None
+    use_uc = uc is not None
+    if CFG.USE_UNDETECTED and not use_uc:
         logger.warning("undetected_chromedriver not available; falling back to standard chromedriver")
 
-    os.environ["WDM_ARCH"] = _resolve_wdm_arch()
-
-    driver_path = CFG.CHROMEDRIVER_PATH.strip()
-    if driver_path:
-        _LOGGER = logging.getLogger("doi_bot.selenium")
-        _LOGGER.info("Using chromedriver from CHROMEDRIVER_PATH=%s", driver_path)
-        if use_uc:
-            return uc.Chrome(driver_executable_path=driver_path, options=opts)
-        return webdriver.Chrome(service=Service(driver_path), options=opts)
-
-    drv_path = ChromeDriverManager().install()
+    try:
+        driver_path = _resolve_chromedriver(use_uc)
+    except Exception as exc:
+        logger.warning("chromedriver_resolve_failed | err=%s", exc)
+        driver_path = CFG.CHROMEDRIVER_PATH.strip()
+        if not driver_path and not use_uc:
+            raise
 
     if use_uc:
+        if driver_path:
+            return uc.Chrome(driver_executable_path=driver_path, options=opts)
         return uc.Chrome(options=opts)
-    return webdriver.Chrome(service=Service(drv_path), options=opts)
+    return webdriver.Chrome(service=Service(driver_path), options=opts)
 
 def _get_scihub_driver() -> webdriver.Chrome:
     global _SCIHUB_DRIVER
@@ -2979,7 +4388,7 @@ class ScihubNoResultError(RuntimeError):
 
 def _scihub_no_result_banner(driver: webdriver.Chrome) -> bool:
     try:
-        body = driver.find_element(By.TAG_NAME, "body")
+        body = driver.find_element("tag name", "body")
         text = (body.text or "").lower()
     except Exception:
         return False
@@ -2993,6 +4402,11 @@ def _scihub_no_result_banner(driver: webdriver.Chrome) -> bool:
 
 def _selenium_extract_pdf_url(doi: str) -> str:
     """کروم را اجرا می‌کند و لینک PDF داخل iframe را برمی‌گرداند."""
+    from selenium.common.exceptions import TimeoutException
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.support.ui import WebDriverWait
+
     driver = _get_scihub_driver()
     logger.info("selenium_starting | doi=%s", doi)
 
@@ -3034,6 +4448,8 @@ async def download_via_sciencedirect(
     chat_id: int,
     force: bool = False,
 ) -> Optional[Path]:
+    from downloaders.sciencedirect import download_via_sciencedirect as scidir_download
+
     accounts = iranpaper_accounts_ordered()
     return await scidir_download(
         session,
@@ -3162,7 +4578,7 @@ async def process_single_doi(session: aiohttp.ClientSession, user_id: int, doi_r
                         oa_pdf_url = extracted
             if not oa_pdf_url:
                 # استفاده از ایمیل کاربر اگه تنظیم شده، وگرنه POLITE_CONTACT
-                user = db_get_user(user_id)
+                user = await db_run(db_get_user, user_id)
                 email = user.get("email") or CFG.POLITE_CONTACT
                 oa_pdf_url = await fetch_unpaywall_pdf_link(session, doi, email)
             if not oa_pdf_url:
@@ -3181,7 +4597,7 @@ async def process_single_doi(session: aiohttp.ClientSession, user_id: int, doi_r
             logger.debug("oa_pdf_detect_failed | doi=%s err=%s", doi, e)
 
         status = "ok" if (title or year) else "not_found"
-        db_upsert_meta(user_id, doi, title=title, year=year, category=category, source=source, status=status, error=None)
+        queue_upsert_meta(user_id, doi, title=title, year=year, category=category, source=source, status=status, error=None)
         return {
             "doi": doi,
             "title": title,
@@ -3194,7 +4610,7 @@ async def process_single_doi(session: aiohttp.ClientSession, user_id: int, doi_r
         }
 
     except Exception as e:
-        db_upsert_meta(user_id, doi, title=None, year=None, category=None, source="none", status="error", error=str(e)[:300])
+        queue_upsert_meta(user_id, doi, title=None, year=None, category=None, source="none", status="error", error=str(e)[:300])
         return {
             "doi": doi,
             "title": None,
@@ -3252,7 +4668,7 @@ async def process_single_doi_oa_only(session: aiohttp.ClientSession, user_id: in
                     if extracted:
                         oa_pdf_url = extracted
             if not oa_pdf_url:
-                user = db_get_user(user_id)
+                user = await db_run(db_get_user, user_id)
                 email = user.get("email") or CFG.POLITE_CONTACT
                 oa_pdf_url = await fetch_unpaywall_pdf_link(session, doi, email)
             if not oa_pdf_url:
@@ -3261,7 +4677,7 @@ async def process_single_doi_oa_only(session: aiohttp.ClientSession, user_id: in
             logger.debug("oa_only_pdf_detect_failed | doi=%s err=%s", doi, e)
 
         status = "ok" if (title or year) else "not_found"
-        db_upsert_meta(user_id, doi, title=title, year=year, category=category, source=source, status=status, error=None)
+        queue_upsert_meta(user_id, doi, title=title, year=year, category=category, source=source, status=status, error=None)
         return {
             "doi": doi,
             "title": title,
@@ -3274,7 +4690,7 @@ async def process_single_doi_oa_only(session: aiohttp.ClientSession, user_id: in
         }
 
     except Exception as e:
-        db_upsert_meta(user_id, doi, title=None, year=None, category=None, source="none", status="error", error=str(e)[:300])
+        queue_upsert_meta(user_id, doi, title=None, year=None, category=None, source="none", status="error", error=str(e)[:300])
         return {
             "doi": doi,
             "title": None,
@@ -3287,22 +4703,223 @@ async def process_single_doi_oa_only(session: aiohttp.ClientSession, user_id: in
         }
 
 
+# --- زمان‌بند آپلود: حداکثر UPLOAD_PER_CHAT آپلود هم‌زمان برای هر چت، سقف سراسری قابل تنظیم، فایل‌های کوچک‌تر اول
+class _UploadScheduler:
+    def __init__(self, global_cap: int, max_wait_s: float, per_chat: int = 1) -> None:
+        self.global_cap = max(1, int(global_cap))
+        # آپلود هم‌زمان در یک چت (مثلاً جلدهای یک ZIP)
+        self.per_chat = max(1, int(per_chat))
+        # بعد از این مدت انتظار، فایل بزرگ هم بدون توجه به اندازه نوبت می‌گیرد (جلوگیری از گرسنگی)
+        self.max_wait_s = max(0.0, float(max_wait_s))
+        self._active: Dict[int, int] = {}   # chat_id -> آپلودهای فعال
+        self._active_total = 0
+        self._waiters: List[Tuple[int, int, int, float, asyncio.Future]] = []  # (size, seq, chat_id, t0, fut)
+        self._seq = 0
+        self._stats: Dict[str, float] = {"uploads": 0, "failed": 0, "bytes": 0, "upload_s": 0.0, "wait_s": 0.0, "max_wait_s": 0.0}
+
+    def _next_waiter(self) -> Optional[int]:
+        now = time.monotonic()
+        best: Optional[int] = None
+        best_key: Optional[Tuple[int, int, int]] = None
+        for idx, (size, seq, chat_id, t0, fut) in enumerate(self._waiters):
+            if fut.done() or not self._chat_has_room(chat_id):
+                continue
+            aged = self.max_wait_s and (now - t0) >= self.max_wait_s
+            key = (0, seq, 0) if aged else (1, size, seq)
+            if best_key is None or key < best_key:
+                best, best_key = idx, key
+        return best
+
+    def _chat_has_room(self, chat_id: int) -> bool:
+        return self._active.get(chat_id, 0) < self.per_chat
+
+    def _acquire(self, chat_id: int) -> None:
+        self._active[chat_id] = self._active.get(chat_id, 0) + 1
+        self._active_total += 1
+
+    def _release(self, chat_id: int) -> None:
+        n = self._active.get(chat_id, 0) - 1
+        if n > 0:
+            self._active[chat_id] = n
+        else:
+            self._active.pop(chat_id, None)
+        self._active_total = max(0, self._active_total - 1)
+
+    def _grant(self) -> None:
+        self._waiters = [w for w in self._waiters if not w[4].done()]
+        while self._active_total < self.global_cap:
+            idx = self._next_waiter()
+            if idx is None:
+                return
+            _size, _seq, chat_id, _t0, fut = self._waiters.pop(idx)
+            self._acquire(chat_id)
+            fut.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, chat_id: int, size_bytes: int):
+        chat_id = int(chat_id)
+        t0 = time.monotonic()
+        if self._chat_has_room(chat_id) and self._active_total < self.global_cap and not self._waiters:
+            self._acquire(chat_id)
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            self._seq += 1
+            self._waiters.append((max(0, int(size_bytes)), self._seq, chat_id, t0, fut))
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    self._release(chat_id)
+                    self._grant()
+                raise
+        waited = time.monotonic() - t0
+        self._stats["wait_s"] += waited
+        self._stats["max_wait_s"] = max(self._stats["max_wait_s"], waited)
+        t1 = time.monotonic()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            elapsed = time.monotonic() - t1
+            self._release(chat_id)
+            if ok:
+                self._stats["uploads"] += 1
+                self._stats["bytes"] += max(0, int(size_bytes))
+                self._stats["upload_s"] += elapsed
+                logger.info(
+                    "upload_done | chat_id=%s bytes=%s secs=%.1f mbps=%.2f wait=%.1f",
+                    chat_id, size_bytes, elapsed, (size_bytes / 1e6) / elapsed if elapsed > 0 else 0.0, waited,
+                )
+            else:
+                self._stats["failed"] += 1
+            self._grant()
+
+    def stats(self) -> Dict[str, Any]:
+        s = dict(self._stats)
+        s["throughput_mbps"] = round((s["bytes"] / 1e6) / s["upload_s"], 3) if s["upload_s"] else 0.0
+        s["avg_wait_s"] = round(s["wait_s"] / s["uploads"], 2) if s["uploads"] else 0.0
+        s["active"] = self._active_total
+        s["waiting"] = sum(1 for w in self._waiters if not w[4].done())
+        return s
+
+
+UPLOADS = _UploadScheduler(CFG.UPLOAD_GLOBAL_CAP, CFG.UPLOAD_MAX_WAIT_S, CFG.UPLOAD_PER_CHAT)
+
+
+def upload_slot(chat_id: int, file_path: Path):
+    """اسلات آپلود برای ارسال فایل به یک چت (اندازهٔ فایل برای اولویت‌دهی)."""
+    try:
+        size = Path(file_path).stat().st_size
+    except OSError:
+        size = 0
+    return UPLOADS.slot(chat_id, size)
+
+
+def upload_stats() -> Dict[str, Any]:
+    return UPLOADS.stats()
+
+
+# --- Bot API محلی
+def _bot_api_urls() -> Tuple[str, str]:
+    """(base_url, base_file_url) برای ApplicationBuilder؛ توکن را خود PTB به انتهای آن اضافه می‌کند."""
+    base = CFG.TELEGRAM_BOT_API_URL
+    if "{token}" not in base and not base.endswith("/bot"):
+        base += "/bot"
+    file_url = CFG.TELEGRAM_BOT_API_FILE_URL
+    if not file_url:
+        file_url = base[: -len("/bot")] + "/file/bot" if base.endswith("/bot") else base.replace("/bot{token}", "/file/bot{token}")
+    return base, file_url
+
+
+def configure_bot_api(builder):
+    """
+    ApplicationBuilder را به Bot API محلی وصل می‌کند (اگر TELEGRAM_BOT_API_URL تنظیم نشده باشد بدون تغییر).
+    در حالت local، send_document مسیر فایل (file://) را می‌فرستد و سرور مستقیماً از دیسک می‌خواند.
+    """
+    if not CFG.TELEGRAM_BOT_API_URL:
+        return builder
+    base, file_url = _bot_api_urls()
+    logger.info("bot_api_custom | base=%s local=%s", base.split("{")[0], CFG.TELEGRAM_BOT_API_LOCAL)
+    return builder.base_url(base).base_file_url(file_url).local_mode(CFG.TELEGRAM_BOT_API_LOCAL)
+
+
+def chat_serial_update_processor(max_concurrent: int):
+    """
+    پردازشگر آپدیت PTB: تا max_concurrent آپدیت هم‌زمان بین چت‌های مختلف، ولی ترتیبی درون هر چت.
+    ConversationHandler و user_data (مثل doi_buffer) با پردازش موازی آپدیت‌های یک چت سازگار نیستند.
+    قفل چت قبل از semaphore گرفته می‌شود تا آپدیت‌های منتظر یک چت جای چت‌های دیگر را نگیرند.
+    """
+    from telegram.ext import BaseUpdateProcessor
+
+    class _ChatSerialUpdateProcessor(BaseUpdateProcessor):
+        def __init__(self, max_concurrent_updates: int) -> None:
+            super().__init__(max_concurrent_updates)
+            self._locks: Dict[int, List[Any]] = {}   # chat_id -> [Lock, تعداد منتظرها]
+
+        async def process_update(self, update, coroutine) -> None:
+            chat = getattr(update, "effective_chat", None)
+            if chat is None:
+                await super().process_update(update, coroutine)
+                return
+            entry = self._locks.setdefault(chat.id, [asyncio.Lock(), 0])
+            entry[1] += 1
+            try:
+                async with entry[0]:
+                    await super().process_update(update, coroutine)
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    self._locks.pop(chat.id, None)
+
+        async def do_process_update(self, update, coroutine) -> None:
+            await coroutine
+
+        async def initialize(self) -> None:
+            pass
+
+        async def shutdown(self) -> None:
+            pass
+
+    return _ChatSerialUpdateProcessor(max(1, int(max_concurrent)))
+
+
+@contextmanager
+def document_input(file_path: Path):
+    """ورودی document برای send_document: در Bot API محلی خود مسیر فایل (بدون عبور بایت‌ها از پردازه)، وگرنه فایل باز."""
+    if CFG.TELEGRAM_BOT_API_LOCAL:
+        yield Path(file_path).resolve()
+        return
+    with open(file_path, "rb") as f:
+        yield f
+
+
 # --- ارسال سند با retry نمایی
-SEND_SEM = asyncio.Semaphore(1)
+def upload_size_allowed(file_path: Path) -> bool:
+    """آیا حجم فایل زیر سقف send_document در Bot API است؟ (فایل بزرگ‌تر با retry هم ارسال نمی‌شود)"""
+    try:
+        return Path(file_path).stat().st_size <= CFG.TELEGRAM_UPLOAD_MAX_MB * 1024 * 1024
+    except OSError:
+        return False
+
 
 async def _send_document_with_retry(bot, chat_id: int, file_path: Path, caption: str, *, tries: int = 3, timeout: int = 180) -> bool:
+    if not upload_size_allowed(file_path):
+        logger.warning("send_document_too_large | file=%s cap_mb=%s", os.path.basename(file_path), CFG.TELEGRAM_UPLOAD_MAX_MB)
+        return False
     for i in range(1, tries + 1):
         try:
-            await bot.send_chat_action(chat_id=chat_id, action="upload_document")
-            with open(file_path, "rb") as f:
-                await bot.send_document(
-                    chat_id,
-                    document=f,
-                    filename=os.path.basename(file_path),
-                    caption=caption,
-                    read_timeout=timeout,
-                    parse_mode=PARSE_HTML if PARSE_HTML else None
-                )
+            async with upload_slot(chat_id, file_path):
+                await bot.send_chat_action(chat_id=chat_id, action="upload_document")
+                with document_input(file_path) as doc:
+                    await bot.send_document(
+                        chat_id,
+                        document=doc,
+                        filename=os.path.basename(file_path),
+                        caption=caption,
+                        read_timeout=timeout,
+                        parse_mode=PARSE_HTML if PARSE_HTML else None
+                    )
             return True
         except Exception as e:
             wait = 2 ** i  # 2,4,8
@@ -3335,295 +4952,787 @@ def _summary_font_path() -> Path:
         return preferred
     return fallback
 
-async def process_dois_batch(user_id: int, dois: List[str], chat_id: int, bot) -> None:
-    """پردازش یک‌جای DOIها: متادیتا + تعیین دسته + کشف OA + دانلود/ارسال PDF."""
-    sem = asyncio.Semaphore(CFG.MAX_CONCURRENCY)
+# --- زمان‌بند سراسری منصفانه برای مراحل پردازش DOI
+SCHED_LANES: Final[Tuple[str, ...]] = ("premium", "normal")
 
-    # User-Agent مودبانه
-    ua = "doi-bot/1.0"
-    if _valid_email(CFG.POLITE_CONTACT):
-        ua += f" (+mailto:{CFG.POLITE_CONTACT})"
-    headers = {"User-Agent": ua}
-
-    async with aiohttp.ClientSession(headers=headers) as session:
-        async def run_with_limit(d):
-            async with sem:
-                return await process_single_doi(session, user_id, d)
-
-        # اجرای موازی پردازش متادیتا/کشف OA
-        tasks = [asyncio.create_task(run_with_limit(d)) for d in dois]
-        results: List[Dict[str, Any]] = []
-        for t in asyncio.as_completed(tasks):
-            r = await t
-            results.append(r)
-
-        # خلاصهٔ نتایج
-        ok = [r for r in results if r["status"] == "ok"]
-        not_found = [r for r in results if r["status"] == "not_found"]
-        errors = [r for r in results if r["status"] == "error"]
-
-        def _short_title(t: Optional[str]) -> str:
-            if not t:
-                return "—"
-            t = re.sub(r"\s+", " ", t).strip()
-            return (t[:70] + "…") if len(t) > 72 else t
-
-        lines = []
-        for r in ok[:10]:
-            lines.append(f"• {r['year'] or '—'} | {r['category']} | {_short_title(r['title'])}")
-        extra = ""
-        if len(ok) > 10:
-            extra = f"\n… و {len(ok) - 10} مورد دیگر"
-
-        summary = (
-            "📊 <b>نتیجهٔ پردازش DOIها</b>\n"
-            f"کل: <b>{len(results)}</b> | موفق: <b>{len(ok)}</b> | نامشخص: <b>{len(not_found)}</b> | خطا: <b>{len(errors)}</b>\n\n"
-            + ("\n".join(lines) if lines else "موردی برای نمایش نیست.")
-            + extra
-            + ("\n\nℹ️ نتیجهٔ کامل در سیستم ذخیره شد.")
-        )
-        try:
-            await bot.send_message(chat_id, summary, parse_mode=PARSE_HTML if PARSE_HTML else None)
-        except Exception as e:
-            logger.warning("failed to send summary: %s", e)
-
-        # دانلودها و بسته‌بندی ZIP + PDF فهرست
-        activation = is_activation_on()
-        entries: List[Dict[str, Any]] = []
-        font_path = _summary_font_path()
-        zip_path = CFG.DOWNLOAD_LINK_DIR / f"downloads_{int(time.time())}.zip"
-
-        for r in results:
-            doi = r["doi"]
-            year = r.get("year")
-            title = r.get("title") or doi
-            fpath: Optional[Path] = None
-            cost_label = "نامشخص"
-            status_label = "دانلود نشده"
-
-            if r["status"] != "ok":
-                status_label = "دانلود نشده (متادیتا ناقص)"
-            elif not activation:
-                status_label = "دانلود نشده (غیرفعال)"
-            else:
-                oa_pdf_url = r.get("oa_pdf_url")
-                if oa_pdf_url:
-                    fpath = await download_pdf_to_tmp(session, oa_pdf_url, hint=doi.replace("/", "_"))
-                    cost_label = "رایگان"
-                    status_label = "دانلود موفق" if fpath else "دانلود ناموفق"
-
-                if not fpath:
-                    fpath = await try_download_via_providers(session, doi, year)
-                    if fpath:
-                        cost_label = "رایگان"
-                        status_label = "دانلود موفق"
-
-                if not fpath and (year or 0) >= 2022:
-                    fpath = await download_via_sciencedirect(
-                        session,
-                        doi,
-                        title,
-                        r.get("abstract"),
-                        r.get("journal"),
-                        bot=bot,
-                        chat_id=chat_id,
-                        force=False,
-                    )
-                    if fpath:
-                        cost_label = "هزینه‌دار"
-                        status_label = "دانلود موفق"
 
-                if not fpath:
-                    try:
-                        fpath = await download_pdf_with_selenium(doi)
-                    except ScihubNoResultError:
-                        fpath = None
-                        logger.info("scihub_no_result_detected | doi=%s", doi)
-                    if fpath:
-                        cost_label = "رایگان"
-                        status_label = "دانلود موفق"
-
-            fname = fpath.name if fpath else "—"
-            entries.append({
-                "doi": doi,
-                "title": title,
-                "year": year or "—",
-                "filename": fname,
-                "file_path": str(fpath) if fpath else None,
-                "cost": cost_label,
-                "status": status_label,
-            })
+class _FairScheduler:
+    """
+    سقف هم‌زمانی سراسری برای هر مرحله (metadata/download/package) در کل پردازه.
+    بین laneها (پریمیوم/معمولی) با weighted round-robin و داخل هر lane بین کاربران
+    به‌صورت نوبتی (هر کاربر یک نوبت در هر دور) اسلات می‌دهد تا کاربر با ۲۰۰ DOI
+    کاربر با ۲ DOI را گرسنه نگذارد.
+    """
 
-        try:
-            zip_file = build_zip_with_summary(entries, zip_path, font_path)
-        except Exception as e:
-            logger.warning("zip_build_failed | err=%s", e)
-            zip_file = None
-
-        if zip_file and zip_file.exists():
-            link = None
-            token = None
-            if CFG.DOWNLOAD_BOT_USERNAME:
-                token = db_create_download_link(user_id, str(zip_file), zip_file.name)
-                link = _download_bot_deeplink(token) if token else None
-            if link:
-                try:
-                    await bot.send_message(
-                        chat_id,
-                        f"Download link (start the download bot):\n{link}",
-                        parse_mode=PARSE_HTML if PARSE_HTML else None,
-                        reply_markup=_download_link_done_kb(),
-                    )
-                except Exception as e:
-                    logger.warning("download_link_send_failed | err=%s", e)
-                    link = None
-            if not link:
-                if token:
-                    db_delete_download_link(token)
-                try:
-                    async with SEND_SEM:
-                        await bot.send_chat_action(chat_id=chat_id, action="upload_document")
-                        with open(zip_file, "rb") as f:
-                            await bot.send_document(
-                                chat_id,
-                                document=f,
-                                filename=zip_file.name,
-                                caption="بستهٔ دانلود شده + فهرست",
-                                read_timeout=240,
-                            )
-                except Exception as e:
-                    logger.warning("zip_send_failed | err=%s", e)
-                finally:
-                    with suppress(Exception):
-                        zip_file.unlink()
+    def __init__(self, caps: Dict[str, int], weights: Dict[str, int]) -> None:
+        self._caps = {stage: max(1, int(n)) for stage, n in caps.items()}
+        self._weights = {lane: max(1, int(weights.get(lane, 1))) for lane in SCHED_LANES}
+        self._busy: Dict[str, int] = {stage: 0 for stage in self._caps}
+        # stage -> lane -> user_id -> صف futureها (ترتیب dict = نوبت کاربران)
+        self._waiters: Dict[str, Dict[str, Dict[int, List[asyncio.Future]]]] = {
+            stage: {lane: {} for lane in SCHED_LANES} for stage in self._caps
+        }
+        self._credit: Dict[str, Dict[str, int]] = {stage: {lane: 0 for lane in SCHED_LANES} for stage in self._caps}
+        self._stats: Dict[str, Dict[str, float]] = {stage: {"granted": 0, "queued": 0, "wait_s": 0.0} for stage in self._caps}
+
+    def _has_waiters(self, stage: str) -> bool:
+        return any(self._waiters[stage][lane] for lane in SCHED_LANES)
+
+    @staticmethod
+    def _pick_lane(waiters: Dict[str, Dict[int, List[Any]]], credit: Dict[str, int], weights: Dict[str, int]) -> Optional[str]:
+        # smooth weighted round-robin بین laneهای غیرخالی
+        lanes = [lane for lane in SCHED_LANES if waiters[lane]]
+        if not lanes:
+            return None
+        total = sum(weights[lane] for lane in lanes)
+        for lane in lanes:
+            credit[lane] += weights[lane]
+        chosen = max(lanes, key=lambda lane: credit[lane])
+        credit[chosen] -= total
+        return chosen
+
+    @staticmethod
+    def _pop_user_turn(users: Dict[int, List[Any]]) -> Tuple[int, Any]:
+        uid = next(iter(users))
+        queue = users.pop(uid)
+        item = queue.pop(0)
+        if queue:
+            users[uid] = queue  # انتهای نوبت
+        return uid, item
+
+    def _grant(self, stage: str) -> None:
+        waiters = self._waiters[stage]
+        while self._busy[stage] < self._caps[stage]:
+            lane = self._pick_lane(waiters, self._credit[stage], self._weights)
+            if lane is None:
+                return
+            _uid, fut = self._pop_user_turn(waiters[lane])
+            if fut.done():
+                continue
+            self._busy[stage] += 1
+            fut.set_result(None)
+
+    def _release(self, stage: str) -> None:
+        self._busy[stage] = max(0, self._busy[stage] - 1)
+        self._grant(stage)
+
+    def _discard(self, stage: str, lane: str, user_id: int, fut: asyncio.Future) -> None:
+        users = self._waiters[stage][lane]
+        queue = users.get(user_id)
+        if queue and fut in queue:
+            queue.remove(fut)
+            if not queue:
+                users.pop(user_id, None)
+
+    def position(self, stage: str, user_id: int) -> int:
+        """چند اسلات قبل از اولین درخواست منتظر این کاربر داده می‌شود (۰ یعنی منتظر نیست)."""
+        waiters = {lane: {u: list(q) for u, q in self._waiters[stage][lane].items()} for lane in SCHED_LANES}
+        if not any(int(user_id) in waiters[lane] for lane in SCHED_LANES):
+            return 0
+        credit = dict(self._credit[stage])
+        ahead = 0
+        while True:
+            lane = self._pick_lane(waiters, credit, self._weights)
+            if lane is None:
+                return 0
+            uid, _fut = self._pop_user_turn(waiters[lane])
+            ahead += 1
+            if uid == int(user_id):
+                return ahead
+
+    @asynccontextmanager
+    async def slot(self, stage: str, user_id: int, lane: str = "normal",
+                   on_queued: Optional[Callable[[int], None]] = None):
+        lane = lane if lane in SCHED_LANES else "normal"
+        if self._busy[stage] < self._caps[stage] and not self._has_waiters(stage):
+            self._busy[stage] += 1
         else:
-            await bot.send_message(chat_id, "❗️ ساخت بستهٔ دانلود/فهرست انجام نشد.", parse_mode=PARSE_HTML if PARSE_HTML else None)
-        for item in entries:
-            fp = item.get("file_path")
-            if fp:
+            fut = asyncio.get_running_loop().create_future()
+            self._waiters[stage][lane].setdefault(int(user_id), []).append(fut)
+            self._stats[stage]["queued"] += 1
+            if on_queued:
                 with suppress(Exception):
-                    Path(fp).unlink()
+                    on_queued(self.position(stage, user_id))
+            t0 = time.monotonic()
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    self._release(stage)
+                else:
+                    self._discard(stage, lane, int(user_id), fut)
+                raise
+            self._stats[stage]["wait_s"] += time.monotonic() - t0
+        self._stats[stage]["granted"] += 1
+        try:
+            yield
+        finally:
+            self._release(stage)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        out: Dict[str, Dict[str, Any]] = {}
+        for stage, cap in self._caps.items():
+            waiting = {lane: sum(len(q) for q in self._waiters[stage][lane].values()) for lane in SCHED_LANES}
+            out[stage] = dict(self._stats[stage], cap=cap, busy=self._busy[stage], waiting=waiting)
+        return out
+
+
+SCHEDULER = _FairScheduler(
+    {
+        "metadata": CFG.SCHED_METADATA_SLOTS,
+        "download": CFG.SCHED_DOWNLOAD_SLOTS,
+        "package": CFG.SCHED_PACKAGE_SLOTS,
+    },
+    {"premium": CFG.SCHED_PREMIUM_WEIGHT, "normal": 1},
+)
 
 
-async def process_dois_batch_oa_only(user_id: int, dois: List[str], chat_id: int, bot) -> None:
-    """پردازش DOIها فقط برای مسیرهای Open-Access/قانونی + ارسال به تلگرام."""
-    sem = asyncio.Semaphore(CFG.MAX_CONCURRENCY)
+def user_sched_lane(user: Dict[str, Any]) -> str:
+    """lane زمان‌بند از روی پلن: پلن‌های premium_* فعال → premium."""
+    plan_type = str(user.get("plan_type") or "")
+    if plan_type.startswith("premium") and plan_is_active(user):
+        return "premium"
+    return "normal"
+
+
+def queue_position(user_id: int, stage: str = "download") -> int:
+    return SCHEDULER.position(stage, user_id)
 
+
+def scheduler_stats() -> Dict[str, Dict[str, Any]]:
+    return SCHEDULER.stats()
+
+
+def _polite_headers() -> Dict[str, str]:
+    # User-Agent مودبانه
     ua = "doi-bot/1.0"
     if _valid_email(CFG.POLITE_CONTACT):
         ua += f" (+mailto:{CFG.POLITE_CONTACT})"
-    headers = {"User-Agent": ua}
+    return {"User-Agent": ua}
 
-    async with aiohttp.ClientSession(headers=headers) as session:
-        async def run_with_limit(d):
-            async with sem:
-                return await process_single_doi_oa_only(session, user_id, d)
 
-        tasks = [asyncio.create_task(run_with_limit(d)) for d in dois]
-        results: List[Dict[str, Any]] = []
-        for t in asyncio.as_completed(tasks):
-            results.append(await t)
+def _short_title(t: Optional[str]) -> str:
+    if not t:
+        return "—"
+    t = re.sub(r"\s+", " ", t).strip()
+    return (t[:70] + "…") if len(t) > 72 else t
 
-        ok = [r for r in results if r["status"] == "ok"]
-        errors = [r for r in results if r["status"] == "error"]
 
-        summary = (
+def _batch_summary_text(results: List[Dict[str, Any]], *, oa_only: bool) -> str:
+    ok = [r for r in results if r["status"] == "ok"]
+    errors = [r for r in results if r["status"] == "error"]
+    if oa_only:
+        return (
             "📊 <b>نتیجهٔ بررسی (Open Access)</b>\n"
             f"کل: <b>{len(results)}</b> | موفق: <b>{len(ok)}</b> | خطا: <b>{len(errors)}</b>\n\n"
             "ℹ️ فقط در صورت وجود لینک Open-Access تلاش به دانلود انجام می‌شود."
         )
+    not_found = [r for r in results if r["status"] == "not_found"]
+    lines = []
+    for r in ok[:10]:
+        lines.append(f"• {r['year'] or '—'} | {r['category']} | {_short_title(r['title'])}")
+    extra = ""
+    if len(ok) > 10:
+        extra = f"\n… و {len(ok) - 10} مورد دیگر"
+    return (
+        "📊 <b>نتیجهٔ پردازش DOIها</b>\n"
+        f"کل: <b>{len(results)}</b> | موفق: <b>{len(ok)}</b> | نامشخص: <b>{len(not_found)}</b> | خطا: <b>{len(errors)}</b>\n\n"
+        + ("\n".join(lines) if lines else "موردی برای نمایش نیست.")
+        + extra
+        + ("\n\nℹ️ نتیجهٔ کامل در سیستم ذخیره شد.")
+    )
+
+
+async def _download_entry(
+    session: aiohttp.ClientSession,
+    r: Dict[str, Any],
+    *,
+    user_id: int,
+    chat_id: int,
+    bot,
+    activation: bool,
+    oa_only: bool,
+) -> Dict[str, Any]:
+    """دانلود PDF یک DOI و ساخت ردیف فهرست (مرحلهٔ downloaded)."""
+    doi = r["doi"]
+    year = r.get("year")
+    title = r.get("title") or doi
+    fpath: Optional[Path] = None
+    cost_label = "رایگان (Open Access)" if oa_only else "نامشخص"
+    status_label = "دانلود نشده"
+
+    if r["status"] != "ok":
+        status_label = "دانلود نشده (متادیتا ناقص)"
+    elif not activation:
+        status_label = "دانلود نشده (غیرفعال)"
+    elif oa_only:
+        oa_pdf_url = r.get("oa_pdf_url")
+        if oa_pdf_url:
+            fpath = await download_pdf_to_tmp(session, oa_pdf_url, hint=doi.replace("/", "_"))
+            status_label = "دانلود موفق" if fpath else "دانلود ناموفق"
+            if fpath:
+                queue_inc_used(user_id, free_inc=1)
+        else:
+            status_label = "Open Access پیدا نشد"
+    else:
+        oa_pdf_url = r.get("oa_pdf_url")
+        if oa_pdf_url:
+            fpath = await download_pdf_to_tmp(session, oa_pdf_url, hint=doi.replace("/", "_"))
+            cost_label = "رایگان"
+            status_label = "دانلود موفق" if fpath else "دانلود ناموفق"
+
+        if not fpath:
+            fpath = await try_download_via_providers(session, doi, year)
+            if fpath:
+                cost_label = "رایگان"
+                status_label = "دانلود موفق"
+
+        if not fpath and (year or 0) >= 2022:
+            fpath = await download_via_sciencedirect(
+                session,
+                doi,
+                title,
+                r.get("abstract"),
+                r.get("journal"),
+                bot=bot,
+                chat_id=chat_id,
+                force=False,
+            )
+            if fpath:
+                cost_label = "هزینه‌دار"
+                status_label = "دانلود موفق"
+
+        if not fpath:
+            try:
+                fpath = await download_pdf_with_selenium(doi)
+            except ScihubNoResultError:
+                fpath = None
+                logger.info("scihub_no_result_detected | doi=%s", doi)
+            if fpath:
+                cost_label = "رایگان"
+                status_label = "دانلود موفق"
+
+    return {
+        "doi": doi,
+        "title": title,
+        "year": year or "—",
+        "filename": fpath.name if fpath else "—",
+        "file_path": str(fpath) if fpath else None,
+        "cost": cost_label,
+        "status": status_label,
+    }
+
+
+def _zip_volume_max_bytes() -> int:
+    return max(1, CFG.ZIP_VOLUME_MAX_MB) * 1024 * 1024
+
+
+def _job_zip_paths(job: Dict[str, Any]) -> List[Path]:
+    """zip_path کار: فهرست JSON جلدها (یا مسیر تکی در رکوردهای قدیمی)."""
+    raw = (job.get("zip_path") or "").strip()
+    if not raw:
+        return []
+    if raw.startswith("["):
         with suppress(Exception):
-            await bot.send_message(chat_id, summary, parse_mode=PARSE_HTML if PARSE_HTML else None)
-
-        activation = is_activation_on()
-        entries: List[Dict[str, Any]] = []
-        font_path = _summary_font_path()
-        zip_path = CFG.DOWNLOAD_LINK_DIR / f"downloads_oa_{int(time.time())}.zip"
-
-        for r in results:
-            doi = r["doi"]
-            title = r.get("title") or doi
-            year = r.get("year")
-
-            fpath: Optional[Path] = None
-            status_label = "دانلود نشده"
-            cost_label = "رایگان (Open Access)"
-
-            if r["status"] != "ok":
-                status_label = "دانلود نشده (متادیتا ناقص)"
-            elif not activation:
-                status_label = "دانلود نشده (غیرفعال)"
+            return [Path(p) for p in json.loads(raw) if p]
+        return []
+    return [Path(raw)]
+
+
+async def _deliver_zip(bot, chat_id: int, user_id: int, zip_files: List[Path], *, caption: str) -> None:
+    """
+    تحویل جلدهای ZIP: با ربات دانلود یا دانلود مستقیم HTTP برای هر جلد یک توکن/لینک جدا ساخته می‌شود؛
+    در غیر این صورت جلدها به‌صورت موازی (در حد اسلات‌های آپلود هر چت) ارسال می‌شوند.
+    """
+    total = len(zip_files)
+    tokens: List[str] = []
+    sent_links = False
+    if CFG.DOWNLOAD_BOT_USERNAME or CFG.DOWNLOAD_HTTP_BASE_URL:
+        for zf in zip_files:
+            token = await db_run(db_create_download_link, user_id, str(zf), zf.name)
+            if not token:
+                break
+            tokens.append(token)
+        if len(tokens) == total:
+            text = _download_links_text(tokens, user_id)
+            try:
+                await bot.send_message(
+                    chat_id,
+                    text,
+                    parse_mode=PARSE_HTML if PARSE_HTML else None,
+                    reply_markup=_download_link_done_kb(),
+                )
+                sent_links = True
+            except Exception as e:
+                logger.warning("download_link_send_failed | err=%s", e)
+    if sent_links:
+        return
+    for token in tokens:
+        await db_run(db_delete_download_link, token)
+
+    async def send_volume(idx: int, zf: Path) -> None:
+        part = f" ({idx}/{total})" if total > 1 else ""
+        label = f"{idx}/{total}" if total > 1 else zf.name
+        keep = False
+        try:
+            if not upload_size_allowed(zf):
+                # مثلاً یک PDF تکی بزرگ‌تر از سقف جلد؛ retry فایده ندارد
+                logger.warning("zip_volume_too_large | file=%s cap_mb=%s", zf.name, CFG.TELEGRAM_UPLOAD_MAX_MB)
+                notice = f"⚠️ بخش {label} از سقف ارسال تلگرام ({CFG.TELEGRAM_UPLOAD_MAX_MB}MB) بزرگ‌تر است و ارسال نشد."
+            elif await _send_document_with_retry(bot, chat_id, zf, f"{caption}{part}", tries=3, timeout=240):
+                return
             else:
-                oa_pdf_url = r.get("oa_pdf_url")
-                if oa_pdf_url:
-                    fpath = await download_pdf_to_tmp(session, oa_pdf_url, hint=doi.replace("/", "_"))
-                    status_label = "دانلود موفق" if fpath else "دانلود ناموفق"
-                    if fpath:
-                        db_inc_used(user_id, free_inc=1)
-                else:
-                    status_label = "Open Access پیدا نشد"
-
-            entries.append({
-                "doi": doi,
-                "title": title,
-                "year": year or "—",
-                "filename": fpath.name if fpath else "—",
-                "file_path": str(fpath) if fpath else None,
-                "cost": cost_label,
-                "status": status_label,
-            })
+                logger.warning("zip_send_failed | file=%s", zf.name)
+                notice = f"⚠️ ارسال بخش {label} ناموفق بود."
+            if CFG.DOWNLOAD_HTTP_BASE_URL:
+                token = await db_run(db_create_download_link, user_id, str(zf), zf.name)
+                url = download_http_url(token, user_id) if token else None
+                if url:
+                    notice += f"\nدانلود مستقیم: {url}"
+                    keep = True   # فایل تا انقضای لینک روی دیسک می‌ماند
+            with suppress(Exception):
+                await bot.send_message(chat_id, notice, disable_web_page_preview=True)
+        finally:
+            if not keep:
+                with suppress(Exception):
+                    zf.unlink()
+
+    await asyncio.gather(*(send_volume(i, zf) for i, zf in enumerate(zip_files, start=1)))
+
+
+# --- گزارش پیشرفت زنده: یک پیام وضعیت برای هر کار که با فاصلهٔ حداقل N ثانیه ویرایش می‌شود
+_PROGRESS_CHAT_NEXT: Dict[int, float] = {}   # chat_id -> زودترین زمان مجاز ویرایش بعدی (monotonic)
+
+
+class _ProgressReporter:
+    """
+    شمارش مراحل یک کار را نگه می‌دارد و فقط یک پیام وضعیت را ویرایش می‌کند.
+    ویرایش‌ها تجمیع می‌شوند (حداکثر یکی در هر PROGRESS_EDIT_INTERVAL_S برای هر چت)،
+    متن تکراری ارسال نمی‌شود و RetryAfter تلگرام (از AIORateLimiter) رعایت می‌شود.
+    """
+
+    def __init__(self, bot, chat_id: int, job: Dict[str, Any], items: List[Dict[str, Any]]) -> None:
+        self.bot = bot
+        self.chat_id = int(chat_id)
+        self.job_id = int(job["id"])
+        self.total = len(items)
+        self.stage = str(job.get("stage") or "queued")
+        self.counts: Dict[str, int] = {
+            "metadata": sum(1 for it in items if job_stage_index(it["stage"]) >= job_stage_index("metadata") and it.get("meta")),
+            "downloaded": sum(1 for it in items if job_stage_index(it["stage"]) >= job_stage_index("downloaded")),
+            "ok": sum(1 for it in items if (it.get("entry") or {}).get("file_path")),
+        }
+        self.position = 0
+        self.message_id: Optional[int] = None
+        self._last_text: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def advance(self, stage: str, *, ok: bool = False) -> None:
+        self.counts[stage] = min(self.total, self.counts.get(stage, 0) + 1)
+        if ok:
+            self.counts["ok"] = min(self.total, self.counts["ok"] + 1)
+        self._schedule()
+
+    def set_stage(self, stage: str) -> None:
+        self.stage = stage
+        if job_stage_index(stage) >= job_stage_index("packaged"):
+            self.position = 0
+        self._schedule()
+
+    def set_position(self, position: int) -> None:
+        self.position = max(0, int(position))
+        self._schedule()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.job_id,
+            "stage": self.stage,
+            "total": self.total,
+            "metadata": self.counts["metadata"],
+            "downloaded": self.counts["downloaded"],
+            "ok": self.counts["ok"],
+            "queue_position": self.position,
+        }
 
-        zip_file = None
+    def _render(self) -> str:
+        head = "✅ <b>پردازش کامل شد</b>" if self.stage == "delivered" else "⏳ <b>وضعیت پردازش DOIها</b>"
+        lines = [
+            head,
+            f"متادیتا: <b>{self.counts['metadata']}/{self.total}</b>",
+            f"دانلود: <b>{self.counts['downloaded']}/{self.total}</b> (موفق: {self.counts['ok']})",
+        ]
+        if self.stage == "packaged":
+            lines.append("📦 بسته آماده شد؛ در حال ارسال…")
+        elif self.counts["downloaded"] >= self.total and self.stage != "delivered":
+            lines.append("📦 در حال ساخت بسته…")
+        if self.position > 0 and self.stage != "delivered":
+            lines.append(f"جایگاه شما در صف: <b>{self.position}</b>")
+        return "\n".join(lines)
+
+    def _schedule(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self) -> None:
+        while True:
+            wait = _PROGRESS_CHAT_NEXT.get(self.chat_id, 0.0) - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if not await self._push():
+                return
+
+    async def _push(self) -> bool:
+        """True یعنی باید دوباره تلاش/ویرایش شود."""
+        text = self._render()
+        if text == self._last_text:
+            return False
+        _PROGRESS_CHAT_NEXT[self.chat_id] = time.monotonic() + CFG.PROGRESS_EDIT_INTERVAL_S
         try:
-            zip_file = build_zip_with_summary(entries, zip_path, font_path)
+            if self.message_id is None:
+                msg = await self.bot.send_message(self.chat_id, text, parse_mode=PARSE_HTML if PARSE_HTML else None)
+                self.message_id = int(msg.message_id)
+            else:
+                await self.bot.edit_message_text(
+                    text,
+                    chat_id=self.chat_id,
+                    message_id=self.message_id,
+                    parse_mode=PARSE_HTML if PARSE_HTML else None,
+                )
+            self._last_text = text
         except Exception as e:
-            logger.warning("zip_build_failed | err=%s", e)
-
-        if zip_file and zip_file.exists():
-            link = None
-            token = None
-            if CFG.DOWNLOAD_BOT_USERNAME:
-                token = db_create_download_link(user_id, str(zip_file), zip_file.name)
-                link = _download_bot_deeplink(token) if token else None
-            if link:
-                try:
-                    await bot.send_message(
-                        chat_id,
-                        f"Download link (start the download bot):\n{link}",
-                        parse_mode=PARSE_HTML if PARSE_HTML else None,
-                        reply_markup=_download_link_done_kb(),
+            retry_after = getattr(e, "retry_after", None)
+            if retry_after:
+                delay = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+                _PROGRESS_CHAT_NEXT[self.chat_id] = time.monotonic() + delay
+                return True
+            if "not modified" in str(e).lower():
+                self._last_text = text
+            else:
+                logger.debug("progress_edit_failed | chat_id=%s job_id=%s err=%s", self.chat_id, self.job_id, e)
+                return False
+        # اگر حین ارسال وضعیت عوض شده، یک دور دیگر
+        return self._render() != self._last_text
+
+    async def close(self, stage: str) -> None:
+        """وضعیت نهایی را بدون انتظار برای throttle می‌فرستد و ردیف throttle چت را آزاد می‌کند."""
+        self.stage = stage
+        if self._task and not self._task.done():
+            self._task.cancel()
+            with suppress(BaseException):
+                await self._task
+        with suppress(Exception):
+            # فقط RetryAfter یا تغییر حین ارسال به حلقهٔ throttle‌دار برمی‌گردد
+            if await self._push():
+                await self._flush_loop()
+        if not any(p.chat_id == self.chat_id for p in _PROGRESS.values()):
+            _PROGRESS_CHAT_NEXT.pop(self.chat_id, None)
+
+
+_PROGRESS: Dict[int, _ProgressReporter] = {}
+
+
+async def get_job_progress(job_id: int) -> Dict[str, Any]:
+    """وضعیت یک کار: از گزارشگر زنده اگر در این پردازه اجرا می‌شود، وگرنه از DB."""
+    job = await db_run(db_get_job, job_id)
+    if not job:
+        return {}
+    reporter = _PROGRESS.get(int(job_id))
+    if reporter:
+        out = reporter.snapshot()
+    else:
+        items = await db_run(db_get_job_items, job_id)
+        out = {
+            "job_id": int(job_id),
+            "stage": job.get("stage"),
+            "total": len(items),
+            "metadata": sum(1 for it in items if job_stage_index(it["stage"]) >= job_stage_index("metadata")),
+            "downloaded": sum(1 for it in items if job_stage_index(it["stage"]) >= job_stage_index("downloaded")),
+            "ok": sum(1 for it in items if (it.get("entry") or {}).get("file_path")),
+            "queue_position": 0,
+        }
+    out["user_id"] = int(job["user_id"])
+    out["status"] = job.get("status")
+    return out
+
+
+async def _job_lease_keeper(job_id: int, runner: asyncio.Task, state: Dict[str, bool]) -> None:
+    """
+    تا وقتی کار در حال اجراست lease آن را تمدید می‌کند.
+    اگر lease از دست برود (پردازهٔ دیگری کار را گرفته) pipeline این پردازه لغو می‌شود تا کار دوبار اجرا نشود.
+    """
+    interval = max(5.0, CFG.JOB_LEASE_S / 3)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            renewed = await db_run(db_renew_job_lease, job_id, lease_s=CFG.JOB_LEASE_S)
+        except Exception as e:
+            logger.warning("job_lease_renew_failed | job_id=%s err=%s", job_id, e)
+            continue
+        if not renewed:
+            logger.warning("job_lease_lost | job_id=%s", job_id)
+            state["lease_lost"] = True
+            runner.cancel()
+            return
+
+
+async def _run_job_stages(job: Dict[str, Any], bot) -> None:
+    job_id = int(job["id"])
+    user_id = int(job["user_id"])
+    chat_id = int(job["chat_id"])
+    items = await db_run(db_get_job_items, job_id)
+    lane = user_sched_lane(await db_run(db_get_user, user_id))
+    progress = _ProgressReporter(bot, chat_id, job, items)
+    _PROGRESS[job_id] = progress
+    try:
+        await _run_job_pipeline(job, items, bot, lane=lane, progress=progress)
+    finally:
+        _PROGRESS.pop(job_id, None)
+        await progress.close(progress.stage)
+
+
+async def _run_job_pipeline(job: Dict[str, Any], items: List[Dict[str, Any]], bot, *,
+                            lane: str, progress: _ProgressReporter) -> None:
+    job_id = int(job["id"])
+    user_id = int(job["user_id"])
+    chat_id = int(job["chat_id"])
+    oa_only = job.get("kind") == JOB_KIND_OA_ONLY
+    single = process_single_doi_oa_only if oa_only else process_single_doi
+    job_stage = job_stage_index(job.get("stage"))
+    progress.set_stage(job.get("stage") or "queued")
+
+    async with aiohttp.ClientSession(headers=_polite_headers()) as session:
+        # ➊ متادیتا/تعیین دسته/کشف OA (موازی)
+        pending = [it for it in items if job_stage_index(it["stage"]) < job_stage_index("metadata") or not it.get("meta")]
+        if pending:
+            sem = asyncio.Semaphore(CFG.MAX_CONCURRENCY)
+
+            async def run_meta(it: Dict[str, Any]) -> None:
+                async with sem, SCHEDULER.slot("metadata", user_id, lane, progress.set_position):
+                    progress.set_position(0)
+                    r = await single(session, user_id, it["doi"])
+                await db_run(db_set_job_item_stage, it["id"], "metadata", meta=r)
+                it["meta"], it["stage"] = r, "metadata"
+                progress.advance("metadata")
+
+            await asyncio.gather(*(run_meta(it) for it in pending))
+            await flush_pending_writes()
+
+        results = [it["meta"] for it in items]
+        if job_stage < job_stage_index("metadata"):
+            try:
+                await bot.send_message(chat_id, _batch_summary_text(results, oa_only=oa_only), parse_mode=PARSE_HTML if PARSE_HTML else None)
+            except Exception as e:
+                logger.warning("failed to send summary: %s", e)
+            await db_run(db_set_job_stage, job_id, "metadata")
+            job_stage = job_stage_index("metadata")
+        progress.set_stage("metadata")
+
+        # ZIP جریانی: هر PDF به محض پایان دانلود (بدون فشرده‌سازی دوباره) به آرشیو اضافه می‌شود؛
+        # خروجی زیر ZIP_VOLUME_MAX_MB به چند جلد شکسته می‌شود
+        zip_files = _job_zip_paths(job)
+        zipper = None
+        if job_stage < job_stage_index("packaged") or not zip_files or not all(p.exists() for p in zip_files):
+            from utils.zip_report import VolumedZip
+
+            prefix = "downloads_oa" if oa_only else "downloads"
+            zip_path = CFG.DOWNLOAD_LINK_DIR / f"{prefix}_{int(time.time())}.zip"
+            zipper = VolumedZip(zip_path, max_bytes=_zip_volume_max_bytes())
+            zip_files = []
+
+        async def append_to_zip(entry: Dict[str, Any]) -> None:
+            nonlocal zipper
+            fp = entry.get("file_path")
+            if zipper is None or not fp:
+                return
+            try:
+                await asyncio.to_thread(zipper.add_file, Path(fp))
+            except Exception as e:
+                logger.warning("zip_append_failed | file=%s err=%s", fp, e)
+                zipper.abort()
+                zipper = None
+
+        # ➋ دانلودها (ترتیبی)؛ فایل‌های دانلودشدهٔ قبلی اگر هنوز روی دیسک باشند دوباره دانلود نمی‌شوند
+        activation = await db_run(is_activation_on)
+        try:
+            for it in items:
+                entry = it.get("entry")
+                if entry and job_stage_index(it["stage"]) >= job_stage_index("downloaded"):
+                    fp = entry.get("file_path")
+                    if not fp or Path(fp).exists():
+                        await append_to_zip(entry)
+                        continue
+                async with SCHEDULER.slot("download", user_id, lane, progress.set_position):
+                    progress.set_position(0)
+                    entry = await _download_entry(
+                        session, it["meta"], user_id=user_id, chat_id=chat_id, bot=bot,
+                        activation=activation, oa_only=oa_only,
                     )
-                except Exception as e:
-                    logger.warning("download_link_send_failed | err=%s", e)
-                    link = None
-            if not link:
-                if token:
-                    db_delete_download_link(token)
-                try:
-                    async with SEND_SEM:
-                        await bot.send_chat_action(chat_id=chat_id, action="upload_document")
-                        with open(zip_file, "rb") as f:
-                            await bot.send_document(
-                                chat_id,
-                                document=f,
-                                filename=zip_file.name,
-                                caption="بستهٔ Open-Access + فهرست",
-                                read_timeout=240,
-                            )
-                except Exception as e:
-                    logger.warning("zip_send_failed | err=%s", e)
-                finally:
-                    with suppress(Exception):
-                        zip_file.unlink()
+                await append_to_zip(entry)
+                await db_run(db_set_job_item_stage, it["id"], "downloaded", entry=entry)
+                it["entry"], it["stage"] = entry, "downloaded"
+                progress.advance("downloaded", ok=bool(entry.get("file_path")))
+        except BaseException:
+            # آرشیو نیمه‌کاره (.part) نباید باقی بماند؛ اجرای بعدی آن را از نو می‌سازد
+            if zipper is not None:
+                zipper.abort()
+            raise
+        await flush_pending_writes()
+        entries = [it["entry"] for it in items]
+
+        # ➌ بستن ZIP: فقط PDF فهرست و meta.json باقی مانده است
+        if zipper is not None:
+            try:
+                async with SCHEDULER.slot("package", user_id, lane):
+                    zip_files = await zipper.finish_async(entries, _summary_font_path(), workers=CFG.PACKAGE_WORKERS)
+                logger.info(
+                    "package_timing | job_id=%s files=%d volumes=%s append_ms=%s summary_ms=%s finalize_ms=%s",
+                    job_id,
+                    sum(1 for e in entries if e.get("file_path")),
+                    zipper.timings.get("volumes", 1),
+                    zipper.timings.get("append_ms", 0),
+                    zipper.timings.get("summary_ms", 0),
+                    zipper.timings.get("finalize_ms", 0),
+                )
+            except Exception as e:
+                logger.warning("zip_build_failed | err=%s", e)
+                zip_files = []
+            if zip_files:
+                await db_run(db_set_job_stage, job_id, "packaged", zip_path=json.dumps([str(p) for p in zip_files]))
+                progress.set_stage("packaged")
+
+        # ➍ تحویل
+        if zip_files and all(p.exists() for p in zip_files):
+            caption = "بستهٔ Open-Access + فهرست" if oa_only else "بستهٔ دانلود شده + فهرست"
+            await _deliver_zip(bot, chat_id, user_id, zip_files, caption=caption)
         else:
             with suppress(Exception):
                 await bot.send_message(
                     chat_id,
-                    "⚠️ ساخت بستهٔ دانلود/فهرست انجام نشد.",
+                    "⚠️ ساخت بستهٔ دانلود/فهرست انجام نشد." if oa_only else "❗️ ساخت بستهٔ دانلود/فهرست انجام نشد.",
                     parse_mode=PARSE_HTML if PARSE_HTML else None,
                 )
-        for item in entries:
-            fp = item.get("file_path")
+        await db_run(db_set_job_stage, job_id, "delivered", status="done")
+        progress.set_stage("delivered")
+        for entry in entries:
+            fp = entry.get("file_path")
             if fp:
                 with suppress(Exception):
                     Path(fp).unlink()
+
+
+def warm_packaging() -> None:
+    """workerهای process pool بسته‌بندی (ReportLab + فونت) را از قبل بالا می‌آورد."""
+    from utils.zip_report import warm_packaging_pool
+
+    warm_packaging_pool(_summary_font_path(), CFG.PACKAGE_WORKERS)
+
+
+def shutdown_packaging() -> None:
+    if "utils.zip_report" in sys.modules:
+        sys.modules["utils.zip_report"].shutdown_packaging_pool()
+
+
+# کارهایی که همین پردازه در حال اجرای آن‌هاست (چه از پیام کاربر، چه از resume)
+_RUNNING_JOBS: set = set()
+
+
+async def run_doi_job(job_id: int, bot) -> None:
+    """یک کار صف را با lease اجرا می‌کند و از آخرین مرحلهٔ ثبت‌شده ادامه می‌دهد."""
+    if job_id in _RUNNING_JOBS:
+        logger.info("job_already_running | job_id=%s", job_id)
+        return
+    _RUNNING_JOBS.add(job_id)
+    try:
+        await _run_claimed_job(job_id, bot)
+    finally:
+        _RUNNING_JOBS.discard(job_id)
+
+
+async def _run_claimed_job(job_id: int, bot) -> None:
+    if not await db_run(db_claim_job, job_id, lease_s=CFG.JOB_LEASE_S):
+        logger.info("job_claim_skipped | job_id=%s", job_id)
+        return
+    job = await db_run(db_get_job, job_id)
+    logger.info("job_started | job_id=%s kind=%s stage=%s attempt=%s", job_id, job.get("kind"), job.get("stage"), job.get("attempts"))
+    state = {"lease_lost": False}
+    runner = asyncio.create_task(_run_job_stages(job, bot))
+    keeper = asyncio.create_task(_job_lease_keeper(job_id, runner, state))
+    me = asyncio.current_task()
+    try:
+        await runner
+    except asyncio.CancelledError:
+        if state["lease_lost"] and not me.cancelling():
+            # کار حالا مال پردازهٔ دیگری است؛ به آن دست نزن
+            logger.warning("job_abandoned_lease_lost | job_id=%s", job_id)
+            return
+        runner.cancel()
+        # shutdown: lease را آزاد کن تا پردازهٔ بعدی بلافاصله ادامه دهد
+        with suppress(Exception):
+            await asyncio.shield(db_run(db_release_job, job_id))
+        raise
+    except Exception as e:
+        logger.error("job_failed | job_id=%s err=%s", job_id, e)
+        with suppress(Exception):
+            await db_run(db_fail_job, job_id, str(e))
+        raise
+    finally:
+        keeper.cancel()
+
+
+_JOB_TASKS: Dict[int, asyncio.Task] = {}
+
+
+async def _give_up_job(job_id: int, chat_id: int, bot, *, too_old: bool, attempts: int) -> None:
+    """کار نیمه‌تمامی که دیگر resume نمی‌شود را failed می‌کند و به کاربر خبر می‌دهد."""
+    reason = "too_old" if too_old else "max_attempts"
+    if not await db_run(db_fail_job, job_id, reason, unleased_only=True):
+        return  # پردازهٔ دیگری زودتر آن را گرفت یا رها کرد
+    logger.warning("job_abandoned | job_id=%s reason=%s attempts=%s", job_id, reason, attempts)
+    text = (
+        "⚠️ پردازش DOIهای ارسالی قبلی شما به‌خاطر قدیمی شدن متوقف شد؛ لطفاً دوباره ارسال کنید."
+        if too_old else
+        "⚠️ پردازش DOIهای ارسالی شما پس از چند تلاش ناموفق متوقف شد؛ لطفاً دوباره ارسال کنید."
+    )
+    with suppress(Exception):
+        await bot.send_message(chat_id, text)
+
+
+async def resume_doi_jobs(bot) -> int:
+    """
+    کارهای نیمه‌تمام (lease منقضی) را در پس‌زمینه دوباره اجرا می‌کند.
+    بعد از ری‌استارت و سپس هر JOB_LEASE_S ثانیه صدا زده می‌شود، چون lease پردازهٔ مرده ممکن است هنوز معتبر باشد.
+    """
+    jobs = await db_run(db_list_resumable_jobs)
+    started = 0
+    now = int(time.time())
+    for job in jobs:
+        job_id = int(job["id"])
+        if job_id in _JOB_TASKS or job_id in _RUNNING_JOBS:
+            continue
+        attempts = int(job.get("attempts") or 0)
+        age_s = now - int(job.get("created_ts") or now)
+        if attempts >= CFG.JOB_MAX_ATTEMPTS or age_s > CFG.JOB_MAX_AGE_S:
+            await _give_up_job(job_id, int(job["chat_id"]), bot, too_old=age_s > CFG.JOB_MAX_AGE_S, attempts=attempts)
+            continue
+        task = asyncio.create_task(run_doi_job(job_id, bot))
+        _JOB_TASKS[job_id] = task
+        task.add_done_callback(lambda t, j=job_id: _JOB_TASKS.pop(j, None))
+        started += 1
+    if started:
+        logger.info("jobs_resumed | count=%d", started)
+    return started
+
+
+async def process_dois_batch(user_id: int, dois: List[str], chat_id: int, bot) -> None:
+    """پردازش یک‌جای DOIها: متادیتا + تعیین دسته + کشف OA + دانلود/ارسال PDF."""
+    job_id = await db_run(db_create_job, user_id, chat_id, JOB_KIND_FULL, dois)
+    await run_doi_job(job_id, bot)
+
+
+async def process_dois_batch_oa_only(user_id: int, dois: List[str], chat_id: int, bot) -> None:
+    """پردازش DOIها فقط برای مسیرهای Open-Access/قانونی + ارسال به تلگرام."""
+    job_id = await db_run(db_create_job, user_id, chat_id, JOB_KIND_OA_ONLY, dois)
+    await run_doi_job(job_id, bot)
+
+
+_record_timing("import:downloadmain", _STARTUP_T0)
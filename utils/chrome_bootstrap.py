@@ -0,0 +1,257 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+from contextlib import suppress
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Optional
+
+LOGGER = logging.getLogger("doi_bot.selenium")
+
+# فایل‌های قفل Chrome که نباید همراه پروفایل کپی شوند
+_PROFILE_LOCK_FILES = ("SingletonLock", "SingletonCookie", "SingletonSocket", "lockfile")
+# کش‌های حجیم؛ کپی‌شان کلون را کند می‌کند و برای کوکی/consent لازم نیستند
+_PROFILE_SKIP_DIRS = ("Cache", "Code Cache", "GPUCache", "ShaderCache", "GrShaderCache", "Crashpad")
+_TEMPLATE_MARKER = "template.json"
+
+# دکمه‌های رایج «پذیرش کوکی» (OneTrust، Cookiebot، Google و بنرهای عمومی)
+_CONSENT_SELECTORS = (
+    "#onetrust-accept-btn-handler",
+    "#CybotCookiebotDialogBodyLevelButtonLevelOptinAllowAll",
+    "#L2AGLb",
+    "button[aria-label='Accept all']",
+    "button[aria-label='Accept all cookies']",
+    ".cc-allow",
+    ".cookie-accept",
+)
+
+_CHROME_BINARIES = ("google-chrome", "google-chrome-stable", "chromium", "chromium-browser", "chrome")
+
+_RESOLVE_LOCK = threading.Lock()
+_RESOLVED: Dict[str, str] = {}
+_CHROME_VERSION: Optional[str] = None
+
+
+def chrome_version() -> Optional[str]:
+    """نسخهٔ مرورگر Chrome/Chromium نصب‌شده (یک‌بار در هر پردازه خوانده می‌شود)."""
+    global _CHROME_VERSION
+    if _CHROME_VERSION is not None:
+        return _CHROME_VERSION or None
+    candidates = [os.environ.get("CHROME_BINARY") or ""] + list(_CHROME_BINARIES)
+    for name in candidates:
+        path = shutil.which(name) if name else None
+        if not path:
+            continue
+        with suppress(Exception):
+            out = subprocess.run([path, "--version"], capture_output=True, text=True, timeout=15).stdout
+            m = re.search(r"(\d+\.\d+\.\d+\.\d+)", out or "")
+            if m:
+                _CHROME_VERSION = m.group(1)
+                return _CHROME_VERSION
+    _CHROME_VERSION = ""
+    return None
+
+
+def _file_sig(path: Path) -> str:
+    st = path.stat()
+    return hashlib.sha1(f"{path.resolve()}:{st.st_size}:{int(st.st_mtime)}".encode()).hexdigest()[:12]
+
+
+def _read_manifest(path: Path) -> Dict[str, Any]:
+    with suppress(Exception):
+        data = json.loads(path.read_text(encoding="utf-8"))
+        if isinstance(data, dict):
+            return data
+    return {}
+
+
+def _write_json_atomic(path: Path, data: Dict[str, Any]) -> None:
+    tmp = path.with_suffix(f".{uuid.uuid4().hex[:6]}.tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def _patch_uc_binary(path: Path) -> None:
+    import undetected_chromedriver as uc  # type: ignore
+
+    patcher = uc.Patcher(executable_path=str(path))
+    if not patcher.is_binary_patched(str(path)):
+        patcher.patch_exe()
+
+
+def resolve_driver(
+    cache_dir: Path,
+    *,
+    source_path: str = "",
+    patch_uc: bool = False,
+    install: Optional[Callable[[], str]] = None,
+    ttl_s: int = 24 * 3600,
+) -> str:
+    """
+    مسیر chromedriver آماده را برمی‌گرداند.
+    باینری برای هر نسخهٔ Chrome (یا هر باینری منبع در CHROMEDRIVER_PATH) فقط یک‌بار resolve و در صورت نیاز
+    برای undetected_chromedriver patch می‌شود و در cache_dir می‌ماند؛ بیلدهای بعدی درخواست شبکه یا patch ندارند.
+    """
+    version = chrome_version()
+    src = Path(source_path) if source_path else None
+    key = f"{version or 'unknown'}-{'uc' if patch_uc else 'std'}"
+    if src is not None:
+        key += f"-{_file_sig(src)}"
+    cached = _RESOLVED.get(key)
+    if cached and Path(cached).exists():
+        return cached
+
+    with _RESOLVE_LOCK:
+        cached = _RESOLVED.get(key)
+        if cached and Path(cached).exists():
+            return cached
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        manifest_path = cache_dir / "drivers.json"
+        manifest = _read_manifest(manifest_path)
+        entry = manifest.get(key) or {}
+        fresh = bool(version) or src is not None or time.time() - float(entry.get("at") or 0) < ttl_s
+        if entry.get("path") and Path(entry["path"]).exists() and fresh:
+            _RESOLVED[key] = str(entry["path"])
+            return _RESOLVED[key]
+
+        t0 = time.perf_counter()
+        if src is None:
+            if install is None:
+                raise RuntimeError("chromedriver source is not configured")
+            src = Path(install())
+        dest_dir = cache_dir / key
+        dest_dir.mkdir(parents=True, exist_ok=True)
+        dest = dest_dir / src.name
+        shutil.copy2(src, dest)
+        dest.chmod(0o755)
+        if patch_uc:
+            try:
+                _patch_uc_binary(dest)
+            except Exception as exc:
+                # uc در اولین اجرا خودش کپی کش‌شده را patch می‌کند
+                LOGGER.warning("chromedriver_patch_failed | path=%s err=%s", dest, exc)
+        manifest[key] = {"path": str(dest), "chrome_version": version, "source": str(src), "at": int(time.time())}
+        _write_json_atomic(manifest_path, manifest)
+        _RESOLVED[key] = str(dest)
+        LOGGER.info(
+            "chromedriver_cached | key=%s path=%s ms=%.0f", key, dest, (time.perf_counter() - t0) * 1000
+        )
+        return _RESOLVED[key]
+
+
+def _copy_ignore(_dir: str, names: Iterable[str]) -> set:
+    return {n for n in names if n in _PROFILE_LOCK_FILES or n in _PROFILE_SKIP_DIRS}
+
+
+class ProfileTemplates:
+    """
+    پروفایل‌های Chrome از پیش گرم‌شده.
+    یک template (کوکی‌ها و بنرهای consent پذیرفته‌شده) یک‌بار ساخته می‌شود و هر درایور یک کپی تازه از آن می‌گیرد؛
+    کپی‌هایی که دیگر قفل Chrome ندارند در prune پاک می‌شوند.
+    """
+
+    def __init__(self, root: Path, *, max_age_s: int) -> None:
+        self.root = root
+        self.template = root / "template"
+        self.clones = root / "clones"
+        self.max_age_s = max(60, int(max_age_s))
+        self._build_lock = threading.Lock()
+
+    def ready(self) -> bool:
+        meta = _read_manifest(self.template / _TEMPLATE_MARKER)
+        return bool(meta) and time.time() - float(meta.get("built_at") or 0) < self.max_age_s
+
+    def exists(self) -> bool:
+        return (self.template / _TEMPLATE_MARKER).exists()
+
+    def build(self, make_driver: Callable[[str], Any], warm_urls: Iterable[str]) -> bool:
+        """template را با یک درایور گرم می‌سازد؛ اگر ساخت دیگری در جریان باشد یا template تازه باشد کاری نمی‌کند."""
+        if self.ready() or not self._build_lock.acquire(blocking=False):
+            return False
+        staging = self.root / f"template.building-{uuid.uuid4().hex[:8]}"
+        t0 = time.perf_counter()
+        try:
+            staging.mkdir(parents=True, exist_ok=True)
+            driver = make_driver(str(staging))
+            visited = []
+            try:
+                for url in warm_urls:
+                    with suppress(Exception):
+                        driver.get(url)
+                        time.sleep(2)
+                        _accept_consent(driver)
+                        visited.append(url)
+            finally:
+                with suppress(Exception):
+                    driver.quit()
+            for name in _PROFILE_LOCK_FILES:
+                with suppress(Exception):
+                    (staging / name).unlink()
+            for name in _PROFILE_SKIP_DIRS:
+                shutil.rmtree(staging / name, ignore_errors=True)
+                shutil.rmtree(staging / "Default" / name, ignore_errors=True)
+            _write_json_atomic(staging / _TEMPLATE_MARKER, {"built_at": int(time.time()), "urls": visited})
+
+            old = self.root / f"template.old-{uuid.uuid4().hex[:8]}"
+            if self.template.exists():
+                os.replace(self.template, old)
+            os.replace(staging, self.template)
+            shutil.rmtree(old, ignore_errors=True)
+            LOGGER.info(
+                "chrome_profile_template_ready | urls=%d ms=%.0f", len(visited), (time.perf_counter() - t0) * 1000
+            )
+            return True
+        except Exception as exc:
+            LOGGER.warning("chrome_profile_template_failed | err=%s", exc)
+            shutil.rmtree(staging, ignore_errors=True)
+            return False
+        finally:
+            self._build_lock.release()
+
+    def clone(self) -> Optional[str]:
+        """یک کپی تازه از template برای --user-data-dir؛ اگر template هنوز ساخته نشده None."""
+        if not self.exists():
+            return None
+        self.prune()
+        dest = self.clones / uuid.uuid4().hex[:12]
+        try:
+            self.clones.mkdir(parents=True, exist_ok=True)
+            shutil.copytree(self.template, dest, ignore=_copy_ignore, symlinks=True)
+            os.utime(dest, None)  # copytree زمان template را کپی می‌کند؛ کلون تازه نباید در prune پاک شود
+        except Exception as exc:
+            LOGGER.warning("chrome_profile_clone_failed | err=%s", exc)
+            shutil.rmtree(dest, ignore_errors=True)
+            return None
+        return str(dest)
+
+    def prune(self, min_age_s: int = 300) -> int:
+        """کپی‌هایی که Chrome دیگر از آن‌ها استفاده نمی‌کند (بدون SingletonLock) را پاک می‌کند."""
+        removed = 0
+        if not self.clones.exists():
+            return 0
+        now = time.time()
+        for d in self.clones.iterdir():
+            with suppress(Exception):
+                if os.path.lexists(d / "SingletonLock") or now - d.stat().st_mtime < min_age_s:
+                    continue
+                shutil.rmtree(d, ignore_errors=True)
+                removed += 1
+        return removed
+
+
+def _accept_consent(driver: Any) -> None:
+    for sel in _CONSENT_SELECTORS:
+        with suppress(Exception):
+            for el in driver.find_elements("css selector", sel)[:1]:
+                if el.is_displayed():
+                    el.click()
+                    time.sleep(1)
+                    return
@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import math
+import time
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Tuple
+
+
+class TokenBucketLimiter:
+    """
+    نرخ‌محدود token bucket با حافظهٔ محدود.
+    هر کلید فقط (توکن‌های باقی‌مانده، زمان آخرین به‌روزرسانی) را نگه می‌دارد و هر take در O(1) است.
+    کلیدی که بیش از burst/rate ثانیه بی‌استفاده بماند سطلش دوباره پر شده و معادل کلید تازه است،
+    پس از ابتدای OrderedDict (قدیمی‌ترین دسترسی) حذف می‌شود؛ max_keys سقف سخت تعداد کلیدهاست.
+    """
+
+    def __init__(self, rate: float, burst: float, *, max_keys: int = 50_000) -> None:
+        self.rate = max(1e-6, float(rate))
+        self.burst = max(1.0, float(burst))
+        self.max_keys = max(1, int(max_keys))
+        self.idle_s = self.burst / self.rate
+        self._buckets: "OrderedDict[str, List[float]]" = OrderedDict()
+
+    @classmethod
+    def per_window(cls, max_hits: int, window_s: float, **kw) -> "TokenBucketLimiter":
+        """همان سیاست قدیمی «max_hits در هر window_s ثانیه» به‌صورت سطل با ظرفیت max_hits."""
+        return cls(max(1, max_hits) / max(1e-6, float(window_s)), max(1, max_hits), **kw)
+
+    def wait(self, key: str, cost: float = 1.0, *, now: Optional[float] = None) -> float:
+        """مثل take ولی بدون برداشتن توکن و بدون تغییر وضعیت: 0 یعنی take الان مجاز است."""
+        now = time.monotonic() if now is None else now
+        b = self._buckets.get(key)
+        tokens = self.burst if b is None else min(self.burst, b[0] + (now - b[1]) * self.rate)
+        return 0.0 if tokens >= cost else (cost - tokens) / self.rate
+
+    def take(self, key: str, cost: float = 1.0, *, now: Optional[float] = None) -> float:
+        """cost توکن برمی‌دارد؛ 0 یعنی مجاز، وگرنه چند ثانیه تا مجاز شدن (توکنی مصرف نمی‌شود)."""
+        now = time.monotonic() if now is None else now
+        self._evict(now)
+        b = self._buckets.get(key)
+        if b is None:
+            tokens = self.burst
+        else:
+            tokens = min(self.burst, b[0] + (now - b[1]) * self.rate)
+            self._buckets.move_to_end(key)
+        if tokens >= cost:
+            tokens -= cost
+            wait = 0.0
+        else:
+            wait = (cost - tokens) / self.rate
+        if b is None:
+            self._buckets[key] = [tokens, now]
+        else:
+            b[0], b[1] = tokens, now
+        return wait
+
+    def _evict(self, now: float) -> None:
+        buckets = self._buckets
+        while buckets:
+            b = next(iter(buckets.values()))
+            if now - b[1] < self.idle_s and len(buckets) < self.max_keys:
+                break
+            buckets.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+def retry_after_header(wait_s: float) -> str:
+    return str(max(1, math.ceil(wait_s)))
+
+
+def check_all(checks: Iterable[Tuple[TokenBucketLimiter, str]], *, now: Optional[float] = None) -> Tuple[float, str]:
+    """
+    همهٔ سطل‌ها را بررسی می‌کند؛ (بیشترین انتظار، کلید محدودکننده) یا (0, "").
+    دو مرحله‌ای: اول همه بدون مصرف بررسی می‌شوند و فقط اگر همه مجاز بودند از هر سطل توکن برداشته می‌شود،
+    تا درخواست ردشده توکن سطل‌های دیگر (مثلاً سطل IP) را نسوزاند.
+    """
+    now = time.monotonic() if now is None else now
+    checks = list(checks)
+    worst: Tuple[float, str] = (0.0, "")
+    for limiter, key in checks:
+        wait = limiter.wait(key, now=now)
+        if wait > worst[0]:
+            worst = (wait, key)
+    if worst[0] > 0:
+        return worst
+    for limiter, key in checks:
+        limiter.take(key, now=now)
+    return worst
@@ -1,10 +1,18 @@
 from __future__ import annotations
 
+import asyncio
 import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from contextlib import suppress
 from pathlib import Path
-from typing import Dict, List, Any
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
@@ -14,6 +22,8 @@ from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
 
+LOGGER = logging.getLogger("doi_bot.package")
+
 
 def _ensure_font(font_path: Path, font_name: str = "CustomPersian") -> str:
     if font_name not in pdfmetrics.getRegisteredFontNames():
@@ -82,26 +92,285 @@ def build_summary_pdf(entries: List[Dict[str, Any]], pdf_path: Path, font_path:
     return pdf_path
 
 
-def build_zip_with_summary(entries: List[Dict[str, Any]], zip_path: Path, font_path: Path) -> Path:
-    zip_path.parent.mkdir(parents=True, exist_ok=True)
-    tmp_pdf = zip_path.with_suffix(".summary.pdf")
+# =========================
+# Process pool بسته‌بندی
+# =========================
+# چیدمان ReportLab و ثبت فونت CPU-bound است و GIL را نگه می‌دارد؛ در پردازه‌های جدا اجرا می‌شود تا
+# event loop ربات آزاد بماند. هر worker فونت را یک‌بار در initializer ثبت می‌کند (رجیستری گرم).
+_POOL: Optional[ProcessPoolExecutor] = None
+_POOL_KEY: Optional[Tuple[int, str]] = None
+_POOL_LOCK = threading.Lock()
 
-    build_summary_pdf(entries, tmp_pdf, font_path)
 
-    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
-        zf.write(tmp_pdf, arcname="فهرست.pdf")
-        for item in entries:
-            fpath = item.get("file_path")
-            if fpath:
-                p = Path(fpath)
-                if p.exists():
-                    zf.write(p, arcname=p.name)
+def _pool_worker_init(font_path: str) -> None:
+    with suppress(Exception):
+        _ensure_font(Path(font_path))
 
-        # فایل JSON کوچک برای دیباگ
-        meta = [{"doi": e.get("doi"), "title": e.get("title"), "year": e.get("year"),
-                 "filename": e.get("filename"), "cost": e.get("cost"), "status": e.get("status")} for e in entries]
-        zf.writestr("meta.json", json.dumps(meta, ensure_ascii=False, indent=2))
 
-    with suppress(Exception):
-        tmp_pdf.unlink()
-    return zip_path
+def _pool_noop() -> int:
+    return os.getpid()
+
+
+def _summary_pdf_job(entries: List[Dict[str, Any]], pdf_path: str, font_path: str) -> float:
+    t0 = time.perf_counter()
+    build_summary_pdf(entries, Path(pdf_path), Path(font_path))
+    return (time.perf_counter() - t0) * 1000
+
+
+def packaging_pool(font_path: Path, workers: int = 2) -> ProcessPoolExecutor:
+    """pool محدود بسته‌بندی (spawn تا وضعیت threadها/event loop والد به worker منتقل نشود)."""
+    global _POOL, _POOL_KEY
+    key = (max(1, int(workers)), str(Path(font_path).resolve()))
+    with _POOL_LOCK:
+        if _POOL is None or _POOL_KEY != key:
+            if _POOL is not None:
+                _POOL.shutdown(wait=False, cancel_futures=True)
+            _POOL = ProcessPoolExecutor(
+                max_workers=key[0],
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_pool_worker_init,
+                initargs=(key[1],),
+            )
+            _POOL_KEY = key
+        return _POOL
+
+
+def warm_packaging_pool(font_path: Path, workers: int = 2) -> None:
+    """workerها را از قبل بالا می‌آورد تا اولین batch هزینهٔ spawn و import ReportLab را ندهد."""
+    pool = packaging_pool(font_path, workers)
+    for _ in range(max(1, int(workers))):
+        pool.submit(_pool_noop)
+
+
+def shutdown_packaging_pool() -> None:
+    global _POOL, _POOL_KEY
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.shutdown(wait=False, cancel_futures=True)
+        _POOL, _POOL_KEY = None, None
+
+
+async def build_summary_pdf_async(
+    entries: List[Dict[str, Any]], pdf_path: Path, font_path: Path, *, workers: int = 2
+) -> float:
+    """
+    PDF فهرست را در process pool می‌سازد و زمان ساخت (ms) را برمی‌گرداند.
+    فقط وقتی pool خراب شده (worker مرده) pool بازسازی و این کار در thread انجام می‌شود؛ خطای خود ساخت PDF بالا می‌رود.
+    """
+    loop = asyncio.get_running_loop()
+    args = (entries, str(Path(pdf_path).resolve()), str(Path(font_path).resolve()))
+    try:
+        return await loop.run_in_executor(packaging_pool(font_path, workers), _summary_pdf_job, *args)
+    except BrokenProcessPool as exc:
+        LOGGER.warning("package_pool_broken | err=%s; falling back to thread", exc)
+        shutdown_packaging_pool()
+        return await asyncio.to_thread(_summary_pdf_job, *args)
+
+
+def _meta_json(entries: List[Dict[str, Any]]) -> str:
+    # فایل JSON کوچک برای دیباگ
+    meta = [{"doi": e.get("doi"), "title": e.get("title"), "year": e.get("year"),
+             "filename": e.get("filename"), "cost": e.get("cost"), "status": e.get("status")} for e in entries]
+    return json.dumps(meta, ensure_ascii=False, indent=2)
+
+
+class StreamingZip:
+    """
+    آرشیو ZIP که PDFها به محض پایان دانلود به آن اضافه می‌شوند.
+    PDFها از قبل فشرده‌اند و با ZIP_STORED (بدون فشرده‌سازی دوباره) نوشته می‌شوند؛ فقط فهرست و meta.json
+    DEFLATED می‌شوند. تا finish() فایل با پسوند .part نوشته می‌شود تا آرشیو نیمه‌کاره هرگز تحویل نشود.
+    """
+
+    def __init__(self, zip_path: Path) -> None:
+        zip_path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = zip_path
+        self._part = zip_path.with_name(zip_path.name + ".part")
+        self._zf = zipfile.ZipFile(self._part, "w", zipfile.ZIP_STORED, allowZip64=True)
+        self._names: Set[str] = set()
+        self._sources: Set[str] = set()
+        self.timings: Dict[str, float] = {}
+
+    def _unique_name(self, name: str) -> str:
+        if name not in self._names:
+            return name
+        stem, dot, ext = name.rpartition(".")
+        if not dot:
+            stem, ext = name, ""
+        i = 2
+        while True:
+            candidate = f"{stem}_{i}.{ext}" if ext else f"{stem}_{i}"
+            if candidate not in self._names:
+                return candidate
+            i += 1
+
+    def add_file(self, path: Path, arcname: Optional[str] = None) -> Optional[str]:
+        """یک PDF را بدون فشرده‌سازی اضافه می‌کند؛ فایل تکراری یا ناموجود نادیده گرفته می‌شود."""
+        key = str(Path(path).resolve())
+        if key in self._sources or not Path(path).exists():
+            return None
+        name = self._unique_name(arcname or Path(path).name)
+        t0 = time.perf_counter()
+        self._zf.write(path, arcname=name, compress_type=zipfile.ZIP_STORED)
+        self.timings["append_ms"] = round(self.timings.get("append_ms", 0.0) + (time.perf_counter() - t0) * 1000, 1)
+        self._names.add(name)
+        self._sources.add(key)
+        return name
+
+    def add_bytes(self, name: str, data: bytes | str, *, compress: bool = True) -> str:
+        name = self._unique_name(name)
+        ctype = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        self._zf.writestr(name, data, compress_type=ctype)
+        self._names.add(name)
+        return name
+
+    def finish(self, entries: List[Dict[str, Any]], font_path: Path) -> Path:
+        """PDF فهرست و meta.json را (DEFLATED) اضافه می‌کند، آرشیو را می‌بندد و به نام نهایی منتقل می‌کند."""
+        tmp_pdf = self._summary_path()
+        try:
+            build_summary_pdf(entries, tmp_pdf, font_path)
+        except Exception:
+            self.abort()
+            with suppress(Exception):
+                tmp_pdf.unlink()
+            raise
+        return self._finalize(entries, tmp_pdf)
+
+    async def finish_async(self, entries: List[Dict[str, Any]], font_path: Path, *, workers: int = 2) -> Path:
+        """
+        نسخهٔ awaitable: PDF فهرست در process pool ساخته می‌شود و بستن آرشیو (I/O) در thread؛
+        زمان هر مرحله در self.timings ثبت می‌شود.
+        """
+        tmp_pdf = self._summary_path()
+        try:
+            self.timings["summary_ms"] = round(await build_summary_pdf_async(entries, tmp_pdf, font_path, workers=workers), 1)
+            t0 = time.perf_counter()
+            path = await asyncio.to_thread(self._finalize, entries, tmp_pdf)
+            self.timings["finalize_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+            return path
+        except BaseException:
+            self.abort()
+            with suppress(Exception):
+                tmp_pdf.unlink()
+            raise
+
+    def _summary_path(self) -> Path:
+        return self.path.with_suffix(".summary.pdf")
+
+    def _finalize(self, entries: List[Dict[str, Any]], tmp_pdf: Path) -> Path:
+        try:
+            self._zf.write(tmp_pdf, arcname="فهرست.pdf", compress_type=zipfile.ZIP_DEFLATED)
+            self.add_bytes("meta.json", _meta_json(entries))
+            self._zf.close()
+            os.replace(self._part, self.path)
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            with suppress(Exception):
+                tmp_pdf.unlink()
+        return self.path
+
+    def abort(self) -> None:
+        with suppress(Exception):
+            self._zf.close()
+        with suppress(Exception):
+            self._part.unlink()
+
+
+class VolumedZip:
+    """
+    خروجی چندجلدی زیر سقف حجمی (مثلاً محدودیت ۵۰ مگابایتی Bot API).
+    اگر افزودن PDF بعدی حجم جلد جاری را از max_bytes بیشتر کند جلد تازه باز می‌شود. هر جلد فهرست
+    (PDF + meta.json) مخصوص فایل‌های خودش را دارد و ردیف‌های بدون فایل در فهرست جلد اول می‌آیند.
+    اگر فقط یک جلد لازم شود نام همان base_path است، وگرنه <name>_partN.zip.
+    """
+
+    def __init__(self, base_path: Path, *, max_bytes: int, reserve_bytes: int = 1024 * 1024) -> None:
+        self.base_path = base_path
+        self.max_bytes = max(1, int(max_bytes))
+        # جا برای PDF فهرست و meta.json هر جلد
+        self.reserve_bytes = max(0, min(int(reserve_bytes), self.max_bytes // 4))
+        self.volumes: List[StreamingZip] = []
+        self._sizes: List[int] = []
+        self._owner: Dict[str, int] = {}
+        self.timings: Dict[str, float] = {}
+
+    def _open_volume(self) -> StreamingZip:
+        n = len(self.volumes) + 1
+        vol = StreamingZip(self.base_path.with_name(f"{self.base_path.stem}_part{n}{self.base_path.suffix}"))
+        self.volumes.append(vol)
+        self._sizes.append(0)
+        return vol
+
+    def add_file(self, path: Path, arcname: Optional[str] = None) -> Optional[str]:
+        path = Path(path)
+        try:
+            size = path.stat().st_size
+        except OSError:
+            return None
+        key = str(path.resolve())
+        if key in self._owner:
+            return None
+        overhead = 256 + 2 * len((arcname or path.name).encode("utf-8"))
+        budget = self.max_bytes - self.reserve_bytes
+        if not self.volumes or (self._sizes[-1] and self._sizes[-1] + size + overhead > budget):
+            self._open_volume()
+        if size + overhead > budget:
+            # یک PDF را نمی‌توان بین جلدها شکست؛ در جلد جداگانهٔ خودش می‌ماند
+            LOGGER.warning("zip_volume_oversize_file | file=%s bytes=%d cap=%d", path.name, size, self.max_bytes)
+        name = self.volumes[-1].add_file(path, arcname)
+        if name:
+            self._sizes[-1] += size + overhead
+            self._owner[key] = len(self.volumes) - 1
+        return name
+
+    def _entries_per_volume(self, entries: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        out: List[List[Dict[str, Any]]] = [[] for _ in self.volumes]
+        for e in entries:
+            idx = 0
+            fp = e.get("file_path")
+            if fp:
+                with suppress(Exception):
+                    idx = self._owner.get(str(Path(fp).resolve()), 0)
+            out[idx].append(e)
+        return out
+
+    async def finish_async(self, entries: List[Dict[str, Any]], font_path: Path, *, workers: int = 2) -> List[Path]:
+        """همهٔ جلدها را (فهرست‌ها موازی در process pool) می‌بندد و مسیرهای نهایی را به ترتیب برمی‌گرداند."""
+        if not self.volumes:
+            self._open_volume()
+        if len(self.volumes) == 1:
+            self.volumes[0].path = self.base_path
+        per_volume = self._entries_per_volume(entries)
+        results = await asyncio.gather(
+            *(vol.finish_async(ents, font_path, workers=workers) for vol, ents in zip(self.volumes, per_volume)),
+            return_exceptions=True,
+        )
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            self.abort()
+            for r in results:
+                if isinstance(r, Path):
+                    with suppress(Exception):
+                        r.unlink()
+            raise errors[0]
+        self.timings = {
+            "volumes": len(self.volumes),
+            "append_ms": round(sum(v.timings.get("append_ms", 0.0) for v in self.volumes), 1),
+            "summary_ms": max(v.timings.get("summary_ms", 0.0) for v in self.volumes),
+            "finalize_ms": max(v.timings.get("finalize_ms", 0.0) for v in self.volumes),
+        }
+        return [Path(r) for r in results]
+
+    def abort(self) -> None:
+        for vol in self.volumes:
+            vol.abort()
+
+
+def build_zip_with_summary(entries: List[Dict[str, Any]], zip_path: Path, font_path: Path) -> Path:
+    zf = StreamingZip(zip_path)
+    for item in entries:
+        fpath = item.get("file_path")
+        if fpath:
+            zf.add_file(Path(fpath))
+    return zf.finish(entries, font_path)